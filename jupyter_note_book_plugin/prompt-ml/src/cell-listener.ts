@@ -20,7 +20,7 @@ import {
 
 import { ISignal, Signal } from '@lumino/signaling';
 import { IObservableList } from "@jupyterlab/observables";
-import { ServerConnection } from "@jupyterlab/services";
+import { KernelMessage, ServerConnection } from "@jupyterlab/services";
 
 import { PromiseDelegate } from "@lumino/coreutils";
 import { CodeCellClient } from "./client";
@@ -35,6 +35,11 @@ export class Listener {
   private tracker : INotebookTracker;
   private _infoSignal : Signal<this, any> = new Signal<this, any>(this);
   private notebook : Notebook;
+  // "<kernel id>:<execution count>" -> msg_id of the execute request, the
+  // kernel stores the namespace snapshot of that execution under it
+  private execMsgIds : Map<string, string> = new Map<string, string>();
+  // session contexts whose kernel messages are already listened to
+  private sessions : WeakSet<object> = new WeakSet<object>();
 
   constructor(client: CodeCellClient, tracker : INotebookTracker) {
 
@@ -57,11 +62,62 @@ export class Listener {
     if(signalSender.currentWidget != null) {
         await signalSender.currentWidget.revealed;
         listener.notebook = signalSender.currentWidget.content;
+        let sessionContext = signalSender.currentWidget.sessionContext;
+        // currentChanged fires each time the notebook is switched back to
+        if (!listener.sessions.has(sessionContext)) {
+          listener.sessions.add(sessionContext);
+          sessionContext.iopubMessage.connect(listener.recordExecution, listener);
+          sessionContext.statusChanged.connect(listener.clearOnRestart, listener);
+          sessionContext.kernelChanged.connect(listener.clearOnKernelChange, listener);
+        }
         listener.listen();
         listener._ready.resolve(undefined);
     }
   }
 
+  private recordExecution(sender : any, msg : KernelMessage.IIOPubMessage) {
+    if (msg.header.msg_type === "execute_input" && sender.session && sender.session.kernel) {
+      let exec_ct = (msg as KernelMessage.IExecuteInputMsg).content.execution_count;
+      let parent = msg.parent_header as KernelMessage.IHeader;
+      this.execMsgIds.set(sender.session.kernel.id + ":" + exec_ct, parent.msg_id);
+    }
+  }
+
+  private clearOnRestart(sender : any, status : string) {
+    // a restarted kernel counts executions from 1 again
+    if ((status === "restarting" || status === "autorestarting") && sender.session && sender.session.kernel) {
+      this.clearExecutions(sender.session.kernel.id);
+    }
+  }
+
+  private clearOnKernelChange(sender : any, args : any) {
+    if (args.oldValue) {
+      this.clearExecutions(args.oldValue.id);
+    }
+  }
+
+  private clearExecutions(k_id : string) {
+    // only the executions of this kernel, other notebooks keep theirs
+    this.execMsgIds.forEach((_value, key) => {
+      if (key.slice(0, key.lastIndexOf(":")) === k_id) {
+        this.execMsgIds.delete(key);
+      }
+    });
+  }
+
+  private takeMsgId(k_id : string, exec_ct : ExecutionCount) : string | undefined {
+    // executions are reported in order, earlier ones still here never will be
+    // (eg. run from a console on the same kernel)
+    let msg_id = this.execMsgIds.get(k_id + ":" + exec_ct);
+    this.execMsgIds.forEach((_value, key) => {
+      let sep = key.lastIndexOf(":");
+      if (key.slice(0, sep) === k_id && Number(key.slice(sep + 1)) <= Number(exec_ct)) {
+        this.execMsgIds.delete(key);
+      }
+    });
+    return msg_id;
+  }
+
   private listen() {
     var cell: Cell;
     var contents: string;
@@ -101,6 +157,7 @@ export class Listener {
 	      id = cell.model.id;
           k_id = this.tracker.currentWidget.sessionContext.session.kernel.id;
           exec_ct = (cell as CodeCell).model.executionCount;
+          let msg_id = this.takeMsgId(k_id, exec_ct);
           this.client.request(
             "exec", "POST", 
             JSON.stringify({
@@ -109,6 +166,7 @@ export class Listener {
                 "cell_id" : id,
                 "kernel" : k_id,
                 "exec_ct" : exec_ct,
+                "msg_id" : msg_id === undefined ? null : msg_id,
                 "metadata" : JSON.stringify(cell.model.metadata)}),
 	        ServerConnection.makeSettings()).
 	    then(value => { 
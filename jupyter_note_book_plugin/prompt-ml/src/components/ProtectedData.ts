@@ -216,6 +216,10 @@ export class ProtectedData {
       vc_str += count;
       vc_str += "</p>";
     }
+    if (res["sampled"]) {
+      // the dataframe was too large to store whole, only a sample of its rows was counted
+      vc_str += "<p class=values>counted in a sample of the rows</p>";
+    }
 
     return vc_str;
   }
@@ -16,13 +16,14 @@ from prompter.storage import DbHandler, RemoteDbHandler
 from prompter.analysis import AnalysisEnvironment, run_code, Aliases
 from prompter.visitors import DataFrameVisitor, ModelScoreVisitor
 from prompter.forkingkernel import ForkingKernel
-from prompter.config import table_query # necessary for testing
+from prompter.config import table_query, migrate_query # necessary for testing
 # imports the three different manager classes used to handle
 # requests and information from the frontend
 from prompter.managers.database import DatabaseManager
 from prompter.managers.request import RequestManager
 from prompter.managers.analysis import AnalysisManager
 from prompter.managers.tracking import TrackingManager
+from prompter.managers.retention import RetentionManager
 
 #from prompter.handler import TSChannelHandler
 
@@ -34,9 +35,9 @@ from prompter.managers.tracking import TrackingManager
 class CodeExecHandler(APIHandler):
     """handles transactions from notebook js app and server backend"""
     
-    def post(self):
+    async def post(self):
 #        print(tornado.escape.json_decode(self.request.body))
-        resp_body = REQUEST_MANAGER.handle_request(tornado.escape.json_decode(self.request.body))
+        resp_body = await REQUEST_MANAGER.handle_request(tornado.escape.json_decode(self.request.body))
         self.set_status(200)
         self.set_default_headers()
         self.finish(resp_body)
@@ -46,7 +47,7 @@ def _jupyter_server_extension_paths():
 
 def load_jupyter_server_extension(app):
     # The three types of managers used to handle traffic
-    global DATABASE_MANAGER, ANALYSIS_MANAGER, REQUEST_MANAGER, TRACKING_MANAGER
+    global DATABASE_MANAGER, ANALYSIS_MANAGER, REQUEST_MANAGER, TRACKING_MANAGER, RETENTION_MANAGER
     # Manages setting up local and remote database handlers
     DATABASE_MANAGER = DatabaseManager(app)
     # Analysis manager intakes cell executions and user input
@@ -54,7 +55,9 @@ def load_jupyter_server_extension(app):
     # Tracking manager handles db storage of user interactions
     TRACKING_MANAGER = TrackingManager(app, DATABASE_MANAGER)
     # Request manager intakes and routes requests
-    REQUEST_MANAGER = RequestManager(ANALYSIS_MANAGER, TRACKING_MANAGER)
+    REQUEST_MANAGER = RequestManager(ANALYSIS_MANAGER, TRACKING_MANAGER, DATABASE_MANAGER)
+    # Retention manager removes old namespace snapshots in the background
+    RETENTION_MANAGER = RetentionManager(app, DATABASE_MANAGER)
     handlers = [("/code_tracker/exec", CodeExecHandler)]
     base_url = app.web_app.settings["base_url"]
     handlers = [(url_path_join(base_url, x[0]), x[1]) for x in handlers]
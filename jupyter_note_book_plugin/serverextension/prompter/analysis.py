@@ -2,16 +2,16 @@
 analysis.py creates a running environment for dynamically tracking
 data relationships between variables
 """
+from collections import ChainMap
 from queue import Empty
 from ast import parse, Name, Attribute, Str
 from sklearn.base import ClassifierMixin
 from pandas import DataFrame
 
-import dill
-
 from timeit import default_timer as timer
 
-from .storage import load_dfs
+from .storage import load_dfs, load_ns, load_profiles
+from .profiles import col_info
 from .visitors import DataFrameVisitor, ModelScoreVisitor
 
 class AnalysisEnvironment:
@@ -30,6 +30,7 @@ class AnalysisEnvironment:
         self.pandas_alias = Aliases("pandas") # handle imports and functions
         self.entry_points = {} # new data introduced into notebook
         self._kernel_id = kernel_id
+        self.profiles = {} # df name -> column profile, from the namespace last analyzed
         
         self._nbapp = nbapp
         self.models = {}
@@ -39,24 +40,38 @@ class AnalysisEnvironment:
 
         self.ancestors = {} # map of (df_name, version) -> {(input_df_name, version), ...,}
 
-    def cell_exec(self, code, notebook, cell_id, exec_ct):
+    def cell_exec(self, code, notebook, cell_id, exec_ct, msg_id=None, ns=None, coalesced=False):
         """
         rewrite of code execution 
+        msg_id is that of the execute request, new data versions link to its snapshot
+        ns is the namespace to analyze, if not given that of msg_id, or the most
+        recent one if there is no msg_id
+        coalesced executions have no snapshot of their own, ns is the one stored
+        at the end of their burst. their new data versions are recorded without
+        a msg_id or object_ref, so they do not point at another execution's frames
         """ 
+        # pylint: disable=too-many-arguments
         cell_code = parse(code)
 
-        try:
-            ns = self.db.recent_ns() 
-        except:
-            self._nbapp.log.warning("[ANALYSIS.CELL_EXEC] Could not acquire namespace") 
+        if ns is None:
+            try:
+                ns = self.db.msg_ns(msg_id) if msg_id else self.db.recent_ns(notebook)
+            except:
+                self._nbapp.log.warning("[ANALYSIS.CELL_EXEC] Could not acquire namespace") 
+                return
+        if ns is None:
+            # another snapshot would link the new data versions to the wrong dataframes
+            self._nbapp.log.warning("[ANALYSIS.CELL_EXEC] no namespace stored for kernel {0}, execution {1}".format(notebook, msg_id))
             return
 
-        ns_dfs = load_dfs(ns)
-        full_ns = dill.loads(ns["namespace"])
+        ns_dfs = load_dfs(ns, cache=self.db.ns_cache)
+        non_dfs = load_ns(ns, cache=self.db.ns_cache)
+        self.profiles = load_profiles(ns, cache=self.db.ns_cache)
         
-        full_ns.update(ns_dfs)
+        # dataframes are only loaded when the visitors look them up
+        full_ns = ChainMap(ns_dfs, non_dfs)
 
-        model_names = [k for k,v in full_ns.items() if isinstance(v, ClassifierMixin)]
+        model_names = [k for k,v in non_dfs.items() if isinstance(v, ClassifierMixin)]
     
         # new data check
         new_data = self._get_new_data(ns_dfs, cell_id)
@@ -81,35 +96,30 @@ class AnalysisEnvironment:
             self.entry_points[df_name]["name"] = df_name
             self.entry_points[df_name]["kernel"] = self._kernel_id
 
-            if df_name in full_ns:
+            if df_name in self.profiles:
+                self.entry_points[df_name]["columns"] = col_info(self.profiles[df_name])
+            elif df_name in full_ns:
                 df_obj = full_ns[df_name]
                 if isinstance(df_obj, DataFrame):
-                    self.entry_points[df_name]["columns"] = {}
-                    for c in df_obj.columns:
-                        self.entry_points[df_name]["columns"][c] = {}
-                        self.entry_points[df_name]["columns"][c]["size"] = len(df_obj[c])
-                        self.entry_points[df_name]["columns"][c]["type"] = str(df_obj[c].dtypes)
+                    self.entry_points[df_name]["columns"] = self.col_info(df_name, full_ns)
         # add data to db
+        # most recent version of each dataframe, looked up once for all the ancestors
+        max_versions = self.db.max_versions(self._kernel_id)
         for entry_point in self.entry_points.values():
 
             self.log.debug("[AnalysisEnv] checking {0}".format(entry_point))
-            pt_version = self.db.check_add_data(entry_point, exec_ct)   
+            # new versions point straight at the dataframe stored in this snapshot
+            object_ref = None if coalesced else ns_dfs.ref(entry_point["name"])
+            pt_version = self.db.check_add_data(entry_point, exec_ct, None if coalesced else msg_id, object_ref)
             child = (entry_point["name"], pt_version)
+            max_versions[child[0]] = max(max_versions.get(child[0], pt_version), pt_version)
 
             if child not in self.ancestors:
                 self.ancestors[child] = set()
 
             # get the most recent version of each. ancestor
-            # this could be made more efficient by looking up all ancestors
-            # once and then using a lookup, but unless this ends up being a 
-            # big time-sink, additional complexity probably not worth it. 
             for ancestor in entry_point["ancestors"]:
-                anc_versions = self.db.find_data({"name" : ancestor, "kernel" : self._kernel_id})
-                if anc_versions is None:
-                    anc_max_version = 1
-                else:
-                    anc_max_version = max([anc["version"] for anc in anc_versions])
-                self.ancestors[child].add((ancestor, anc_max_version))
+                self.ancestors[child].add((ancestor, max_versions.get(ancestor, 1)))
 
         # new model fit calls? 
         new_models = model_visitor.models
@@ -134,20 +144,25 @@ class AnalysisEnvironment:
                 "cell" : cell_id,
                 "name" : df,
                 "kernel" : self._kernel_id,
-                "columns" : {},
+                "columns" : self.col_info(df, df_ns),
             }
 
-            for col in df_ns[df].columns:
-                lookup_entry["columns"][col] = {}
-                lookup_entry["columns"][col]["size"] = len(df_ns[df][col])
-                lookup_entry["columns"][col]["type"] = str(df_ns[df][col].dtypes)
-
             version = self.db.is_new_data(lookup_entry) # returns true/false whether entry is new or not
 
             if version is None: 
                 new_dfs[df] = df_ns[df]
         return new_dfs
                 
+    def col_info(self, df_name, dfs):
+        """
+        return {column : {"size", "type"}} for df_name, from its profile if the
+        kernel stored one, so the frame does not have to be loaded
+        """
+        if df_name in self.profiles:
+            return col_info(self.profiles[df_name])
+        df = dfs[df_name]
+        return {col : {"size" : len(df[col]), "type" : str(df[col].dtypes)} for col in df.columns}
+
     def get_models(self):
         """are models in cell defined in this analysis?"""
         return self.models
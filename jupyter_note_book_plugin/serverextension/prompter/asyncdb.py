@@ -0,0 +1,70 @@
+"""
+asyncdb.py gives the server awaitable access to a DbHandler, so queries,
+commits and waits for namespace snapshots run off the IOLoop and a slow
+database does not stall every other request of the Jupyter server.
+
+Calls run on a pool of database threads, as many as the handler has
+connections free for them (its pool_size). A RemoteDbHandler gives each
+thread its own pooled connection and its own connection to the local
+database. Its pool holds one connection more than pool_size, and no thread
+outside the database threads holds one while the server runs, so every
+database thread can connect. A DbHandler has a single sqlite connection, so
+its calls run one at a time on one thread.
+
+Waiting for a namespace snapshot does not hold a database thread, the
+IOLoop polls for it between lookups, see wait_for_ns.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+from .config import SNAPSHOT_WAIT
+
+class AsyncDbHandler:
+    """
+    awaitable versions of the methods of a DbHandler, eg.
+    await async_db.get_responses(kernel_id)
+    """
+    def __init__(self, db, workers=None):
+        self.db = db
+        # one thread for each connection the handler leaves to the database threads
+        self.workers = workers or getattr(db, "pool_size", 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+
+    def run(self, func, *args, **kwargs):
+        """
+        return an awaitable for func(*args, **kwargs) on a database thread.
+        for work that uses the handler between other steps, eg. analyzing an
+        execution, so the whole of it runs there
+        """
+        return IOLoop.current().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def wait_for_ns(self, exec_ct, kernel_id=None, timeout=SNAPSHOT_WAIT, msg_id=None):
+        """
+        DbHandler.wait_for_ns, each lookup runs on a database thread and the
+        IOLoop sleeps in between, so a slow snapshot only holds up its own request
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            ns = await self.run(self.db.find_ns, exec_ct, kernel_id, msg_id=msg_id)
+            if ns is not None or time.monotonic() >= deadline:
+                return ns
+            await asyncio.sleep(0.05)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            raise AttributeError("{0} is not a method of {1}".format(name, type(self.db).__name__))
+
+        def call(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+    def close(self):
+        """finish the calls already made, then stop the database threads"""
+        self.executor.shutdown(wait=True)
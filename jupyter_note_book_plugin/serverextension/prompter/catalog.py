@@ -0,0 +1,114 @@
+"""
+catalog.py keeps the data versions and column metadata of each kernel in
+memory, so DbHandler can answer find_data, get_columns, get_recent_cols and
+the like with dictionary lookups instead of queries.
+
+A kernel's rows are read from the data and columns tables the first time it
+is looked up. After that the catalog is written through: DbHandler adds the
+rows it inserts and the columns it marks, so the catalog can answer for
+rows that are still queued in an outbox. Rows are returned as copies, in the
+form the queries they replace returned them.
+
+Calls come from the database threads, see asyncdb.py, and invalidate from
+the replicator thread too, so a lock guards what is kept. A kernel's rows are
+read without holding it, and are not kept if the kernel was invalidated or
+written to while they were read, the next lookup reads them again.
+"""
+import bisect
+import threading
+
+from .profiles import columns_fingerprint
+
+class MetadataCatalog:
+    """
+    {kernel : data versions by df name, columns by (df name, version)}
+    load takes a kernel and returns its (data rows, columns rows)
+    """
+    def __init__(self, load):
+        self._load = load
+        self._kernels = {}
+        self._changes = {} # kernel -> count of invalidations and writes while it was not kept
+        self._lock = threading.Lock()
+
+    def _kernel(self, kernel):
+        with self._lock:
+            if kernel in self._kernels:
+                return self._kernels[kernel]
+            changes = self._changes.get(kernel, 0)
+        data_rows, col_rows = self._load(kernel)
+        versions, columns = {}, {}
+        for row in data_rows:
+            versions.setdefault(row["name"], []).append(dict(row))
+        for row_list in versions.values():
+            row_list.sort(key=lambda row: row["version"])
+        for row in col_rows:
+            columns.setdefault((row["name"], row["version"]), []).append(dict(row))
+        for row_list in versions.values():
+            for row in row_list:
+                if not row.get("schema_hash"): # recorded before versions stored it
+                    cols = columns.get((row["name"], row["version"]), [])
+                    row["schema_hash"] = columns_fingerprint({c["col_name"] : c for c in cols})
+        with self._lock:
+            if self._changes.get(kernel, 0) == changes:
+                return self._kernels.setdefault(kernel, (versions, columns))
+        return versions, columns # only for this call
+
+    def _changed(self, kernel):
+        """note a change to a kernel that is not kept, a read of it under way is then not kept either"""
+        self._changes[kernel] = self._changes.get(kernel, 0) + 1
+
+    def versions(self, kernel, name):
+        """the data rows of name, oldest version first"""
+        versions = self._kernel(kernel)[0]
+        with self._lock:
+            return [dict(row) for row in versions.get(name, [])]
+
+    def columns(self, kernel, name, version):
+        """the columns rows of a version of name"""
+        columns = self._kernel(kernel)[1]
+        with self._lock:
+            return [dict(row) for row in columns.get((name, version), [])]
+
+    def max_versions(self, kernel):
+        """{df name : most recent version}"""
+        versions = self._kernel(kernel)[0]
+        with self._lock:
+            return {name : rows[-1]["version"] for name, rows in versions.items() if rows}
+
+    def recent_columns(self, kernel):
+        """the columns rows of the most recent version of each dataframe, by df name"""
+        return [row for name, version in sorted(self.max_versions(kernel).items())
+                for row in self.columns(kernel, name, version)]
+
+    def data_rows(self):
+        """the data rows of every kernel that has been read"""
+        with self._lock:
+            return [dict(row) for versions, _ in self._kernels.values() for rows in versions.values() for row in rows]
+
+    def add_version(self, kernel, data_row, col_rows):
+        """record a version that was just inserted, if the kernel has been read"""
+        with self._lock:
+            if kernel not in self._kernels:
+                self._changed(kernel) # read with the rest when it is first looked up
+                return
+            versions, columns = self._kernels[kernel]
+            rows = versions.setdefault(data_row["name"], [])
+            keys = [row["version"] for row in rows]
+            rows.insert(bisect.bisect(keys, data_row["version"]), dict(data_row))
+            columns[(data_row["name"], data_row["version"])] = [dict(row) for row in col_rows]
+
+    def update_column(self, kernel, name, version, col_name, values):
+        """update the columns row of col_name in a version of name, if the kernel has been read"""
+        with self._lock:
+            if kernel not in self._kernels:
+                self._changed(kernel)
+                return
+            for row in self._kernels[kernel][1].get((name, version), []):
+                if row["col_name"] == col_name:
+                    row.update(values)
+
+    def invalidate(self, kernel):
+        """drop what is known of kernel, it is read again when next looked up"""
+        with self._lock:
+            self._kernels.pop(kernel, None)
+            self._changed(kernel)
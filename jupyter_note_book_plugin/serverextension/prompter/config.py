@@ -3,6 +3,8 @@ import importlib.resources as pkg_resources
 
 DB_DIR = "~/.promptml/"
 DB_NAME = "cells.db"
+FRAMES_DIR = DB_DIR + "frames/"
+OBJECTS_DIR = DB_DIR + "objects/"
 
 
 if not os.getenv("MODE"):
@@ -14,5 +16,63 @@ if not os.getenv("DOCKER_HOST_IP"):
 else:
     remote_config = {"db_user" : "prompter_user", "host" : os.getenv("DOCKER_HOST_IP"), "password" : "user_pw", "database" : "notebooks"}
 
+# skip pickling variables whose identity and contents did not change since the last snapshot
+DELTA_SNAPSHOTS = os.getenv("DELTA_SNAPSHOTS", "1") != "0"
+# pickle and store snapshots on a writer thread instead of before the execute reply
+BACKGROUND_SNAPSHOTS = os.getenv("BACKGROUND_SNAPSHOTS", "1") != "0"
+# snapshots that may wait on the writer before executions block
+SNAPSHOT_QUEUE_SIZE = int(os.getenv("SNAPSHOT_QUEUE_SIZE", "4"))
+# during a burst of queued executions (eg. run all) store only the final snapshot
+COALESCE_SNAPSHOTS = os.getenv("COALESCE_SNAPSHOTS", "1") != "0"
+# bytes a single object may take in a snapshot, larger ones are summarized. 0 for no limit
+SNAPSHOT_OBJECT_BUDGET = int(os.getenv("SNAPSHOT_OBJECT_BUDGET", str(256 * 2**20)))
+# bytes of new objects a snapshot may store, objects past it are summarized. 0 for no limit
+SNAPSHOT_BUDGET = int(os.getenv("SNAPSHOT_BUDGET", str(2**30)))
+# rows kept of a DataFrame that is over budget
+SAMPLE_ROWS = int(os.getenv("SAMPLE_ROWS", "10000"))
+# store snapshots from a forked copy of the kernel, on systems with fork. takes
+# precedence over BACKGROUND_SNAPSHOTS. the kernel runs threads (the IOLoop, the
+# heartbeat, threads started by user code) and only the forking thread is copied
+# into the child, so a lock another thread held at the fork stays held there and
+# the child can deadlock on it, eg. in logging or a library's own locks
+FORK_SNAPSHOTS = os.getenv("FORK_SNAPSHOTS", "0") != "0"
+# seconds a forked snapshot process may run before it is killed and its snapshot
+# given up, 0 to wait on it indefinitely
+FORK_SNAPSHOT_TIMEOUT = float(os.getenv("FORK_SNAPSHOT_TIMEOUT", "300"))
+# msg_id of a namespace snapshot to start the kernel from, see restore.py
+RESTORE_SNAPSHOT = os.getenv("RESTORE_SNAPSHOT")
+# store column profiles of DataFrames with each snapshot
+PROFILE_FRAMES = os.getenv("PROFILE_FRAMES", "1") != "0"
+# rows of a longer DataFrame sampled for the top values in its profile
+PROFILE_ROWS = int(os.getenv("PROFILE_ROWS", "100000"))
+# store DataFrames column by column under FRAMES_DIR instead of as pickles
+COLUMNAR_FRAMES = os.getenv("COLUMNAR_FRAMES", "1") != "0"
+# snapshots always kept per kernel, on top of those that data versions were recorded at
+RETAIN_SNAPSHOTS = int(os.getenv("RETAIN_SNAPSHOTS", "50"))
+# seconds between removals of older snapshots, 0 keeps every snapshot
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "600"))
+# seconds the analysis side waits for the snapshot of an execution
+SNAPSHOT_WAIT = float(os.getenv("SNAPSHOT_WAIT", "5"))
+# bytes of decoded namespaces and variables the server keeps in memory, see nscache.py
+NS_CACHE_BYTES = int(os.getenv("NS_CACHE_BYTES", str(512 * 2**20)))
+# note responses and tracking events buffered before they are written in one batch
+WRITE_BATCH_ROWS = int(os.getenv("WRITE_BATCH_ROWS", "50"))
+# seconds a buffered row may wait before it is written
+WRITE_FLUSH_SECONDS = float(os.getenv("WRITE_FLUSH_SECONDS", "2"))
+# pooled connections to the remote database, one is held by each thread that uses it
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# seconds a remote connection may sit unused before it is checked with a ping
+DB_IDLE_SECONDS = float(os.getenv("DB_IDLE_SECONDS", "30"))
+# local file that holds writes until they have been copied to the remote database
+OUTBOX_NAME = os.getenv("OUTBOX_NAME", "outbox.db")
+# queued rows copied to the remote database in one transaction
+REPLICATE_BATCH_ROWS = int(os.getenv("REPLICATE_BATCH_ROWS", "500"))
+# seconds between attempts to copy queued rows while the remote database is unreachable
+REPLICATE_RETRY_SECONDS = float(os.getenv("REPLICATE_RETRY_SECONDS", "10"))
+# seconds the replicator and the database threads wait for the remote database to accept a connection
+REMOTE_CONNECT_SECONDS = int(os.getenv("REMOTE_CONNECT_SECONDS", "5"))
+
 table_query = pkg_resources.read_text(__package__, "make_tables.sql")
+# brings the tables of a database made by an earlier make_tables.sql up to date
+migrate_query = pkg_resources.read_text(__package__, "migrate_tables.sql")
 
@@ -4,6 +4,19 @@ kernel based on the state of the kernel at a previous point.
 
 It does this by updating a table associating msg_ids with a version
 of the namespace in the cells database.
+
+With FORK_SNAPSHOTS set, snapshots are stored by a forked copy of the kernel,
+see ForkedSnapshotWriter.
+
+The kernel can be put back in the state of any stored snapshot with
+%restore_namespace <msg_id>, or started from one by setting RESTORE_SNAPSHOT,
+see restore.py.
+
+When executions are queued behind the current one, eg. during run all,
+snapshots are coalesced. Each execution gets a placeholder row with no
+namespace, and only the state the kernel is in when the queue runs dry is
+stored, under the msg_id of the last execution. Executions whose request
+metadata has "snapshot" set are always stored.
 """
 
 from datetime import datetime
@@ -12,13 +25,20 @@ import sqlite3
 import os
 import dill
 import re
-
-import pandas as pd
+import zmq
 
 from ipykernel.ipkernel import IPythonKernel
+from IPython.core.error import UsageError
+
+from .config import DB_DIR, DB_NAME, DELTA_SNAPSHOTS, BACKGROUND_SNAPSHOTS, SNAPSHOT_QUEUE_SIZE, COLUMNAR_FRAMES, \
+    COALESCE_SNAPSHOTS, SNAPSHOT_OBJECT_BUDGET, SNAPSHOT_BUDGET, SAMPLE_ROWS, PROFILE_FRAMES, PROFILE_ROWS, \
+    FORK_SNAPSHOTS, FORK_SNAPSHOT_TIMEOUT, RESTORE_SNAPSHOT
+from .storage import LOCAL_SQL_CMDS, update_ns_table
+from .snapshots import DeltaEncoder, SnapshotWriter, ForkedSnapshotWriter, write_snapshot, telemetry_rows
+from .objectstore import ObjectStore
+from .restore import load_manifest, bind, load_referenced
 
-from .config import DB_DIR, DB_NAME
-from .storage import LOCAL_SQL_CMDS
+IDLE_CHECK = 0.05 # seconds between checks whether a burst of executions has ended
 
 class ForkingKernel(IPythonKernel):
     """
@@ -34,17 +54,55 @@ class ForkingKernel(IPythonKernel):
 
         super().__init__(**kwargs)
 
-        self.insert_cmd = """INSERT INTO namespaces(msg_id, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?)"""
+        # a coalesced execution's placeholder row is replaced by its snapshot
+        self.insert_cmd = """INSERT OR REPLACE INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.kernel_id = self._kernel_id()
+        self._deferred = None # (msg_id, exec_ct, time, code) of the execution whose snapshot is put off
+        self._executing = False
+        self._encoder = DeltaEncoder(ObjectStore(), delta=DELTA_SNAPSHOTS, columnar=COLUMNAR_FRAMES,
+                                     log=self.log, object_budget=SNAPSHOT_OBJECT_BUDGET,
+                                     snapshot_budget=SNAPSHOT_BUDGET, sample_rows=SAMPLE_ROWS,
+                                     profile=PROFILE_FRAMES, profile_rows=PROFILE_ROWS)
 
         self._connect_db()
 
+        self._writer = None
+        if FORK_SNAPSHOTS and hasattr(os, "fork"):
+            self._writer = ForkedSnapshotWriter(self._db_file, self.insert_cmd, LOCAL_SQL_CMDS["ADD_OBJECT"],
+                                                self._encoder, self.log,
+                                                vars_cmd=LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"],
+                                                child_timeout=FORK_SNAPSHOT_TIMEOUT)
+        elif BACKGROUND_SNAPSHOTS:
+            self._writer = SnapshotWriter(self._db_file, self.insert_cmd, LOCAL_SQL_CMDS["ADD_OBJECT"],
+                                          self._encoder, self.log, maxsize=SNAPSHOT_QUEUE_SIZE,
+                                          vars_cmd=LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"])
+
+        self.shell.events.register("pre_run_cell", self._load_referenced)
+        self.shell.register_magic_function(self._restore_magic, "line", "restore_namespace")
+        if RESTORE_SNAPSHOT:
+            self.restore(RESTORE_SNAPSHOT)
+
+    def _kernel_id(self):
+        """
+        return the id the notebook server knows this kernel by, which names
+        its connection file kernel-<id>.json. None if it was started otherwise
+        """
+        connection_file = getattr(self.parent, "connection_file", None) or ""
+        match = re.fullmatch(r"kernel-(.+)\.json", os.path.basename(connection_file))
+        if match is None:
+            self.log.warning("[FORKINGKERNEL] no kernel id in connection file {0}".format(connection_file))
+            return None
+        return match.group(1)
+
     def _connect_db(self, dirname=DB_DIR, dbname=DB_NAME):
         db_path = os.path.expanduser(dirname)
+        self._db_file = db_path+dbname
         if os.path.isdir(db_path) and os.path.isfile(db_path+dbname):
             self.log.debug("[FORKINGKERNEL] found database")
             self._conn = sqlite3.connect(db_path+dbname,
                                          detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
             self._cursor = self._conn.cursor()
+            self._add_table()
         else:
             self.log.debug("[FORKINGKERNEL] creating database")
             if not os.path.isdir(db_path):
@@ -53,6 +111,7 @@ class ForkingKernel(IPythonKernel):
                                          detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
             self._conn.row_factory = sqlite3.Row
             self._cursor = self._conn.cursor()
+            self._cursor.execute(LOCAL_SQL_CMDS["INCREMENTAL_VACUUM"])
             self._add_table()
 
     def _add_table(self):
@@ -62,11 +121,14 @@ class ForkingKernel(IPythonKernel):
 
         if len(result) == 0:
             self._cursor.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
-            self._conn.commit()
+        self._cursor.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        self._cursor.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+        self._conn.commit()
+        update_ns_table(self._conn)
 
-    def _handle_ns(self):
-        """render objects into serializable format as needed"""
-        better_ns = {"_forking_kernel_dfs" : {}}
+    def _snapshot_vars(self):
+        """return the user variables that belong in a snapshot"""
+        variables = {}
 
         boiler_plate_keys = [ # defs that are just part of kernel exec env
             "__name__", "__doc__", "__package__", "__loader__",
@@ -83,20 +145,56 @@ class ForkingKernel(IPythonKernel):
             matches = [exp.fullmatch(k) for exp in boiler_plate_exp]
             if not all([m is None for m in matches]):
                 continue
-            if isinstance(var, pd.DataFrame):
-                better_ns["_forking_kernel_dfs"][k] = dill.dumps(var)
-            else:
-                try:
-                    bad_objs = dill.detect.badobjects(var)
-                    if bad_objs is None:
-                        better_ns[k] = var
-                    else:
-                        self.log.debug(
-                            "[FORKINGKERNEL] could not pickle {0}, problem items {1}".format(
-                             k, dill.detect.badobjects(var)))
-                except ValueError:
-                    self.log.error("[FORKINGKERNEL] exception pickling {0}".format(k))
-        return better_ns
+            variables[k] = var
+        return variables
+
+    def restore(self, msg_id):
+        """
+        replace the user's variables with those of the snapshot stored under
+        msg_id, which are loaded when first used. return their names, and
+        {name : reason} for those that were stored reduced and not restored
+        """
+        if self._writer:
+            self._writer.flush()
+        manifest = load_manifest(self._conn, msg_id)
+
+        for name in self._snapshot_vars():
+            if name not in self.shell.user_ns_hidden:
+                del self.shell.user_ns[name]
+        names, reduced = bind(self.shell.user_ns, manifest, self._encoder.store)
+        self._encoder.reset()
+        self.log.info("[FORKINGKERNEL] restored {0} variables from {1}".format(len(names), msg_id))
+        if reduced:
+            self.log.info("[FORKINGKERNEL] not restored {0}".format(reduced))
+        return names, reduced
+
+    def _restore_magic(self, line):
+        """
+        %restore_namespace <msg_id> : go back to the namespace stored under msg_id.
+        variables are loaded when a cell reads them or they are first used, until
+        then type() of one is LazyVariable, though isinstance checks pass
+        """
+        msg_id = line.strip()
+        if not msg_id:
+            raise UsageError("%restore_namespace needs the msg_id of a stored namespace")
+        try:
+            names, reduced = self.restore(msg_id)
+        except KeyError as e:
+            raise UsageError(e.args[0])
+        print("restored {0}".format(", ".join(sorted(names))))
+        if reduced:
+            print("not restored, only a summary or a sample of their rows was stored: {0}".format(
+                ", ".join(sorted(reduced))))
+
+    def _load_referenced(self, info=None):
+        """load the restored variables the cell about to run reads"""
+        if info is None:
+            return
+        try:
+            code = self.shell.transform_cell(info.raw_cell)
+        except Exception: # pylint: disable=broad-except
+            return # IPython reports the error when it runs the cell
+        load_referenced(self.shell.user_ns, code, self.log)
 
     def _cache_ns(self, code):
 
@@ -109,15 +207,83 @@ class ForkingKernel(IPythonKernel):
 # In testing, only object not pickleable is kernel object, which is fine
 #        bad_items = dill.detect.baditems(self.shell.user_ns)
 #        censored_ns = {k : v for k,v in self.shell.user_ns.items() if v not in bad_items}
-        relevant_ns = self._handle_ns()
-        #ns = sqlite3.Binary(dill.dumps(relevant_ns))
-        namespace = dill.dumps(relevant_ns)
-        self._cursor.execute(self.insert_cmd, (msg_id, exec_ct, curr_time, code, namespace))
-        self._conn.commit()
+        if COALESCE_SNAPSHOTS and not self._snapshot_requested() and self._executions_pending():
+            # the executions queued behind this one will change the namespace anyway
+            self._store_ns(msg_id, exec_ct, curr_time, code, None)
+            if self._deferred is None:
+                self.io_loop.call_later(IDLE_CHECK, self._snapshot_if_idle)
+            self._deferred = (msg_id, exec_ct, curr_time, code)
+            return
+        self._deferred = None
+        self._store_ns(msg_id, exec_ct, curr_time, code, self._snapshot_vars())
+
+    def _store_ns(self, msg_id, exec_ct, curr_time, code, variables):
+        """store the snapshot of variables under msg_id, or a placeholder if variables is None"""
+        # pylint: disable=too-many-arguments
+        if self._writer:
+            # pickling and the insert happen on the writer thread
+            self._writer.submit(msg_id, self.kernel_id, exec_ct, curr_time, code, variables)
+            return
+        namespace = None
+        new_objects = []
+        var_rows = []
+        if variables is not None:
+            # variables that cannot be pickled are left out by the encoder
+            namespace = dill.dumps(self._encoder.encode(variables))
+            new_objects = self._encoder.new_objects
+            var_rows = telemetry_rows(msg_id, self.kernel_id, curr_time, self._encoder.telemetry)
+        try:
+            write_snapshot(self._conn, self.insert_cmd, (msg_id, self.kernel_id, exec_ct, curr_time, code, namespace),
+                           LOCAL_SQL_CMDS["ADD_OBJECT"], new_objects, curr_time,
+                           LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"], var_rows)
+        except sqlite3.Error as e:
+            # later snapshots must not reuse objects that were never recorded
+            self._encoder.reset()
+            self.log.error("[FORKINGKERNEL] could not store namespace {0}".format(e))
+
+    def _snapshot_requested(self):
+        """did the request for this execution ask for its snapshot to be stored?"""
+        return bool(self._parent_header.get("metadata", {}).get("snapshot"))
+
+    def _executions_pending(self):
+        """are shell messages, eg. queued executions, waiting to be handled?"""
+        msg_queue = getattr(self, "msg_queue", None)
+        streams = getattr(self, "shell_streams", None) or [getattr(self, "shell_stream", None)]
+        try:
+            if msg_queue is not None and msg_queue.qsize() > 0:
+                return True
+            return any(s is not None and s.socket.poll(0) for s in streams)
+        except zmq.ZMQError:
+            return False
+
+    def _snapshot_if_idle(self):
+        """store the put off snapshot once no executions are queued"""
+        if self._deferred is None:
+            return
+        if self._executing or self._executions_pending():
+            self.io_loop.call_later(IDLE_CHECK, self._snapshot_if_idle)
+            return
+        deferred, self._deferred = self._deferred, None
+        self._store_ns(*deferred, self._snapshot_vars())
 
     def do_execute(self, code, silent, store_history=True,
                    user_expressions=None, allow_stdin=False):
-        result = super().do_execute(code, silent, store_history=store_history,
-                                    user_expressions=user_expressions, allow_stdin=allow_stdin)
+        if self._writer:
+            # the previous snapshot must be pickled before the namespace changes
+            self._writer.wait_encoded()
+        self._executing = True
+        try:
+            result = super().do_execute(code, silent, store_history=store_history,
+                                        user_expressions=user_expressions, allow_stdin=allow_stdin)
+        finally:
+            self._executing = False
         self._cache_ns(code)
         return result
+
+    def do_shutdown(self, restart):
+        if self._deferred is not None:
+            deferred, self._deferred = self._deferred, None
+            self._store_ns(*deferred, self._snapshot_vars())
+        if self._writer:
+            self._writer.close()
+        return super().do_shutdown(restart)
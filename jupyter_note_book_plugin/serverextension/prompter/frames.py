@@ -0,0 +1,202 @@
+"""
+frames.py stores DataFrame snapshots column by column, so that they can be
+memory-mapped and read one column at a time.
+
+Each frame is a directory under FRAMES_DIR (next to cells.db) containing
+
+    schema.pkl : dill pickled header {"nrows" : number of rows,
+                                      "columns" : the frame's column Index,
+                                      "dtypes" : [str(dtype) per column],
+                                      "files" : [file name per column],
+                                      "index" : ("range", (start, stop, step)) or ("file", file name),
+                                      "attrs" : the frame's attrs dictionary}
+    c<i>.npy   : column i, when it has a plain numpy dtype. These are raw
+                 contiguous buffers that np.load maps instead of reading.
+    c<i>.pkl   : column i, dill pickled, for object and extension dtypes
+    index.pkl  : the index, unless it is a RangeIndex
+
+Frames are written to a temporary directory and renamed into place, so a
+reader never sees a partial frame. Tokens are content fingerprints when the
+frames belong to the ObjectStore.
+"""
+import os
+import shutil
+import uuid
+
+import dill
+import numpy as np
+import pandas as pd
+
+from .config import FRAMES_DIR
+
+SCHEMA_FILE = "schema.pkl"
+
+class FrameStore:
+    """directory of column-wise stored DataFrames, addressed by token"""
+
+    def __init__(self, dirname=FRAMES_DIR):
+        self.root = os.path.expanduser(dirname)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, token):
+        """return the directory holding the frame stored under token"""
+        return os.path.join(self.root, token)
+
+    def has(self, token):
+        """is there a frame stored under token?"""
+        return os.path.isfile(os.path.join(self.path(token), SCHEMA_FILE))
+
+    def touch(self, token):
+        """mark the frame under token as just used, return False if it is not stored"""
+        try:
+            os.utime(os.path.join(self.path(token), SCHEMA_FILE))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def modified(self, token):
+        """time the frame under token was last written or touched, None if it is not stored"""
+        try:
+            return os.path.getmtime(os.path.join(self.path(token), SCHEMA_FILE))
+        except FileNotFoundError:
+            return None
+
+    def size(self, token):
+        """bytes on disk used by the frame stored under token"""
+        path = self.path(token)
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+    def write(self, df, token=None):
+        """store df, return the token it is stored under"""
+        if token is None:
+            token = uuid.uuid4().hex
+        tmp_path = os.path.join(self.root, ".tmp-" + uuid.uuid4().hex)
+        os.mkdir(tmp_path)
+
+        try:
+            files = []
+            for i in range(df.shape[1]):
+                files.append(_write_column(df.iloc[:, i], tmp_path, "c{0}".format(i)))
+
+            if isinstance(df.index, pd.RangeIndex):
+                index = ("range", (df.index.start, df.index.stop, df.index.step))
+            else:
+                with open(os.path.join(tmp_path, "index.pkl"), "wb") as f:
+                    dill.dump(df.index, f)
+                index = ("file", "index.pkl")
+
+            schema = {"nrows" : len(df),
+                      "columns" : df.columns,
+                      "dtypes" : [str(t) for t in df.dtypes],
+                      "files" : files,
+                      "index" : index,
+                      "attrs" : df.attrs}
+            with open(os.path.join(tmp_path, SCHEMA_FILE), "wb") as f:
+                dill.dump(schema, f)
+            os.rename(tmp_path, self.path(token))
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if self.has(token):
+                # the same contents were stored concurrently
+                return token
+            raise
+        return token
+
+    def read(self, token):
+        """return the StoredFrame under token"""
+        return StoredFrame(self.path(token))
+
+    def delete(self, token):
+        """remove the frame stored under token"""
+        shutil.rmtree(self.path(token), ignore_errors=True)
+
+class StoredFrame:
+    """
+    read access to a stored frame. Only the schema is read up front, columns
+    are read (or mapped) when asked for
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SCHEMA_FILE), "rb") as f:
+            self.schema = dill.load(f)
+        self._index = None
+
+    @property
+    def columns(self):
+        """the column labels of the frame"""
+        return self.schema["columns"]
+
+    @property
+    def dtypes(self):
+        """dictionary of column label -> dtype name"""
+        return dict(zip(self.columns, self.schema["dtypes"]))
+
+    @property
+    def attrs(self):
+        """the attrs dictionary of the frame"""
+        return self.schema.get("attrs", {})
+
+    def __len__(self):
+        return self.schema["nrows"]
+
+    def index(self):
+        """return the index of the frame"""
+        if self._index is None:
+            kind, value = self.schema["index"]
+            if kind == "range":
+                self._index = pd.RangeIndex(*value)
+            else:
+                with open(os.path.join(self.path, value), "rb") as f:
+                    self._index = dill.load(f)
+        return self._index
+
+    def _position(self, col):
+        loc = self.columns.get_loc(col)
+        if isinstance(loc, slice):
+            return loc.start
+        if isinstance(loc, np.ndarray): # duplicated label, take the first
+            return np.flatnonzero(loc)[0]
+        return loc
+
+    def _values(self, pos):
+        file_name = self.schema["files"][pos]
+        file_path = os.path.join(self.path, file_name)
+        if file_name.endswith(".npy"):
+            # copy on write mapping, so callers can modify what they get
+            mmap_mode = "c" if self.schema["nrows"] > 0 else None
+            values = np.load(file_path, mmap_mode=mmap_mode, allow_pickle=False)
+            # plain ndarray view over the mapping, so memmap does not leak into results
+            return values.view(np.ndarray)
+        with open(file_path, "rb") as f:
+            return dill.load(f)
+
+    def column(self, col):
+        """return the column labelled col as a Series"""
+        pos = self._position(col)
+        return pd.Series(self._values(pos), index=self.index(), name=col, copy=False)
+
+    def to_frame(self, columns=None):
+        """return the frame, or only the listed columns of it"""
+        if columns is None:
+            positions = list(range(len(self.columns)))
+        else:
+            positions = [self._position(c) for c in columns]
+
+        data = {i : self._values(pos) for i, pos in enumerate(positions)}
+        df = pd.DataFrame(data, index=self.index(), copy=False)
+        df.columns = self.columns[positions]
+        df.attrs = dict(self.attrs)
+        return df
+
+def _write_column(col, path, name):
+    """write the values of col, return the file name used"""
+    if isinstance(col.dtype, np.dtype) and col.dtype != object:
+        file_name = name + ".npy"
+        np.save(os.path.join(path, file_name), col.to_numpy(), allow_pickle=False)
+    else:
+        file_name = name + ".pkl"
+        with open(os.path.join(path, file_name), "wb") as f:
+            # the array keeps the dtype, .values drops eg. the timezone of datetimes
+            dill.dump(col.array, f)
+    return file_name
@@ -16,6 +16,7 @@ CREATE TABLE IF NOT EXISTS versions(
     time TIMESTAMP, 
     contents TEXT, 
     exec_ct INT, 
+    msg_id VARCHAR(64), -- of the execute request, the kernel stores its namespace snapshot under it
     PRIMARY KEY(id, version));
 
 CREATE TABLE IF NOT EXISTS data(
@@ -26,7 +27,11 @@ CREATE TABLE IF NOT EXISTS data(
     source VARCHAR(255), 
     name VARCHAR(160) binary NOT NULL, 
     exec_ct INT,
-    PRIMARY KEY(user, kernel, name, version));
+    msg_id VARCHAR(64),
+    schema_hash CHAR(40), -- fingerprint of the column names, types and sizes, for finding matching versions
+    object_ref VARCHAR(80), -- kind:hash of the dataframe in the object store, for loading the version directly
+    PRIMARY KEY(user, kernel, name, version),
+    INDEX data_schema (user, kernel, name, schema_hash));
 
 -- PEP says variables should be no more than 80 characters, but there's no actual limitation.
 
@@ -59,6 +64,11 @@ CREATE TABLE IF NOT EXISTS UsersContainers(
     container_started_at DATETIME,
     running BOOL); 
 
+-- the id of the last outbox row of each server that has been copied here, see outbox.py
+CREATE TABLE IF NOT EXISTS replicated(
+    source VARCHAR(64) PRIMARY KEY,
+    last_id BIGINT NOT NULL);
+
 CREATE TABLE IF NOT EXISTS userTracking(
     user VARCHAR(64) NOT NULL,
     type VARCHAR(255),
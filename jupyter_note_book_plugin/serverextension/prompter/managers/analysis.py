@@ -5,9 +5,8 @@ routing of code analyses and handles failures
 import sys
 import json
 
-import dill
-
-from ..storage import load_dfs
+from ..storage import load_dfs, load_ns
+from ..snapshots import ObjectSummary
 from ..analysis import AnalysisEnvironment
 from ..note_config import NOTES, CONTEXT
 from .note_manager import KernelNoteManager
@@ -24,6 +23,10 @@ class AnalysisManager:
         self.database_manager = database_manager
         self.analyses = {}
         self._nb = nbapp
+        # kernel id -> [(code, cell id, exec_ct)] of coalesced executions, analyzed
+        # with the snapshot stored at the end of their burst. they have no snapshot
+        # of their own, so their data versions are not linked to one
+        self._coalesced = {}
 
         self.note_manager = KernelNoteManager(database_manager.getDb(), nbapp.log, NOTES, CONTEXT)
 
@@ -48,7 +51,7 @@ class AnalysisManager:
         self._nb.log.info("[MANAGER] received non-execution request {0}".format(request))
         return
  
-    def handle_execution(self, request):
+    async def handle_execution(self, request):
         """
         handle a request (json object with "content", "id", and "kernel" fields)
         """
@@ -77,16 +80,56 @@ class AnalysisManager:
             self.analyses[kernel_id] = AnalysisEnvironment(self._nb, kernel_id, self.db())
         
         env = self.analyses[kernel_id]
-        self.db().add_entry(request) 
+        async_db = self.database_manager.getAsyncDb()
+        await async_db.add_entry(request)
+
+        # the kernel stores its namespace in the background, wait for the
+        # snapshot of this execution and analyze that one
+        msg_id = request.get("msg_id") # of the execute request, sent by frontends that know it
+        ns = None
+        coalesced = False
+        if request["exec_ct"] is not None:
+            ns = await async_db.wait_for_ns(request["exec_ct"], kernel_id, msg_id=msg_id)
+            if ns is None:
+                self._nb.log.warning("[MANAGER] no namespace stored for execution {0}, using most recent".format(request["exec_ct"]))
+            elif ns["namespace"] is None:
+                self._nb.log.info("[MANAGER] execution {0} was coalesced, analyzing it at the end of its burst".format(request["exec_ct"]))
+                self._coalesced.setdefault(kernel_id, []).append((code, cell_id, request["exec_ct"]))
+                return {"kernel_id" : kernel_id}
+            else:
+                # the snapshot stored in place of this execution's, its burst ended before the request came
+                coalesced = ns["msg_id"] != msg_id if msg_id else ns["exec_num"] != request["exec_ct"]
+
+        # the analysis reads and writes the database throughout
+        return await async_db.run(self._analyze, env, kernel_id, request, ns, cell_mode, coalesced)
+
+    def _analyze(self, env, kernel_id, request, ns, cell_mode, coalesced=False):
+        """
+        analyze an execution with its namespace ns and make the notes to send back.
+        a coalesced execution's versions are recorded without a snapshot link
+        """
+        # pylint: disable=too-many-arguments
+        cell_id = request["cell_id"]
+        code = request["contents"]
+        msg_id = None if coalesced else request.get("msg_id")
         try:
-            env.cell_exec(code, kernel_id, cell_id, request["exec_ct"])
+            if ns is not None:
+                for coalesced_code, coalesced_cell, coalesced_ct in self._coalesced.pop(kernel_id, []):
+                    env.cell_exec(coalesced_code, kernel_id, coalesced_cell, coalesced_ct, None, ns, coalesced=True)
+            env.cell_exec(code, kernel_id, cell_id, request["exec_ct"], msg_id, ns, coalesced=coalesced)
         except RuntimeError as e:
             self._nb.log.error("[MANAGER] Analysis environment encountered exception {0}, call back {1}".format(e, sys.exc_info()[0]))
 
-        ns = self.db().recent_ns()
-        dfs = load_dfs(ns)
-
-        non_dfs = dill.loads(ns["namespace"])
+        if ns is None:
+            ns = self.db().recent_ns(kernel_id)
+        if ns is None:
+            self._nb.log.warning("[MANAGER] no namespace stored for kernel {0}, no notes to make".format(kernel_id))
+            return {"kernel_id" : kernel_id}
+        # the notes count and compare whole objects, those over the snapshot
+        # budget were stored as a row sample or a summary and are left out
+        dfs = load_dfs(ns, cache=self.db().ns_cache).without_samples()
+        non_dfs = {name : var for name, var in load_ns(ns, cache=self.db().ns_cache).items()
+                   if not isinstance(var, ObjectSummary)}
         self.note_manager.update_notes(cell_id, kernel_id, env, dfs, non_dfs, cell_mode)
 
         response = self.note_manager.make_responses(kernel_id, cell_id, request["exec_ct"], cell_mode, dfs, non_dfs)
@@ -101,7 +144,8 @@ class AnalysisManager:
             return result
 
         formatted_result = {"col_name" : result["col_name"],
-                            "sensitivity" : result["sensitivity"]}
+                            "sensitivity" : result["sensitivity"],
+                            "sampled" : result["sampled"]}
         
         formatted_result["valueCounts"] = {}
         
@@ -2,27 +2,67 @@
 we need a global session manager which handles
 routing of code analyses and handles failures
 """
+import atexit
 import os
 
 import mysql.connector
 
-from ..storage import DbHandler, RemoteDbHandler, load_dfs
-from ..config import remote_config
+from tornado.ioloop import PeriodicCallback
+
+from ..storage import RemoteDbHandler, load_dfs
+from ..asyncdb import AsyncDbHandler
+from ..outbox import Outbox, Replicator
+from ..config import remote_config, WRITE_FLUSH_SECONDS, DB_DIR, OUTBOX_NAME, REMOTE_CONNECT_SECONDS
 
 
 class DatabaseManager:
     def __init__(self, nbapp):
-        try:
-            remote_config["nb_user"] = os.getenv("JP_PLUGIN_USER")
-            if not remote_config["nb_user"]: remote_config["nb_user"] = "DEFAULT_USER"
-            nbapp.log.debug("[MANAGER] user is {0}".format(remote_config["nb_user"]))
-            self.db = RemoteDbHandler(**remote_config)
-            nbapp.log.debug("[MANAGER] db local cursor: {0}".format(self.db._local_cursor))
-        except mysql.connector.Error as e:
-            nbapp.log.warning("[MANAGER] Unable to connect to remote db, creating local backup. Error {0}".format(e))
-            self.db = DbHandler()
+        # writes land in the outbox first, the replicator copies them to the
+        # remote database whenever it can be reached
+        db_dir = os.path.expanduser(DB_DIR)
+        os.makedirs(db_dir, exist_ok=True)
+        self.outbox = Outbox(db_dir + OUTBOX_NAME)
+        remote_config["nb_user"] = os.getenv("JP_PLUGIN_USER")
+        if not remote_config["nb_user"]: remote_config["nb_user"] = "DEFAULT_USER"
+        nbapp.log.debug("[MANAGER] user is {0}".format(remote_config["nb_user"]))
+        # connects on the database threads, starts without the remote db too
+        self.db = RemoteDbHandler(**remote_config, outbox=self.outbox)
+        nbapp.log.debug("[MANAGER] db local cursor: {0}".format(self.db._local_cursor))
         self._nb = nbapp
+        # reads go to the remote db while the replicator can reach it
+        self.replicator = Replicator(self.outbox, connect_remote, log=nbapp.log, report=self.db.remote_reached)
+        self.replicator.start()
+        nbapp.log.info("[MANAGER] {0} writes waiting to be copied to the remote db".format(len(self.outbox)))
+        held = self.outbox.held()
+        if held:
+            nbapp.log.warning("[MANAGER] {0} writes the remote db rejected are held in the outbox".format(len(held)))
         self.db.addTrack("START", "Started up database tracking")
+        # once the server is up the handler is only used from the database threads
+        self.async_db = AsyncDbHandler(self.db)
+
+        # buffered note responses and tracking events are written in batches,
+        # at the latest every WRITE_FLUSH_SECONDS and when the server exits
+        self._flush_callback = PeriodicCallback(self.flush, WRITE_FLUSH_SECONDS * 1000)
+        self._flush_callback.start()
+        # by the time atexit runs, the database thread has finished its calls.
+        # functions registered later run first, so the buffered rows are queued
+        # before the replicator makes its last attempt
+        atexit.register(self.replicator.stop)
+        atexit.register(self.db.flush_writes)
+
+    async def flush(self):
+        """write the rows the database handler has buffered"""
+        if not await self.async_db.flush_writes():
+            self._nb.log.warning("[MANAGER] could not write buffered rows, keeping them for the next flush")
 
     def getDb(self):
-        return self.db
\ No newline at end of file
+        return self.db
+
+    def getAsyncDb(self):
+        return self.async_db
+
+def connect_remote():
+    """a new connection to the remote database, for the replicator"""
+    return mysql.connector.connect(host=remote_config["host"], user=remote_config["db_user"],
+                                   password=remote_config["password"], database=remote_config["database"],
+                                   connection_timeout=REMOTE_CONNECT_SECONDS)
\ No newline at end of file
@@ -5,12 +5,19 @@ The actual information flow is
 (init.py) post ==> RequestManager.handle_request ==> one of the routing codes
 
 Then, the result from the function called by the route functions is returned
-back to the original "post" function to respond to the frontend
+back to the original "post" function to respond to the frontend. Route
+functions that are coroutines await their database calls themselves, the
+others run on a database thread, so post awaits them without blocking the
+IOLoop. The requests of a kernel are handled one at a time, in the order
+they arrived, those of different kernels at the same time
 """
+import asyncio
+
 class RequestManager:
-    def __init__(self, analysis_manager, tracking_manager):
+    def __init__(self, analysis_manager, tracking_manager, database_manager):
         self.analysis_manager = analysis_manager
         self.tracking_manager = tracking_manager
+        self.database_manager = database_manager
         self.routeCodes = {
             # format:
             # [request type (str)] : [function which takes a JSON obj. parameter]
@@ -18,7 +25,15 @@ class RequestManager:
             "tracking": tracking_manager.handle_track_request,
             "user_input": analysis_manager.handle_user_input
         }
+        self._kernel_locks = {} # kernel id -> asyncio.Lock
 
-    def handle_request(self, request):
+    async def handle_request(self, request):
         # given a request type, will execute the corresponding function
-        return self.routeCodes[request["type"]](request)
+        route = self.routeCodes[request["type"]]
+        kernel_id = request.get("kernel")
+        if kernel_id not in self._kernel_locks:
+            self._kernel_locks[kernel_id] = asyncio.Lock()
+        async with self._kernel_locks[kernel_id]:
+            if asyncio.iscoroutinefunction(route):
+                return await route(request)
+            return await self.database_manager.getAsyncDb().run(route, request)
@@ -0,0 +1,59 @@
+"""
+the retention manager periodically removes old namespace snapshots from the
+local database, without blocking request handling
+"""
+import os
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+
+from tornado.ioloop import PeriodicCallback
+
+from ..config import DB_DIR, DB_NAME, RETENTION_INTERVAL
+from ..retention import SnapshotCompactor
+
+class RetentionManager:
+    """
+    runs a SnapshotCompactor every RETENTION_INTERVAL seconds. The snapshots
+    that data versions refer to are read on the database thread, the compaction
+    itself runs on a worker thread with its own connection
+    """
+    def __init__(self, nbapp, database_manager, interval=RETENTION_INTERVAL):
+        self._nb = nbapp
+        self.database_manager = database_manager
+        self.compactor = SnapshotCompactor(os.path.expanduser(DB_DIR) + DB_NAME, log=nbapp.log)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retention")
+        self._future = None
+        self._callback = None
+        if interval > 0:
+            self._callback = PeriodicCallback(self.run, interval * 1000)
+            self._callback.start()
+
+    async def run(self):
+        """start a compaction, unless one is still running"""
+        if self._future is not None and not self._future.done():
+            return
+        try:
+            links = await self.database_manager.getAsyncDb().data_snapshots()
+        except (sqlite3.Error, mysql.connector.Error) as e:
+            self._nb.log.warning("[MANAGER] could not read data versions, skipping retention: {0}".format(e))
+            return
+        if links is None:
+            self._nb.log.info("[MANAGER] the remote db has not been read yet, skipping retention")
+            return
+        self._future = self._executor.submit(self.compactor.run_once, **links)
+        self._future.add_done_callback(self._done)
+
+    def _done(self, future):
+        error = future.exception()
+        if error is not None:
+            self._nb.log.error("[MANAGER] snapshot retention failed: {0}".format(error))
+
+    def stop(self):
+        """stop scheduling compactions"""
+        if self._callback is not None:
+            self._callback.stop()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,43 @@
+-- brings the tables of a study database made by an earlier make_tables.sql up to date.
+-- each change is only made if information_schema shows it is missing, so it can be run again
+-- run it as a user that can alter the tables, the server's user cannot
+
+SET @migrate = (SELECT IF(COUNT(*) = 0, 'ALTER TABLE versions ADD COLUMN msg_id VARCHAR(64)', 'DO 0')
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'versions' AND COLUMN_NAME = 'msg_id');
+PREPARE migrate FROM @migrate;
+EXECUTE migrate;
+DEALLOCATE PREPARE migrate;
+
+SET @migrate = (SELECT IF(COUNT(*) = 0, 'ALTER TABLE data ADD COLUMN msg_id VARCHAR(64)', 'DO 0')
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND COLUMN_NAME = 'msg_id');
+PREPARE migrate FROM @migrate;
+EXECUTE migrate;
+DEALLOCATE PREPARE migrate;
+
+SET @migrate = (SELECT IF(COUNT(*) = 0, 'ALTER TABLE data ADD COLUMN schema_hash CHAR(40)', 'DO 0')
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND COLUMN_NAME = 'schema_hash');
+PREPARE migrate FROM @migrate;
+EXECUTE migrate;
+DEALLOCATE PREPARE migrate;
+
+SET @migrate = (SELECT IF(COUNT(*) = 0, 'ALTER TABLE data ADD COLUMN object_ref VARCHAR(80)', 'DO 0')
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND COLUMN_NAME = 'object_ref');
+PREPARE migrate FROM @migrate;
+EXECUTE migrate;
+DEALLOCATE PREPARE migrate;
+
+SET @migrate = (SELECT IF(COUNT(*) = 0, 'ALTER TABLE data ADD INDEX data_schema (user, kernel, name, schema_hash)', 'DO 0')
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'data' AND INDEX_NAME = 'data_schema');
+PREPARE migrate FROM @migrate;
+EXECUTE migrate;
+DEALLOCATE PREPARE migrate;
+
+-- the id of the last outbox row of each server that has been copied here, see outbox.py
+CREATE TABLE IF NOT EXISTS replicated(
+    source VARCHAR(64) PRIMARY KEY,
+    last_id BIGINT NOT NULL);
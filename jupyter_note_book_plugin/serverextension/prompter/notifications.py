@@ -18,7 +18,6 @@ from ast import literal_eval
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 import numpy as np
-import dill
 import json
 
 from scipy.stats import f_oneway, chi2_contingency, spearmanr, chisquare
@@ -28,7 +27,7 @@ from sklearn.base import ClassifierMixin
 from .string_compare import check_for_protected, guess_protected, set_env
 from .sortilege import is_categorical
 from .slice_finder import err_slices
-from .storage import clean_json, clean_list, NpEncoder
+from .storage import clean_json, clean_list, NpEncoder, load_ns
 
 PVAL_CUTOFF = 0.25 # cutoff for thinking that column is a proxy for a sensitive column
 
@@ -242,17 +241,12 @@ class ProtectedColumnNote(Notification):
                             resp["columns"][col_name] = old_col_info
         """
         return resp
-    def _make_col_info(self, df):
+    def _make_col_info(self, env, df_name, dfs):
         """
         return a dictionary mapping column names to type and size
         """
-        col_info = {}
-
-        for col in df.columns:
-            col_info[col] = {}
-            col_info[col]["size"] = len(df[col])
-            col_info[col]["type"] = str(df[col].dtypes)
-        return col_info
+        # pylint: disable=no-self-use
+        return env.col_info(df_name, dfs)
     def update(self, env, kernel_id, cell_id, dfs, ns):
         # pylint: disable=too-many-arguments
 
@@ -304,7 +298,7 @@ class ProtectedColumnNote(Notification):
             protected_cols = guess_protected(dfs[df_name])
             self.df_protected_cols[df_name] = protected_cols
 
-            col_data = self._make_col_info(dfs[df_name]) 
+            col_data = self._make_col_info(env, df_name, dfs)
             df_version = self.db.get_data_version(df_name, col_data, env._kernel_id) 
 
             if not df_version:
@@ -628,9 +622,16 @@ class MissingDataNote(ProtectedColumnNote):
             if df_name not in dfs:
                 continue
 
-            filtered_entry = [col for col in df_names[df_name] if col["col_name"] in dfs[df_name].columns]
+            profile = env.profiles.get(df_name)
+            if profile is not None:
+                # the kernel counted missing values when it stored the frame
+                columns = profile["columns"]
+                has_missing = any(c["nulls"] > 0 for c in columns.values())
+            else:
+                columns = dfs[df_name].columns
+                has_missing = dfs[df_name].isna().any().any()
+            filtered_entry = [col for col in df_names[df_name] if col["col_name"] in columns]
 
-            has_missing = dfs[df_name].isna().any().any()
             has_sensitive = any([col["is_sensitive"] for col in filtered_entry])
 
             if has_missing and has_sensitive: 
@@ -788,7 +789,7 @@ class ModelReportNote(Notification):
     def check_feasible(self, cell_id, env, dfs, ns):
         
         if "namespace" in ns:
-            non_dfs_ns = dill.loads(ns["namespace"])
+            non_dfs_ns = load_ns(ns)
         else:
             non_dfs_ns = ns
 
@@ -824,7 +825,7 @@ class ModelReportNote(Notification):
         """
         Find ancestor of df_name with sensitive columns
         """
-        col_info = ProtectedColumnNote._make_col_info(self, dfs[df_name])
+        col_info = ProtectedColumnNote._make_col_info(self, env, df_name, dfs)
         df_version = self.db.get_data_version(df_name, col_info, kernel_id)
         
         q = [(df_name, df_version)]
@@ -1211,8 +1212,10 @@ class ModelReportNote(Notification):
         If model is still defined, recalculate ModelReport correction for grp
         """
         # pylint: disable=too-many-locals,too-many-arguments
-        ns = self.db.recent_ns()
-        non_dfs_ns = dill.loads(ns["namespace"])
+        ns = self.db.recent_ns(kernel_id)
+        if ns is None:
+            return # nothing stored for the kernel to check the models against
+        non_dfs_ns = load_ns(ns, cache=self.db.ns_cache)
 
         def check_if_defined(resp):
 
@@ -1446,7 +1449,7 @@ class UncertaintyNote(Notification):
     def check_feasible(self, cell_id, env, dfs, ns):
         # if there exists a model (prob similar to modelrepnote)
         if "namespace" in ns:
-            non_dfs_ns = dill.loads(ns["namespae"])
+            non_dfs_ns = load_ns(ns)
         else:
             non_dfs_ns = ns
 
@@ -1990,8 +1993,10 @@ class UncertaintyNote(Notification):
             self.uncertainty(env, model_name, mode="make_response")
     
     def update(self, env, kernel_id, cell_id, dfs, ns):
-        ns = self.db.recent_ns()
-        non_dfs_ns = dill.loads(ns["namespace"])
+        ns = self.db.recent_ns(kernel_id)
+        if ns is None:
+            return # nothing stored for the kernel to check the models against
+        non_dfs_ns = load_ns(ns, cache=self.db.ns_cache)
 
         def check_if_defined(resp):
 
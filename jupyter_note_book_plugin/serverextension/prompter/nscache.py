@@ -0,0 +1,87 @@
+"""
+nscache.py keeps decoded namespace snapshots in memory, so the components
+that look at the namespace of one execution decode it once between them.
+
+Stored namespace dictionaries are cached under the msg_id of their row and
+the variables they reference under the object store reference, which is a
+content fingerprint, so a dataframe that did not change between executions
+is loaded once for all the snapshots that share it. Neither changes once
+stored, so entries never go stale and are only evicted, least recently used
+first, to keep the total under a byte budget.
+
+Cached objects are shared by everyone who asks for them, and must be
+treated as read-only.
+"""
+from collections import OrderedDict
+import sys
+import threading
+
+import pandas as pd
+
+from .config import NS_CACHE_BYTES
+
+class NamespaceCache:
+    """least recently used cache of decoded snapshots, bounded by bytes"""
+
+    def __init__(self, max_bytes=NS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (value, bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key, load, size=None):
+        """
+        return the value cached under key, or load() and cache it. size is its
+        cost in bytes, or a function of the loaded value that returns it
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        # loaded outside the lock, two threads asking at once may both load it
+        value = load()
+        nbytes = size(value) if callable(size) else size
+        if nbytes is None:
+            nbytes = object_bytes(value)
+        if nbytes > self.max_bytes:
+            return value # would evict everything else
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+        return value
+
+    def peek(self, key):
+        """return the value cached under key without loading it, None if there is none"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def clear(self):
+        """drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+def object_bytes(obj):
+    """approximate in memory size of a loaded variable"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    nbytes = getattr(obj, "nbytes", None) # numpy arrays
+    if isinstance(nbytes, int):
+        return nbytes
+    return sys.getsizeof(obj)
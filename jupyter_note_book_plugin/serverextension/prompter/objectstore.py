@@ -0,0 +1,211 @@
+"""
+objectstore.py is a content addressed store for the objects referenced by
+namespace manifests. Each object is stored once, under a hash of its
+contents, no matter how many snapshots refer to it.
+
+Objects are referenced by (kind, hash) tuples
+
+    ("pickle", hash) : dill pickle in OBJECTS_DIR/<first two hex digits>/<hash>.pkl,
+                       hash is the sha1 of the pickle
+    ("pickle5", hash) : protocol 5 pickle whose large buffers, eg. numpy arrays,
+                        were kept out of band, in OBJECTS_DIR/<hh>/<hash>.pk5.
+                        hash is the sha1 of the pickle and then each buffer
+    ("frame", hash)  : DataFrame stored column-wise by FrameStore under
+                       FRAMES_DIR/<hash>, hash is the content fingerprint
+                       of the frame
+
+A .pk5 file is laid out as
+
+    [pickle][buffer 0][buffer 1]...[header][8 byte little endian header length]
+
+with each section aligned to ALIGNMENT bytes, and the header a JSON list of
+the (offset, length) of the pickle and then each buffer. Buffers are written
+straight from the memory of the objects they belong to, and loaded as views
+over a copy on write mapping of the file, so neither direction copies them.
+Python before 3.8 has no protocol 5, objects are pickled in band there.
+
+Snapshots written before the object store hold the pickles (bytes) of their
+DataFrames in place of references, load handles those too.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import sys
+import uuid
+
+import dill
+import numpy as np
+
+from .config import OBJECTS_DIR, FRAMES_DIR
+from .frames import FrameStore
+
+PICKLE = "pickle"
+PICKLE5 = "pickle5"
+FRAME = "frame"
+
+OUT_OF_BAND = sys.version_info >= (3, 8)
+OUT_OF_BAND_MIN_BYTES = 1 << 16 # smaller buffers stay in the pickle
+ALIGNMENT = 64
+
+class _BufferPickler(dill.Pickler):
+    """
+    dill pickler that leaves numpy arrays to their own reducer, which hands
+    their memory to buffer_callback under protocol 5. dill's reducer for
+    arrays always pickles their contents in band
+    """
+    dispatch = {t : f for t, f in dill.Pickler.dispatch.items() if t is not np.ndarray}
+
+class ObjectStore:
+    """content addressed store of pickles and column-wise frames"""
+
+    def __init__(self, dirname=OBJECTS_DIR, frames_dir=FRAMES_DIR):
+        self.root = os.path.expanduser(dirname)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        self.frames = FrameStore(frames_dir)
+
+    def _pickle_path(self, digest, kind=PICKLE):
+        ext = ".pk5" if kind == PICKLE5 else ".pkl"
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def has(self, ref):
+        """is the object referenced by ref stored?"""
+        kind, digest = ref
+        if kind == FRAME:
+            return self.frames.has(digest)
+        return os.path.isfile(self._pickle_path(digest, kind))
+
+    def touch(self, ref):
+        """
+        mark the object referenced by ref as just used, so that it is not
+        collected while a new snapshot refers to it. return False if it is not stored
+        """
+        kind, digest = ref
+        if kind == FRAME:
+            return self.frames.touch(digest)
+        try:
+            os.utime(self._pickle_path(digest, kind))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def modified(self, ref):
+        """time the object was last stored or touched, None if it is not stored"""
+        kind, digest = ref
+        if kind == FRAME:
+            return self.frames.modified(digest)
+        try:
+            return os.path.getmtime(self._pickle_path(digest, kind))
+        except FileNotFoundError:
+            return None
+
+    def pickle(self, obj):
+        """
+        pickle obj, keeping large buffers out of band. return the reference
+        it is stored under, the pickle, and the buffers
+        """
+        # pylint: disable=no-self-use
+        buffers = []
+        def out_of_band(buf):
+            if buf.raw().nbytes < OUT_OF_BAND_MIN_BYTES:
+                return True # pickled in band
+            buffers.append(buf)
+            return False
+
+        if OUT_OF_BAND:
+            f = io.BytesIO()
+            _BufferPickler(f, protocol=5, buffer_callback=out_of_band).dump(obj)
+            data = f.getvalue()
+        else:
+            data = dill.dumps(obj)
+
+        hasher = hashlib.sha1(data)
+        for buf in buffers:
+            hasher.update(buf.raw())
+        return (PICKLE5 if buffers else PICKLE, hasher.hexdigest()), data, buffers
+
+    def put_pickle(self, ref, data, buffers=()):
+        """store a pickle made by pickle under ref, return its size in bytes"""
+        kind, digest = ref
+        path = self._pickle_path(digest, kind)
+
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp-" + uuid.uuid4().hex
+            with open(tmp_path, "wb") as f:
+                if kind == PICKLE5:
+                    _write_sections(f, [memoryview(data)] + [buf.raw() for buf in buffers])
+                else:
+                    f.write(data)
+            os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def put_frame(self, df, digest):
+        """store df under its content fingerprint digest, return the reference to it"""
+        if not self.frames.has(digest):
+            self.frames.write(df, token=digest)
+        return (FRAME, digest)
+
+    def size(self, ref):
+        """bytes on disk used by the object referenced by ref"""
+        kind, digest = ref
+        if kind == FRAME:
+            return self.frames.size(digest)
+        return os.path.getsize(self._pickle_path(digest, kind))
+
+    def delete(self, ref):
+        """remove the object referenced by ref"""
+        kind, digest = ref
+        if kind == FRAME:
+            self.frames.delete(digest)
+        elif os.path.isfile(self._pickle_path(digest, kind)):
+            os.remove(self._pickle_path(digest, kind))
+
+    def frame(self, stored):
+        """
+        return the StoredFrame for a stored dataframe, None if it was not
+        stored column-wise
+        """
+        if isinstance(stored, tuple) and stored[0] == FRAME:
+            return self.frames.read(stored[1])
+        return None
+
+    def load(self, stored):
+        """load the object for a manifest entry"""
+        if isinstance(stored, bytes):
+            return dill.loads(stored)
+        frame = self.frame(stored)
+        if frame is not None:
+            return frame.to_frame()
+        kind, digest = stored
+        if kind == PICKLE5:
+            return _load_sections(self._pickle_path(digest, kind))
+        with open(self._pickle_path(digest), "rb") as f:
+            return dill.load(f)
+
+def _write_sections(f, sections):
+    """write the sections of a .pk5 file, each from the memory it is in"""
+    offset = 0
+    header = []
+    for section in sections:
+        padding = -offset % ALIGNMENT
+        f.write(b"\0" * padding)
+        offset += padding
+        f.write(section)
+        header.append((offset, section.nbytes))
+        offset += section.nbytes
+    header = json.dumps(header).encode()
+    f.write(header)
+    f.write(len(header).to_bytes(8, "little"))
+
+def _load_sections(path):
+    """load a .pk5 file, its buffers are views over a copy on write mapping of it"""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mapped)
+    header_len = int.from_bytes(view[-8:], "little")
+    header = json.loads(bytes(view[-8 - header_len:-8]))
+    sections = [view[offset:offset + length] for offset, length in header]
+    return dill.loads(sections[0], buffers=sections[1:])
@@ -0,0 +1,332 @@
+"""
+outbox.py keeps the writes meant for the study database in a local sqlite
+file until they have been copied to it, so requests never wait on the remote
+database, and nothing written while it is unreachable is lost.
+
+DbHandler queues (cmd name, [params]) batches in an Outbox in place of running
+them. A Replicator copies the queued rows to the remote database on a thread
+of its own, a batch at a time and in the order they were queued. The remote
+replicated table, made by make_tables.sql, holds the id of the last row each
+outbox has had copied, and is updated in the same transaction as the rows. A
+batch that was committed there but not yet removed from the outbox, eg.
+because the server exited in between, is skipped when it is sent again.
+
+The Replicator is also what tells the database handler whether the remote
+database can be reached. It pings it when there is nothing to copy, and
+reports after every attempt, so reads on the request path go back to the
+remote database without trying it themselves.
+
+Cell versions numbered while the remote database was unreachable, or by a
+restarted kernel, may have been given numbers it already has, so they are
+numbered again on the way in, after the latest version of the cell id there,
+the key the versions table enforces. A batch with a row the remote database
+rejects, eg. a data version it has already, is copied again a row at a time.
+The rejected rows are logged and held in the outbox with the error, so they
+do not hold up the rows queued after them, and are not lost. held() lists
+them, they are not copied again until they are released.
+
+A statement the remote database cannot run at all, eg. because its tables
+were made by an earlier make_tables.sql and migrate_tables.sql has not been
+run on it, would fail for every row. The Replicator logs it and stops, the
+rows stay queued until the tables are brought up to date and the server
+restarted.
+"""
+import itertools
+import json
+import sqlite3
+import threading
+import uuid
+
+from mysql.connector import Error as MySQLError
+from mysql.connector.errors import IntegrityError, DataError, ProgrammingError
+
+from .config import WRITE_FLUSH_SECONDS, REPLICATE_BATCH_ROWS, REPLICATE_RETRY_SECONDS
+from .storage import SQL_CMDS, NpEncoder
+
+OUTBOX_CMDS = {
+  "MAKE_OUTBOX" : """CREATE TABLE IF NOT EXISTS outbox(id INTEGER PRIMARY KEY AUTOINCREMENT, cmd TEXT NOT NULL, params TEXT NOT NULL,
+                                                      error TEXT)""",
+  "MAKE_INDEX" : """CREATE INDEX IF NOT EXISTS outbox_cmd ON outbox(cmd, id)""",
+  "MAKE_SOURCE" : """CREATE TABLE IF NOT EXISTS outbox_source(source TEXT NOT NULL)""",
+  "GET_SOURCE" : """SELECT source FROM outbox_source""",
+  "SET_SOURCE" : """INSERT INTO outbox_source(source) VALUES (?)""",
+  "PUT" : """INSERT INTO outbox(cmd, params) VALUES (?, ?)""",
+  "PEEK" : """SELECT id, cmd, params FROM outbox WHERE error IS NULL ORDER BY id LIMIT ?""",
+  # held rows too, they are not in the remote database either
+  "PENDING" : """SELECT id, params FROM outbox WHERE cmd = ? ORDER BY id""",
+  "REMOVE" : """DELETE FROM outbox WHERE id <= ? AND error IS NULL""",
+  "COUNT" : """SELECT COUNT(*) FROM outbox WHERE error IS NULL""",
+  "HOLD" : """UPDATE outbox SET error = ? WHERE id = ?""",
+  "HELD" : """SELECT id, cmd, params, error FROM outbox WHERE error IS NOT NULL ORDER BY id""",
+  "RELEASE" : """UPDATE outbox SET error = NULL WHERE id = ?""",
+}
+
+def _remote(cmd):
+    return SQL_CMDS[cmd].replace("?", "%s")
+
+REPLICA_CMDS = { # run against the remote database, by the cmd name rows were queued under
+  "UPSERT_CELLS" : """INSERT INTO cells(id, contents, num_exec, last_exec, kernel, user, metadata) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                      ON DUPLICATE KEY UPDATE num_exec = num_exec + 1, contents = VALUES(contents), last_exec = VALUES(last_exec),
+                      kernel = VALUES(kernel), metadata = VALUES(metadata)""",
+  "INSERT_VERSIONS" : """INSERT INTO versions(user, kernel, id, version, time, contents, exec_ct, msg_id)
+                         SELECT %s, %s, %s, GREATEST(%s, COALESCE(MAX(version), 0) + 1), %s, %s, %s, %s
+                         FROM versions WHERE id = %s""",
+  "ADD_DATA" : _remote("ADD_DATA"),
+  "ADD_COLS" : _remote("ADD_COLS"),
+  "UPDATE_COL_TYPES" : _remote("UPDATE_COL_TYPES"),
+  "STORE_RESP" : _remote("STORE_RESP"),
+  "USER_TRACKING_AT" : _remote("USER_TRACKING_AT"),
+  "LAST_REPLICATED" : """SELECT last_id FROM replicated WHERE source = %s FOR UPDATE""",
+  "SET_REPLICATED" : """INSERT INTO replicated(source, last_id) VALUES (%s, %s) ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)""",
+}
+
+def _versions_params(params):
+    """the params of a queued version, followed by the cell id whose latest version it goes after"""
+    return params + (params[2],)
+
+REPLICA_PARAMS = { # the params of a REPLICA_CMDS statement, from those of a queued row
+  "INSERT_VERSIONS" : _versions_params,
+}
+
+REJECTED_ROW_ERRORS = (IntegrityError, DataError) # a row that would fail on every attempt
+# a statement that would fail for every row: unknown column, no such table
+SCHEMA_ERRNOS = (1054, 1146)
+
+class Outbox:
+    """
+    durable queue of rows waiting to be written to the remote database. rows are
+    kept as (id, cmd name, params), ids increase in the order rows were queued.
+    the rows of a cmd are read from the file once, when they are first asked for,
+    and kept in memory with those queued after, since reads on the request path
+    merge them in
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # queued to on the database thread, drained on the replicator thread
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(OUTBOX_CMDS["MAKE_OUTBOX"])
+        self._conn.execute(OUTBOX_CMDS["MAKE_INDEX"])
+        self._conn.execute(OUTBOX_CMDS["MAKE_SOURCE"])
+        row = self._conn.execute(OUTBOX_CMDS["GET_SOURCE"]).fetchone()
+        if row is None:
+            row = (uuid.uuid4().hex,)
+            self._conn.execute(OUTBOX_CMDS["SET_SOURCE"], row)
+        self._conn.commit()
+        self.source = row[0] # names this outbox in the replicated table
+        self._pending = {} # {cmd name : {id : params}} of the cmds pending() was asked for
+        self._held = {row[0] for row in self._conn.execute(OUTBOX_CMDS["HELD"])}
+
+    def put(self, batches):
+        """queue [(cmd name, [params])] in one transaction"""
+        rows = [(cmd, json.dumps(list(params), cls=NpEncoder)) for cmd, param_list in batches for params in param_list]
+        with self._lock:
+            cursor = self._conn.cursor()
+            ids = []
+            for row in rows:
+                cursor.execute(OUTBOX_CMDS["PUT"], row)
+                ids.append(cursor.lastrowid)
+            self._conn.commit()
+            for row_id, (cmd, params) in zip(ids, rows):
+                if cmd in self._pending:
+                    self._pending[cmd][row_id] = tuple(json.loads(params))
+
+    def peek(self, limit):
+        """the first limit rows, [(id, cmd name, params)]"""
+        with self._lock:
+            rows = self._conn.execute(OUTBOX_CMDS["PEEK"], (limit,)).fetchall()
+        return [(row_id, cmd, tuple(json.loads(params))) for row_id, cmd, params in rows]
+
+    def pending(self, cmd):
+        """the params of the rows of cmd still waiting, in the order they were queued"""
+        with self._lock:
+            if cmd not in self._pending:
+                rows = self._conn.execute(OUTBOX_CMDS["PENDING"], (cmd,)).fetchall()
+                self._pending[cmd] = {row_id : tuple(json.loads(params)) for row_id, params in rows}
+            return list(self._pending[cmd].values())
+
+    def remove(self, last_id):
+        """remove the rows up to and including last_id, once they have been copied. held rows are kept"""
+        with self._lock:
+            self._conn.execute(OUTBOX_CMDS["REMOVE"], (last_id,))
+            self._conn.commit()
+            for rows in self._pending.values():
+                copied = []
+                for row_id in rows:
+                    if row_id > last_id:
+                        break
+                    if row_id not in self._held:
+                        copied.append(row_id)
+                for row_id in copied:
+                    del rows[row_id]
+
+    def hold(self, errors):
+        """hold the rows of [(id, error)] back, they are not copied until they are released"""
+        with self._lock:
+            self._conn.executemany(OUTBOX_CMDS["HOLD"], [(error, row_id) for row_id, error in errors])
+            self._conn.commit()
+            self._held.update(row_id for row_id, _ in errors)
+
+    def held(self):
+        """the rows held back, [(id, cmd name, params, error)]"""
+        with self._lock:
+            rows = self._conn.execute(OUTBOX_CMDS["HELD"]).fetchall()
+        return [(row_id, cmd, tuple(json.loads(params)), error) for row_id, cmd, params, error in rows]
+
+    def release(self, row_id):
+        """copy a held row again, eg. once the rows it conflicted with have been dealt with"""
+        with self._lock:
+            self._conn.execute(OUTBOX_CMDS["RELEASE"], (row_id,))
+            self._conn.commit()
+            self._held.discard(row_id)
+
+    def __len__(self):
+        """the rows waiting to be copied, held rows are not counted"""
+        with self._lock:
+            return self._conn.execute(OUTBOX_CMDS["COUNT"]).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class Replicator:
+    """
+    copies the rows of an Outbox to the remote database in the background.
+    connect returns a new connection to the remote database, report is called
+    with whether it could be reached after each attempt. schema_error is the
+    error it stopped on if the remote tables cannot take the rows
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, outbox, connect, batch_rows=REPLICATE_BATCH_ROWS, interval=WRITE_FLUSH_SECONDS,
+                 retry=REPLICATE_RETRY_SECONDS, log=None, report=None):
+        self.outbox = outbox
+        self._connect = connect
+        self.report = report
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self.retry = retry
+        self.log = log
+        self._conn = None
+        self.schema_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    def _disconnect(self):
+        try:
+            self._conn.rollback()
+            self._conn.close()
+        except MySQLError:
+            pass # the connection is gone, nothing was committed
+        self._conn = None
+
+    def drain(self):
+        """
+        copy the next batch of rows. returns how many were copied, None if the
+        remote database could not be reached
+        """
+        rows = self.outbox.peek(self.batch_rows)
+        if not rows:
+            return 0 if self.ping() else None
+        try:
+            try:
+                self._copy(rows)
+            except REJECTED_ROW_ERRORS as e:
+                if self.log:
+                    self.log.warning("[REPLICATOR] a batch of {0} rows was rejected, {1}, copying it a row at a time"
+                                     .format(len(rows), e))
+                self._conn.rollback()
+                self._copy(rows, row_at_a_time=True)
+        except MySQLError as e:
+            if self._conn is not None:
+                self._disconnect()
+            if isinstance(e, ProgrammingError) and e.errno in SCHEMA_ERRNOS:
+                self.schema_error = e
+                if self.log:
+                    self.log.critical("[REPLICATOR] the remote db cannot take the queued rows, {0}. its tables are older "
+                                      "than this server, run migrate_tables.sql on it and restart. stopped copying, {1} "
+                                      "rows are kept in the outbox".format(e, len(self.outbox)))
+            elif self.log:
+                self.log.warning("[REPLICATOR] could not copy {0} queued rows, {1}".format(len(rows), e))
+            return None
+        self.outbox.remove(rows[-1][0])
+        return len(rows)
+
+    def ping(self):
+        """can the remote database be reached?"""
+        try:
+            self._connection().ping()
+        except MySQLError:
+            if self._conn is not None:
+                self._disconnect()
+            return False
+        return True
+
+    def _copy(self, rows, row_at_a_time=False):
+        """
+        copy rows in one transaction, skipping those copied before. a row at a
+        time, rows that are rejected are held in the outbox
+        """
+        conn = self._connection()
+        cursor = conn.cursor()
+        cursor.execute(REPLICA_CMDS["LAST_REPLICATED"], (self.outbox.source,))
+        result = cursor.fetchall()
+        last_copied = result[0][0] if result else 0
+        todo = [row for row in rows if row[0] > last_copied]
+        rejected = [] # (id, error)
+        for cmd, group in itertools.groupby(todo, key=lambda row: row[1]):
+            group = [(row_id, REPLICA_PARAMS.get(cmd, tuple)(params)) for row_id, _, params in group]
+            if not row_at_a_time:
+                cursor.executemany(REPLICA_CMDS[cmd], [params for _, params in group])
+                continue
+            for row_id, params in group:
+                try:
+                    cursor.execute(REPLICA_CMDS[cmd], params)
+                except REJECTED_ROW_ERRORS as e:
+                    rejected.append((row_id, str(e)))
+                    if self.log:
+                        self.log.error("[REPLICATOR] held back a {0} row the remote db rejected, {1}: {2}"
+                                       .format(cmd, e, params))
+        # before the commit, the rows are not removed with the batch if the server exits in between
+        self.outbox.hold(rejected)
+        cursor.execute(REPLICA_CMDS["SET_REPLICATED"], (self.outbox.source, max(last_copied, rows[-1][0])))
+        conn.commit()
+
+    def drain_all(self):
+        """copy batches until the outbox is empty, return whether the remote database was reachable"""
+        while self.schema_error is None:
+            copied = self.drain()
+            if copied is None:
+                return False
+            if copied < self.batch_rows:
+                return True
+        return False
+
+    def _run(self):
+        wait = 0 # the first attempt tells the handler whether the remote database is up
+        while not self._stop.wait(wait):
+            reachable = self.drain_all()
+            if self.schema_error is not None:
+                return # not an outage, copying again would not help
+            if self.report:
+                self.report(reachable)
+            wait = self.interval if reachable else self.retry
+
+    def start(self):
+        """copy queued rows every interval seconds, every retry seconds while the remote database is unreachable"""
+        self._thread = threading.Thread(target=self._run, name="replicator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop the background thread, then make a last attempt at copying what is queued"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.drain_all()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,100 @@
+"""
+profiles.py computes compact column profiles of DataFrames while the kernel
+has them in memory, so the server can make metadata-only decisions without
+loading the frames from a snapshot.
+
+A profile is a dictionary
+
+    "schema"  : schema_fingerprint of the frame
+    "nrows"   : number of rows
+    "sampled" : whether distinct counts and top values come from a row sample
+    "columns" : {column : {"dtype"    : str(dtype),
+                           "length"   : number of values,
+                           "nulls"    : number of missing values,
+                           "distinct" : approximate number of distinct non-null
+                                        values, None if they are unhashable,
+                           "top"      : [(value, count)] of the most common values}}
+
+Null counts are exact. Frames longer than the sample size have their top
+values counted in a row sample and scaled up, and their distinct values
+estimated from the k smallest hashes of the full column.
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+TOP_VALUES = 5
+SKETCH_SIZE = 1024 # hashes kept to estimate distinct counts
+
+def schema_fingerprint(df):
+    """hex digest of the column names and dtypes of df, in order"""
+    hasher = hashlib.sha1()
+    for col, dtype in df.dtypes.items():
+        hasher.update(repr((str(col), str(dtype))).encode())
+    return hasher.hexdigest()
+
+def columns_fingerprint(columns):
+    """
+    hex digest of {column : {"type", "size"}}, as data versions record their
+    columns. the same for the same names, types and sizes in any order
+    """
+    hasher = hashlib.sha1()
+    for col, info in sorted((str(col), info) for col, info in columns.items()):
+        size = info["size"] if info["size"] is None else int(info["size"])
+        hasher.update(repr((col, str(info["type"]), size)).encode())
+    return hasher.hexdigest()
+
+def profile_frame(df, sample_rows=100000):
+    """return the profile of df"""
+    sampled = len(df) > sample_rows
+    sample = df
+    if sampled:
+        rows = np.random.RandomState(0).randint(0, len(df), sample_rows)
+        sample = df.iloc[np.sort(rows)]
+
+    columns = {}
+    for i, col in enumerate(df.columns):
+        columns[col] = _profile_column(df.iloc[:, i], sample.iloc[:, i], sampled)
+    return {"schema" : schema_fingerprint(df),
+            "nrows" : len(df),
+            "sampled" : sampled,
+            "columns" : columns}
+
+def _profile_column(col, sample, sampled):
+    profile = {"dtype" : str(col.dtype),
+               "length" : len(col),
+               "nulls" : int(col.isna().sum()),
+               "distinct" : None,
+               "top" : []}
+    try:
+        counts = sample.value_counts(dropna=True)
+    except TypeError: # unhashable values, eg. lists
+        return profile
+
+    scale = len(col) / len(sample) if sampled and len(sample) else 1
+    profile["top"] = [(value, int(round(count * scale)))
+                      for value, count in zip(counts.index[:TOP_VALUES].tolist(), counts.iloc[:TOP_VALUES])]
+    profile["distinct"] = _approx_distinct(col, len(counts)) if sampled else len(counts)
+    return profile
+
+def _approx_distinct(col, seen):
+    """estimate the distinct non-null values of col, seen is the number in its sample"""
+    try:
+        hashes = pd.util.hash_pandas_object(col.dropna(), index=False).to_numpy()
+    except TypeError:
+        return seen
+    if len(hashes) <= SKETCH_SIZE:
+        return len(np.unique(hashes))
+
+    # k minimum values, the kth smallest distinct hash tells how densely distinct values fill the hash space
+    threshold = np.partition(hashes, SKETCH_SIZE)[SKETCH_SIZE]
+    smallest = np.unique(hashes[hashes <= threshold])
+    if len(smallest) < SKETCH_SIZE:
+        # repeated values crowd the smallest hashes, there are few enough that the sample saw them
+        return seen
+    return int((SKETCH_SIZE - 1) * 2.0**64 / (float(smallest[SKETCH_SIZE - 1]) + 1))
+
+def col_info(profile):
+    """return {column : {"size", "type"}}, as the notes describe data versions, from a profile"""
+    return {col : {"size" : c["length"], "type" : c["dtype"]} for col, c in profile["columns"].items()}
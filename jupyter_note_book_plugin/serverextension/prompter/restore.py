@@ -0,0 +1,99 @@
+"""
+restore.py puts a kernel back in the state of a stored namespace snapshot.
+
+Variables are bound to LazyVariable placeholders rather than loaded, so a
+restore takes as long as reading one namespaces row, however large the
+namespace. Before each cell runs, the variables its code reads are loaded
+and put in place of their placeholders, so the cell sees the real objects.
+Placeholders reached some other way, eg. through globals() or a function
+defined before the restore, load themselves when first used, including by an
+isinstance check. type() of such a variable is LazyVariable until it has been
+loaded, and %whos lists it as one. Modules are imported again by name.
+
+Variables that were over the snapshot budget were stored only as a summary,
+or a sample of their rows, see snapshots.py. They are not restored, the
+kernel keeps no binding for them, and their names are reported instead.
+
+A kernel can be restored from a cell with %restore_namespace <msg_id>, or
+started from a snapshot by setting RESTORE_SNAPSHOT to its msg_id.
+"""
+import ast
+import importlib
+import sqlite3
+
+import dill
+
+from .snapshots import DFS_KEY, OBJS_KEY, PROFILES_KEY, MODULES_KEY, REDUCED_KEY, LazyVariable
+from .storage import LOCAL_SQL_CMDS
+
+def load_manifest(conn, msg_id):
+    """
+    return the stored namespace dictionary of the snapshot under msg_id, or of
+    the snapshot stored in its place if it is the placeholder of a coalesced
+    execution. raises KeyError if there is none
+    """
+    curs = conn.cursor()
+    curs.row_factory = sqlite3.Row
+    row = curs.execute(LOCAL_SQL_CMDS["GET_NS"], (msg_id,)).fetchone()
+    if row is not None and row["namespace"] is None:
+        row = curs.execute(LOCAL_SQL_CMDS["SUPERSEDING_NS"], (row["kernel"], msg_id)).fetchone()
+    if row is None:
+        raise KeyError("no namespace stored for {0}".format(msg_id))
+    return dill.loads(row["namespace"])
+
+def bind(namespace, manifest, store):
+    """
+    bind the variables of a stored namespace dictionary in namespace. return
+    their names, and {name : reason} for the variables that were stored reduced
+    and so were not bound
+    """
+    names = []
+    reduced = manifest.get(REDUCED_KEY, {})
+    if OBJS_KEY not in manifest:
+        # stored before delta snapshots, objects are not pickled separately
+        for name, var in manifest.items():
+            if name != DFS_KEY:
+                namespace[name] = var
+                names.append(name)
+
+    profiles = manifest.get(PROFILES_KEY, {})
+    for key in (DFS_KEY, OBJS_KEY):
+        for name, ref in manifest.get(key, {}).items():
+            if name in reduced:
+                continue
+            namespace[name] = LazyVariable(namespace, name, key, ref, store, profiles.get(name))
+            names.append(name)
+
+    for name, module in manifest.get(MODULES_KEY, {}).items():
+        try:
+            namespace[name] = importlib.import_module(module)
+            names.append(name)
+        except ImportError:
+            pass # not installed in this environment
+    return names, reduced
+
+def referenced_names(code):
+    """return the names code reads, empty if it does not parse"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            names.add(node.target.id)
+    return names
+
+def load_referenced(namespace, code, log=None):
+    """load the placeholders for the variables code reads"""
+    for name in referenced_names(code):
+        var = namespace.get(name)
+        if isinstance(var, LazyVariable):
+            try:
+                var.load()
+            except Exception as e: # pylint: disable=broad-except
+                # left as a placeholder, the cell sees the error if it uses the variable
+                if log:
+                    log.warning("[FORKINGKERNEL] could not load {0} {1}".format(name, e))
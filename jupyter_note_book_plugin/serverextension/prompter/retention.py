@@ -0,0 +1,172 @@
+"""
+retention.py removes old namespace snapshots so that a long session does not
+fill the disk.
+
+A compaction run keeps the RETAIN_SNAPSHOTS most recent snapshots of each
+kernel, and every snapshot a data version links to, since get_dataframe_version
+loads those for ancestor lookups. Versions link to the msg_id of their
+snapshot, versions recorded before they stored it to their kernel and
+exec_num. The objects versions point at directly are kept as well.
+A kept placeholder of a coalesced execution keeps the snapshot stored in its
+place. The other rows are deleted together with their snapshot_vars
+telemetry, then the objects in the ObjectStore that no remaining snapshot
+refers to, then freed database pages are returned with an incremental
+vacuum. Databases made before retention are converted to incremental
+vacuuming with a full VACUUM, once.
+
+Objects touched less than grace seconds ago are not collected, the kernel
+touches the objects it reuses before the snapshot referring to them is written.
+"""
+import sqlite3
+import time
+
+import dill
+
+from .config import RETAIN_SNAPSHOTS
+from .objectstore import ObjectStore
+from .snapshots import DFS_KEY, OBJS_KEY
+from .storage import LOCAL_SQL_CMDS
+
+GRACE_SECONDS = 120
+
+class SnapshotCompactor:
+    """deletes snapshots outside the retention policy, and the objects only they referred to"""
+    # pylint: disable=too-many-arguments
+    def __init__(self, db_file, store=None, retain=RETAIN_SNAPSHOTS, grace=GRACE_SECONDS, log=None):
+        self.db_file = db_file
+        self.store = store if store is not None else ObjectStore()
+        self.retain = max(1, retain)
+        self.grace = grace
+        self.log = log
+        self.reclaimed = 0 # bytes reclaimed over all runs
+
+    def run_once(self, protected=(), msg_ids=(), object_refs=()):
+        """
+        apply the retention policy once, keeping the snapshots with (kernel,
+        exec_num) in protected or msg_id in msg_ids, and the objects in object_refs.
+        return {"rows" : snapshots deleted, "objects" : objects deleted,
+        "bytes" : bytes reclaimed}
+        """
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            keep, drop = self._partition(conn, set(protected), set(msg_ids))
+            kept_refs = set(object_refs)
+            for manifest in _manifests(conn, keep):
+                kept_refs.update(_object_refs(manifest))
+
+            # databases from before the telemetry table get it, and its msg_id index, here
+            conn.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+            conn.executemany("DELETE FROM namespaces WHERE msg_id = ?", [(m,) for m in drop])
+            conn.executemany("DELETE FROM snapshot_vars WHERE msg_id = ?", [(m,) for m in drop])
+            conn.commit()
+
+            num_objects, num_bytes = self._collect(conn, kept_refs)
+            num_bytes += self._vacuum(conn)
+        finally:
+            conn.close()
+
+        self.reclaimed += num_bytes
+        report = {"rows" : len(drop), "objects" : num_objects, "bytes" : num_bytes}
+        if self.log:
+            self.log.info("[RETENTION] removed {rows} snapshots and {objects} objects, reclaimed {bytes} bytes".format(**report))
+        return report
+
+    def _vacuum(self, conn):
+        """return free pages to the file system, return the bytes freed"""
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return _incremental_vacuum(conn)
+        # made before retention, switching to incremental vacuuming takes a full VACUUM
+        if self.log:
+            self.log.info("[RETENTION] converting {0} to incremental vacuuming".format(self.db_file))
+        try:
+            return _full_vacuum(conn)
+        except sqlite3.OperationalError as e:
+            # eg. the kernel was writing a snapshot, tried again on the next run
+            if self.log:
+                self.log.warning("[RETENTION] could not convert {0}: {1}".format(self.db_file, e))
+            return 0
+
+    def _partition(self, conn, protected, msg_ids=frozenset()):
+        """split the msg_ids of the stored snapshots into those to keep and those to delete"""
+        rows = conn.execute("""SELECT msg_id, kernel, exec_num, namespace IS NULL
+                               FROM namespaces ORDER BY time DESC""").fetchall()
+        keep = set()
+        per_kernel = {}
+        protected_exec = set(exec_num for _, exec_num in protected)
+        superseding = {} # kernel -> msg_id of the oldest snapshot newer than the current row
+        for msg_id, kernel, exec_num, placeholder in rows:
+            if not placeholder: # placeholders of coalesced executions do not count
+                per_kernel[kernel] = per_kernel.get(kernel, 0) + 1
+            if per_kernel.get(kernel, 0) <= self.retain or msg_id in msg_ids or (kernel, exec_num) in protected:
+                keep.add(msg_id)
+            elif kernel is None and exec_num in protected_exec:
+                # snapshots from before namespaces were keyed by kernel
+                keep.add(msg_id)
+
+            if not placeholder:
+                superseding[kernel] = msg_id
+            elif msg_id in keep and kernel in superseding:
+                # the snapshot stored in place of a coalesced execution
+                keep.add(superseding[kernel])
+
+        return keep, [row[0] for row in rows if row[0] not in keep]
+
+    def _collect(self, conn, kept_refs):
+        """delete the unreferenced objects, return how many and their size"""
+        candidates = {(kind, digest) : size for digest, kind, size
+                      in conn.execute("SELECT hash, kind, size FROM objects")}
+
+        deleted = []
+        num_bytes = 0
+        now = time.time()
+        for ref, size in candidates.items():
+            if ref in kept_refs:
+                continue
+            modified = self.store.modified(ref)
+            if modified is not None:
+                if now - modified < self.grace:
+                    continue
+                self.store.delete(ref)
+                num_bytes += size or 0
+            deleted.append(ref)
+
+        conn.executemany("DELETE FROM objects WHERE kind = ? AND hash = ?", deleted)
+        conn.commit()
+        return len(deleted), num_bytes
+
+def _manifests(conn, msg_ids):
+    """yield the stored namespace dictionaries of msg_ids"""
+    for msg_id in msg_ids:
+        row = conn.execute("SELECT namespace FROM namespaces WHERE msg_id = ?", (msg_id,)).fetchone()
+        if row is None or row[0] is None:
+            continue
+        try:
+            manifest = dill.loads(row[0])
+        except Exception: # pylint: disable=broad-except
+            # very old snapshots hold objects that may no longer unpickle, they hold no references
+            continue
+        yield manifest
+
+def _object_refs(manifest):
+    """yield the ObjectStore references in a stored namespace dictionary"""
+    for key in (DFS_KEY, OBJS_KEY):
+        for stored in manifest.get(key, {}).values():
+            if isinstance(stored, tuple):
+                yield stored
+
+def _full_vacuum(conn):
+    """switch conn to incremental vacuuming and rebuild it, return the bytes freed"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute(LOCAL_SQL_CMDS["INCREMENTAL_VACUUM"])
+    conn.execute("VACUUM")
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    return max(0, before - after) * page_size # the pointer map pages can make small databases grow
+
+def _incremental_vacuum(conn):
+    """return free pages to the file system, return the bytes freed"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute("PRAGMA incremental_vacuum").fetchall()
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    return (before - after) * page_size
@@ -0,0 +1,947 @@
+"""
+snapshots.py handles rendering a kernel namespace into the manifest stored
+in the namespaces table, and reading stored manifests back.
+
+A stored namespace is a dill pickled dictionary with reserved keys
+
+    _forking_kernel_dfs  : {df name : ObjectStore reference of the DataFrame}
+    _forking_kernel_objs : {var name : ObjectStore reference of the object}
+    _forking_kernel_profiles : {df name : column profile of the DataFrame}
+    _forking_kernel_modules : {alias : name of the module}
+
+so rows are small, and the objects themselves are stored once in the
+content addressed ObjectStore however many snapshots refer to them. The
+objects table records each stored object and its size. Profiles, see
+profiles.py, describe the full frames, even those stored reduced, and are
+missing from snapshots stored before them. Modules cannot be pickled, the
+manifest records which module each alias was bound to so a restore can
+import it again.
+
+Variables that did not change since the previous snapshot are not pickled
+again, the previous reference is reused. DataFrames, Series and arrays are
+compared by identity and a hash of their contents, numbers, strings, bytes
+and tuples of them by value. Other objects have no cheaper fingerprint than
+their pickle, so they are pickled on every snapshot, but as pickles are
+stored under their hash an unchanged one is not written again. Variables
+that cannot be pickled are left out, PicklabilityCache remembers them so they
+are not tried again on every execution.
+
+Objects larger than the per-object budget, or that would take a snapshot past
+its budget, are stored reduced, and the encoder lists them in summarized. The
+manifest lists them under REDUCED_KEY, {name : reason}, so a restore can leave
+them out without loading them.
+DataFrames are replaced by a sample of their rows, stored under DFS_KEY like
+any frame, with df.attrs[SAMPLE_ATTR] holding the summary of the full frame.
+Other objects, and frames too wide for even a small sample, are replaced by
+an ObjectSummary under OBJS_KEY. An ObjectSummary is a dictionary with
+
+    "type"   : module and qualified name of the type of the object
+    "size"   : estimated size of the object in bytes
+    "hash"   : hex digest of its contents, None if there was no cheap one
+    "reason" : why it was summarized
+    "shape"  : shape, for frames, series and arrays
+    "dtypes" : {column : dtype name} for frames, dtype name for series and arrays
+    "stats"  : for frames {column : {"count", "mean", "min", "max"}}, the latter
+               three for numeric columns only. the same dictionary for numeric
+               series and arrays
+
+Notes can test isinstance(obj, ObjectSummary) and is_sample(df) to tell they
+are not looking at the full object. Objects with no cheap size estimate are
+measured by pickling them. One found over the object budget is remembered, and
+summarized without being pickled again for as long as the same object is bound.
+
+After each encode, telemetry lists (name, type, size, seconds, status) for every
+variable, status one of STORED, UNCHANGED, SUMMARIZED or SKIPPED. size is the
+serialized size of what the manifest refers to, 0 for skipped variables, and
+seconds the time spent fingerprinting and serializing it. The writers record
+it in the snapshot_vars table next to the snapshot.
+
+Namespaces from before the ObjectStore hold the pickled bytes of each
+DataFrame under _forking_kernel_dfs, and the other variables unpickled at
+the top level.
+
+SnapshotWriter moves pickling and the database write off the kernel's
+execute path. The kernel hands it a shallow copy of the namespace and, before
+running the next cell, waits until that copy has been pickled, so the
+objects cannot change underneath the writer.
+
+ForkedSnapshotWriter instead forks the kernel after each execution. The child
+has a copy on write image of the namespace, encodes and writes it, and exits,
+so the kernel does not wait for pickling at all. Pages the next cells change
+are copied while a child runs. The child sends back what it stored over a
+pipe, and the parent's encoder takes that on before the next snapshot, so
+unchanged variables are still reused. One child runs at a time. A child
+inherits only the forking thread, and may deadlock on a lock another thread
+of the kernel held at the fork, so a child that has not reported back within
+child_timeout seconds is killed and its snapshot given up.
+"""
+import hashlib
+import io
+import os
+import queue
+import select
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import types
+import warnings
+import weakref
+
+import dill
+import numpy as np
+import pandas as pd
+
+from .objectstore import FRAME
+from .profiles import profile_frame
+
+DFS_KEY = "_forking_kernel_dfs"
+OBJS_KEY = "_forking_kernel_objs"
+PROFILES_KEY = "_forking_kernel_profiles"
+MODULES_KEY = "_forking_kernel_modules"
+REDUCED_KEY = "_forking_kernel_reduced"
+SAMPLE_ATTR = "forking_kernel_sample"
+
+# status of a variable in the telemetry of a snapshot
+STORED = "stored"
+UNCHANGED = "unchanged"
+SUMMARIZED = "summarized"
+SKIPPED = "skipped"
+
+class DeltaEncoder:
+    """
+    stores the variables of a snapshot in the ObjectStore and returns the
+    manifest for them. remembers what was stored for each variable, so that
+    variables whose identity and content have not changed are not pickled again
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, store, delta=True, columnar=True, log=None,
+                 object_budget=0, snapshot_budget=0, sample_rows=10000, profile=True, profile_rows=100000):
+        self.store = store
+        self.delta = delta
+        self.columnar = columnar # store DataFrames column-wise
+        self.log = log
+        self.profile = profile # add column profiles of DataFrames to the manifest
+        self.profile_rows = profile_rows
+        self.object_budget = object_budget # bytes, 0 for no limit
+        self.snapshot_budget = snapshot_budget # bytes of new objects, 0 for no limit
+        self.sample_rows = sample_rows
+        self._spent = 0
+        self.picklability = PicklabilityCache()
+        self._prev = {} # var name -> _StoredVar
+        self.new_objects = [] # (reference, size) of objects added by the last encode
+        self.skipped = {} # var name -> reason, for variables left out by the last encode
+        self.summarized = {} # var name -> reason, for variables stored reduced by the last encode
+        self.telemetry = [] # (name, type, size, seconds, status) of each variable of the last encode
+        self.pickled = {} # var name -> whether it pickled, for variables the last encode tried
+        self.oversized = {} # var name -> measured size, for variables the last encode measured over the object budget
+        self._oversized = {} # id -> (weakref or contents, type, size) of objects measured over the object budget
+
+    def encode(self, variables):
+        """store variables (name -> object), return their manifest"""
+        manifest = {DFS_KEY : {}, OBJS_KEY : {}, MODULES_KEY : {}, REDUCED_KEY : {}}
+        if self.profile:
+            manifest[PROFILES_KEY] = {}
+        curr = {}
+        self.new_objects = []
+        self.skipped = {}
+        self.summarized = {}
+        self.telemetry = []
+        self.pickled = {}
+        self.oversized = {}
+        self._spent = 0
+
+        for name, var in variables.items():
+
+            start = time.perf_counter()
+            if isinstance(var, LazyVariable):
+                if not var.loaded and self._reuse_lazy(manifest, name, var, start):
+                    continue
+                var = var.load(bind=False)
+            if isinstance(var, types.ModuleType):
+                manifest[MODULES_KEY][name] = var.__name__
+
+            is_df = isinstance(var, pd.DataFrame)
+            if not is_df:
+                reason = self.picklability.known_bad(var)
+                if reason:
+                    self.skipped[name] = reason
+                    self._record(name, var, 0, SKIPPED, start)
+                    continue
+            fingerprint = content_fingerprint(var)
+            prev = self._prev.get(name)
+
+            # reused objects are touched, so retention does not collect them
+            # before the snapshot that refers to them is written
+            if (self.delta and prev and prev.unchanged(var, is_df, fingerprint)
+                    and self.store.touch(prev.ref)):
+                key, ref, size, profile = prev.key, prev.ref, prev.size, prev.profile
+                reduced = prev.reduced
+                status = UNCHANGED
+            else:
+                stored = self._store(name, var, is_df, fingerprint)
+                if stored is None:
+                    self._record(name, var, 0, SKIPPED, start)
+                    continue
+                key, ref, size = stored
+                reduced = self.summarized.get(name)
+                if reduced:
+                    status = SUMMARIZED
+                elif prev and (prev.key, prev.ref) == (key, ref):
+                    status = UNCHANGED # pickled again, but the same pickle is stored already
+                else:
+                    status = STORED
+                profile = self._profile(name, var) if is_df else None
+
+            manifest[key][name] = ref
+            if profile is not None:
+                manifest[PROFILES_KEY][name] = profile
+            if reduced:
+                manifest[REDUCED_KEY][name] = reduced
+            curr[name] = _StoredVar(id(var), is_df, fingerprint, ref, key, size, profile, reduced)
+            self._record(name, var, size, status, start)
+        self._prev = curr
+
+        if self.log and self.skipped:
+            self.log.debug("[FORKINGKERNEL] could not pickle {0}".format(self.skipped))
+        if self.log and self.summarized:
+            self.log.debug("[FORKINGKERNEL] summarized {0}".format(self.summarized))
+        return manifest
+
+    def _store(self, name, var, is_df, fingerprint):
+        """
+        store var, reduced if it is over budget. return its manifest key,
+        reference and serialized size, None if it could not be stored
+        """
+        # pylint: disable=too-many-return-statements
+        size = estimate_size(var)
+        if size is None:
+            size = self._oversized_size(var) # not pickled again only to find it is still over budget
+        if size is not None and self._over_budget(size):
+            return self._store_reduced(name, var, is_df, fingerprint, size)
+
+        if is_df and self.columnar:
+            stored = self._put_frame(var, fingerprint)
+            if stored is None:
+                self.skipped[name] = "could not be written"
+                return None
+            return (DFS_KEY,) + stored
+
+        try:
+            ref, data, buffers = self.store.pickle(var)
+        except Exception as e: # pylint: disable=broad-except
+            # pickling fails with all sorts of errors, depending on the object
+            self.picklability.record(var, False)
+            self.pickled[name] = False
+            self.skipped[name] = repr(e)
+            return None
+        self.picklability.record(var, True)
+        self.pickled[name] = True
+
+        if size is None:
+            # no cheap estimate, the pickle is measured before it is written
+            size = len(data) + sum(buf.raw().nbytes for buf in buffers)
+            if self.object_budget and size > self.object_budget:
+                self._remember_oversized(var, size)
+                self.oversized[name] = size
+            if self._over_budget(size):
+                if fingerprint is None:
+                    fingerprint = bytes.fromhex(ref[1])
+                return self._store_reduced(name, var, is_df, fingerprint, size)
+        return (DFS_KEY if is_df else OBJS_KEY,) + self._put_pickle(ref, data, buffers)
+
+    def _remember_oversized(self, var, size):
+        """remember that var was measured at size, over the object budget"""
+        try:
+            check = weakref.ref(var)
+        except TypeError:
+            # eg. builtin containers, whose ids are reused once they are collected
+            check = _contents(var) if isinstance(var, CONTAINER_TYPES) else None
+        self._oversized[id(var)] = (check, type(var), size)
+
+    def _oversized_size(self, var):
+        """the size var was measured at if it was over the object budget, None if it was not"""
+        entry = self._oversized.get(id(var))
+        if entry is None:
+            return None
+        check, var_type, size = entry
+        if isinstance(check, weakref.ref):
+            same = check() is var
+        else:
+            same = type(var) is var_type and (check is None or check == _contents(var))
+        if not same:
+            del self._oversized[id(var)]
+            return None
+        return size
+
+    def _over_budget(self, size):
+        if self.object_budget and size > self.object_budget:
+            return True
+        return bool(self.snapshot_budget) and self._spent + size > self.snapshot_budget
+
+    def _allowance(self):
+        """bytes the next object may take"""
+        allowed = sys.maxsize
+        if self.object_budget:
+            allowed = self.object_budget
+        if self.snapshot_budget:
+            allowed = min(allowed, self.snapshot_budget - self._spent)
+        return allowed
+
+    def _store_reduced(self, name, var, is_df, fingerprint, size):
+        """store a row sample of a DataFrame, or a summary of any other object"""
+        # pylint: disable=too-many-arguments
+        if self.object_budget and size > self.object_budget:
+            reason = "over the object budget of {0} bytes".format(self.object_budget)
+        else:
+            reason = "over the snapshot budget of {0} bytes".format(self.snapshot_budget)
+        self.summarized[name] = reason
+        summary = summarize(var, size, fingerprint, reason)
+
+        if is_df and self.columnar and len(var) > 0:
+            row_bytes = max(1, size // len(var))
+            num_rows = min(self.sample_rows, len(var), self._allowance() // row_bytes)
+            if num_rows > 0:
+                rows = np.random.RandomState(0).choice(len(var), num_rows, replace=False)
+                sample = var.iloc[np.sort(rows)].copy()
+                sample.attrs[SAMPLE_ATTR] = summary
+                stored = self._put_frame(sample, content_fingerprint(sample))
+                if stored is not None:
+                    return (DFS_KEY,) + stored
+
+        ref, data, buffers = self.store.pickle(summary)
+        return (OBJS_KEY,) + self._put_pickle(ref, data, buffers)
+
+    def _put_frame(self, df, fingerprint):
+        """
+        store df unless it already is, return its reference and size. a frame
+        that cannot be stored column-wise is pickled, None if that fails too
+        """
+        if fingerprint is None:
+            # contents that cannot be hashed cell by cell. the hash of the pickle
+            # reads numeric blocks where they are instead of copying them
+            fingerprint = bytes.fromhex(self.store.pickle(df)[0][1])
+        ref = (FRAME, fingerprint.hex())
+        if self.store.touch(ref):
+            return ref, self.store.size(ref)
+        try:
+            self.store.put_frame(df, ref[1])
+        except Exception as e: # pylint: disable=broad-except
+            # eg. the disk is full, or a column cannot be written
+            if self.log:
+                self.log.debug("[FORKINGKERNEL] could not store frame column-wise {0}".format(e))
+            try:
+                ref, data, buffers = self.store.pickle(df)
+                return self._put_pickle(ref, data, buffers)
+            except Exception: # pylint: disable=broad-except
+                return None
+        size = self.store.size(ref)
+        self.new_objects.append((ref, size))
+        self._spent += size
+        return ref, size
+
+    def _put_pickle(self, ref, data, buffers):
+        """store a pickle unless it already is, return its reference and size"""
+        if self.store.touch(ref):
+            return ref, len(data) + sum(buf.raw().nbytes for buf in buffers)
+        size = self.store.put_pickle(ref, data, buffers)
+        self.new_objects.append((ref, size))
+        self._spent += size
+        return ref, size
+
+    def _profile(self, name, df):
+        """return the column profile of df, None if profiles are off or it could not be made"""
+        if not self.profile:
+            return None
+        try:
+            return profile_frame(df, self.profile_rows)
+        except Exception as e: # pylint: disable=broad-except
+            if self.log:
+                self.log.debug("[FORKINGKERNEL] could not profile {0} {1}".format(name, e))
+            return None
+
+    def _reuse_lazy(self, manifest, name, var, start):
+        """
+        refer to what a restored variable that was never loaded was stored as,
+        return False if it is no longer in the store
+        """
+        if not isinstance(var.ref, tuple) or not self.store.touch(var.ref):
+            return False
+        manifest[var.key][name] = var.ref
+        if self.profile and var.profile is not None:
+            manifest[PROFILES_KEY][name] = var.profile
+        self._record(name, var, self.store.size(var.ref), UNCHANGED, start)
+        return True
+
+    def _record(self, name, var, size, status, start):
+        # pylint: disable=too-many-arguments
+        self.telemetry.append((name, type_name(var), size, time.perf_counter() - start, status))
+
+    def reset(self):
+        """forget previous snapshots, eg. if the last one was never written"""
+        self._prev = {}
+
+    def state(self):
+        """what the last encode learned, for an encoder in another process to adopt"""
+        return {"prev" : self._prev, "pickled" : self.pickled, "oversized" : self.oversized}
+
+    def adopt(self, state, variables):
+        """take on the state of an encoder that encoded variables in a forked child"""
+        self._prev = state["prev"]
+        for name, picklable in state["pickled"].items():
+            if name in variables:
+                self.picklability.record(variables[name], picklable)
+        for name, size in state.get("oversized", {}).items():
+            if name in variables:
+                self._remember_oversized(variables[name], size)
+
+_UNLOADED = object()
+
+class LazyVariable:
+    """
+    stands in for a variable of a restored snapshot in the kernel's namespace,
+    and loads it from the ObjectStore when it is first used. load(bind=True)
+    also puts the object in its place in the namespace. __class__ is that of the
+    loaded object, so isinstance checks pass, but type() is LazyVariable until
+    the object has taken its place
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, namespace, name, key, ref, store, profile=None):
+        self._namespace = namespace
+        self._name = name
+        self._store = store
+        self._obj = _UNLOADED
+        self.key = key # manifest key it was stored under
+        self.ref = ref
+        self.profile = profile
+
+    @property
+    def loaded(self):
+        """has the object been loaded?"""
+        return self._obj is not _UNLOADED
+
+    def load(self, bind=True):
+        """return the object, loading it if it has not been"""
+        if self._obj is _UNLOADED:
+            self._obj = self._store.load(self.ref)
+        if bind and self._namespace.get(self._name) is self:
+            self._namespace[self._name] = self._obj
+        return self._obj
+
+    @property
+    def __class__(self):
+        return type(self.load())
+
+    def __getattr__(self, attr):
+        if attr in _LAZY_ATTRS: # not set yet, eg. while the placeholder is copied
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in _LAZY_ATTRS:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.load(), attr, value)
+
+    def __bool__(self):
+        return bool(self.load())
+
+    def __hash__(self):
+        return hash(self.load())
+
+_LAZY_ATTRS = frozenset(("_namespace", "_name", "_store", "_obj", "key", "ref", "profile"))
+
+def _forward(method):
+    """make a special method of LazyVariable that calls the loaded object's"""
+    def forward(self, *args, **kwargs):
+        func = getattr(type(self.load()), method, None)
+        if func is None:
+            return NotImplemented
+        return func(self.load(), *args, **kwargs)
+    forward.__name__ = method
+    return forward
+
+for _method in ("__repr__", "__str__", "__format__", "__len__", "__iter__", "__reversed__", "__contains__",
+                "__getitem__", "__setitem__", "__delitem__", "__call__", "__array__", "__index__",
+                "__int__", "__float__", "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+                "__neg__", "__pos__", "__abs__", "__invert__", "__add__", "__radd__", "__sub__", "__rsub__",
+                "__mul__", "__rmul__", "__matmul__", "__rmatmul__", "__truediv__", "__rtruediv__",
+                "__floordiv__", "__rfloordiv__", "__mod__", "__rmod__", "__pow__", "__rpow__",
+                "__and__", "__rand__", "__or__", "__ror__", "__xor__", "__rxor__"):
+    setattr(LazyVariable, _method, _forward(_method))
+
+class _StoredVar:
+    """what was stored for a variable"""
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, ident, is_df, fingerprint, ref, key, size, profile=None, reduced=None):
+        self.ident = ident
+        self.is_df = is_df
+        self.fingerprint = fingerprint
+        self.ref = ref
+        self.key = key # manifest key it was stored under
+        self.size = size
+        self.profile = profile # column profile, for DataFrames
+        self.reduced = reduced # why it was stored reduced, None if it was stored whole
+
+    def unchanged(self, var, is_df, fingerprint):
+        """
+        is var the same object, with the same content, as was stored? values
+        that cannot change only have to be equal
+        """
+        if fingerprint is None or self.fingerprint is None:
+            return False
+        same = self.ident == id(var) or type(var) in VALUE_TYPES
+        return same and self.is_df == is_df and self.fingerprint == fingerprint
+
+UNPICKLABLE_TYPES = (types.ModuleType, types.GeneratorType, types.FrameType, types.TracebackType,
+                     io.IOBase, socket.socket, sqlite3.Connection, sqlite3.Cursor,
+                     type(threading.Lock()), type(threading.RLock()))
+KERNEL_MODULES = ("IPython", "ipykernel", "jupyter_client", "zmq", "tornado", "traitlets")
+CONTAINER_TYPES = (list, tuple, dict, set, frozenset)
+# immutable types fingerprinted by value, tuples only if all they hold is
+VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes, tuple)
+
+class PicklabilityCache:
+    """
+    remembers which variables could not be pickled, so that they are skipped
+    rather than pickled again on every snapshot.
+
+    Results are kept per type, since instances of a type generally pickle or
+    fail alike. Builtin containers are the exception, whether they pickle depends
+    on what they hold, so failures are kept per container identity, along with
+    its length and the types it holds, since ids are reused once an object is
+    collected. Modules, open handles and the kernel's own objects are never tried.
+    """
+    def __init__(self):
+        self._bad_types = set()
+        self._good_types = set()
+        self._bad_containers = {} # id -> _contents(container) when pickling failed
+
+    def known_bad(self, var):
+        """return why var is known not to pickle, None if it may pickle"""
+        if isinstance(var, UNPICKLABLE_TYPES):
+            return "unpicklable type {0}".format(type(var).__name__)
+        if _kernel_object(var):
+            return "kernel object"
+        if isinstance(var, CONTAINER_TYPES):
+            bad = self._bad_containers.get(id(var))
+            if bad is not None and bad == _contents(var):
+                return "failed to pickle before"
+            return None
+        if type(var) in self._bad_types:
+            return "{0} failed to pickle before".format(type(var).__name__)
+        return None
+
+    def record(self, var, picklable):
+        """learn from an attempt to pickle var"""
+        if isinstance(var, CONTAINER_TYPES):
+            if picklable:
+                self._bad_containers.pop(id(var), None)
+            else:
+                self._bad_containers[id(var)] = _contents(var)
+        elif picklable:
+            self._good_types.add(type(var))
+        elif type(var) not in self._good_types:
+            # a type that has pickled before is not given up on for one bad instance
+            self._bad_types.add(type(var))
+
+def _contents(container):
+    """(length, types held) of a builtin container"""
+    items = container.items() if isinstance(container, dict) else ((item,) for item in container)
+    return (len(container), frozenset(type(part) for item in items for part in item))
+
+def _kernel_object(var):
+    """is var part of the kernel rather than user data, eg. get_ipython or exit?"""
+    owner = getattr(var, "__self__", var) if isinstance(var, types.MethodType) else var
+    module = getattr(type(owner), "__module__", None) or ""
+    return module.split(".")[0] in KERNEL_MODULES
+
+class ObjectSummary(dict):
+    """stands in for an object that was over the snapshot budget, see the module docstring"""
+
+def is_sample(df):
+    """is df a row sample standing in for a DataFrame that was over the snapshot budget?"""
+    return SAMPLE_ATTR in getattr(df, "attrs", {})
+
+def estimate_size(var):
+    """
+    return the bytes var takes in memory, estimated without going through
+    all of it. None for objects with no cheap estimate
+    """
+    if isinstance(var, pd.DataFrame):
+        return int(var.memory_usage(index=True, deep=False).sum()) + \
+            sum(_object_bytes(var.iloc[:, i]) for i in range(var.shape[1]) if var.dtypes.iloc[i] == object)
+    if isinstance(var, pd.Series):
+        extra = _object_bytes(var) if var.dtype == object else 0
+        return int(var.memory_usage(index=True, deep=False)) + extra
+    if isinstance(var, np.ndarray):
+        return int(var.nbytes) + (_object_bytes(var.ravel()) if var.dtype == object else 0)
+    return None
+
+def _object_bytes(values, sample=100):
+    """estimate the bytes held by the python objects in values from a sample of them"""
+    if len(values) == 0:
+        return 0
+    step = max(1, len(values) // sample)
+    picked = [sys.getsizeof(v) for v in values[::step][:sample]]
+    return int(sum(picked) / len(picked) * len(values))
+
+def type_name(var):
+    """module and qualified name of the type of var"""
+    kind = type(var)
+    return "{0}.{1}".format(kind.__module__, kind.__qualname__)
+
+def summarize(var, size, fingerprint, reason):
+    """return the ObjectSummary of var"""
+    summary = ObjectSummary(type=type_name(var),
+                            size=size,
+                            hash=fingerprint.hex() if fingerprint is not None else None,
+                            reason=reason)
+    if isinstance(var, pd.DataFrame):
+        summary["shape"] = var.shape
+        summary["dtypes"] = {col : str(t) for col, t in var.dtypes.items()}
+        summary["stats"] = {col : _column_stats(var.iloc[:, i]) for i, col in enumerate(var.columns)}
+    elif isinstance(var, (pd.Series, np.ndarray)):
+        summary["shape"] = var.shape
+        summary["dtypes"] = str(var.dtype)
+        summary["stats"] = _column_stats(pd.Series(var.ravel()) if isinstance(var, np.ndarray) else var)
+    return summary
+
+def _column_stats(col):
+    stats = {"count" : int(col.count())}
+    if pd.api.types.is_numeric_dtype(col.dtype) and not pd.api.types.is_bool_dtype(col.dtype):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            stats.update({"mean" : float(col.mean()), "min" : float(col.min()), "max" : float(col.max())})
+    return stats
+
+def content_fingerprint(var):
+    """
+    return a digest of the contents of var that is cheaper to compute than
+    pickling var, None if there is no such digest
+    """
+    if type(var) in VALUE_TYPES:
+        hasher = hashlib.sha1()
+        return hasher.digest() if _hash_value(var, hasher) else None
+    try:
+        if isinstance(var, pd.Series):
+            hasher = hashlib.sha1()
+            hasher.update(repr((var.name, str(var.dtype), str(var.index.dtype))).encode())
+            if isinstance(var.dtype, pd.CategoricalDtype):
+                hasher.update(repr((list(var.dtype.categories), var.dtype.ordered)).encode())
+            hasher.update(pd.util.hash_pandas_object(var, index=True).values.tobytes())
+            return hasher.digest()
+        if isinstance(var, pd.DataFrame):
+            hasher = hashlib.sha1()
+            hasher.update(repr(list(var.columns)).encode())
+            hasher.update(repr([str(t) for t in var.dtypes]).encode())
+            # the values of a categorical are hashed, not its categories or their order
+            for dtype in list(var.dtypes) + [var.index.dtype]:
+                if isinstance(dtype, pd.CategoricalDtype):
+                    hasher.update(repr((list(dtype.categories), dtype.ordered)).encode())
+            hasher.update(pd.util.hash_pandas_object(var, index=True).values.tobytes())
+            return hasher.digest()
+        if isinstance(var, np.ndarray) and var.dtype != object:
+            hasher = hashlib.sha1()
+            hasher.update(repr((var.dtype.str, var.shape)).encode())
+            hasher.update(np.ascontiguousarray(var).data)
+            return hasher.digest()
+    except (TypeError, ValueError):
+        # unhashable contents, eg. lists stored in a column
+        return None
+    return None
+
+def _hash_value(var, hasher):
+    """
+    add an immutable value to hasher, with its type. returns False if var
+    holds something that is not one
+    """
+    kind = type(var)
+    if kind not in VALUE_TYPES:
+        return False
+    hasher.update(kind.__name__.encode())
+    if kind is tuple:
+        hasher.update(str(len(var)).encode())
+        return all(_hash_value(item, hasher) for item in var)
+    if kind is str:
+        var = var.encode("utf-8", "surrogatepass")
+    elif kind is not bytes:
+        var = repr(var).encode()
+    hasher.update(str(len(var)).encode() + b":")
+    hasher.update(var)
+    return True
+
+class SnapshotWriter:
+    """
+    pickles and stores snapshots on a background thread, in the order they
+    were submitted.
+
+    submit blocks once maxsize snapshots are waiting to be written.
+    wait_encoded returns once every submitted snapshot has been pickled, and
+    flush returns once every submitted snapshot has been committed.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, db_file, insert_cmd, object_cmd, encoder, log, maxsize=4, vars_cmd=None):
+
+        self._db_file = db_file
+        self._insert_cmd = insert_cmd
+        self._object_cmd = object_cmd
+        self._vars_cmd = vars_cmd # records the telemetry of each snapshot, if given
+        self._encoder = encoder
+        self.log = log
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._encoded = 0
+        self._written = 0
+
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, msg_id, kernel_id, exec_ct, curr_time, code, variables):
+        """
+        queue variables (name -> object) to be stored under msg_id. If
+        variables is None a placeholder row without a namespace is stored
+        """
+        # pylint: disable=too-many-arguments
+        with self._cond:
+            self._submitted += 1
+        item = (msg_id, kernel_id, exec_ct, curr_time, code, variables)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.log.warning("[FORKINGKERNEL] snapshot queue full, waiting on writer")
+            self._queue.put(item)
+
+    def wait_encoded(self, timeout=None):
+        """wait until all submitted snapshots have been pickled"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._encoded >= self._submitted, timeout)
+
+    def flush(self, timeout=None):
+        """wait until all submitted snapshots have been committed"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._written >= self._submitted, timeout)
+
+    def close(self, timeout=None):
+        """write out remaining snapshots and stop the writer thread"""
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _advance(self, counter):
+        with self._cond:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self._cond.notify_all()
+
+    def _run(self):
+
+        conn = sqlite3.connect(self._db_file,
+                               detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            msg_id, kernel_id, exec_ct, curr_time, code, variables = item
+            item = None
+            namespace = None
+            new_objects = []
+            var_rows = []
+            placeholder = variables is None
+
+            try:
+                if not placeholder:
+                    namespace = dill.dumps(self._encoder.encode(variables))
+                    new_objects = self._encoder.new_objects
+                    var_rows = telemetry_rows(msg_id, kernel_id, curr_time, self._encoder.telemetry)
+            except Exception as e: # pylint: disable=broad-except
+                self._encoder.reset()
+                self.log.error("[FORKINGKERNEL] could not pickle namespace {0}".format(e))
+            finally:
+                variables = None
+                self._advance("_encoded")
+
+            if namespace is not None or placeholder:
+                try:
+                    write_snapshot(conn, self._insert_cmd, (msg_id, kernel_id, exec_ct, curr_time, code, namespace),
+                                   self._object_cmd, new_objects, curr_time, self._vars_cmd, var_rows)
+                except sqlite3.Error as e:
+                    # later snapshots must not reuse objects that were never recorded
+                    self._encoder.reset()
+                    self.log.error("[FORKINGKERNEL] could not store namespace {0}".format(e))
+            self._advance("_written")
+        conn.close()
+
+class ForkedSnapshotWriter:
+    """
+    stores each snapshot from a child process forked with a copy on write
+    image of the namespace. has the interface of SnapshotWriter.
+
+    submit waits for the previous child to finish. flush returns once every
+    submitted snapshot has been committed, or its child killed after
+    child_timeout seconds
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, db_file, insert_cmd, object_cmd, encoder, log, vars_cmd=None, child_timeout=None):
+
+        self._db_file = db_file
+        self._insert_cmd = insert_cmd
+        self._object_cmd = object_cmd
+        self._vars_cmd = vars_cmd
+        self._encoder = encoder
+        self.log = log
+        self.child_timeout = child_timeout or None
+
+        self._conn = None # for placeholders, written by the parent
+        self._child = None # (pid, read end of its pipe, variables it encodes, time it is killed at)
+        self._received = []
+
+    def submit(self, msg_id, kernel_id, exec_ct, curr_time, code, variables):
+        """
+        fork a child that stores variables (name -> object) under msg_id. If
+        variables is None a placeholder row without a namespace is stored
+        """
+        # pylint: disable=too-many-arguments
+        if not self.flush(timeout=0):
+            # the child has to report what it stored before the next snapshot can reuse it
+            self.log.warning("[FORKINGKERNEL] waiting on snapshot process {0}".format(self._child[0]))
+            self.flush()
+
+        if variables is None:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self._db_file,
+                                             detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            try:
+                write_snapshot(self._conn, self._insert_cmd, (msg_id, kernel_id, exec_ct, curr_time, code, None),
+                               self._object_cmd, [], curr_time)
+            except sqlite3.Error as e:
+                self.log.error("[FORKINGKERNEL] could not store namespace {0}".format(e))
+            return
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_child(write_fd, (msg_id, kernel_id, exec_ct, curr_time, code), variables)
+        os.close(write_fd)
+        expires = None if self.child_timeout is None else time.monotonic() + self.child_timeout
+        self._child = (pid, read_fd, variables, expires)
+
+    def _run_child(self, write_fd, row, variables):
+        """encode and write the snapshot, send the encoder's state to the parent, exit"""
+        status = 1
+        try:
+            msg_id, kernel_id, exec_ct, curr_time, code = row
+            try:
+                with warnings.catch_warnings():
+                    # the child has no kernel to show warnings in
+                    warnings.simplefilter("ignore")
+                    namespace = dill.dumps(self._encoder.encode(variables))
+                    conn = sqlite3.connect(self._db_file, timeout=30,
+                                           detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                    write_snapshot(conn, self._insert_cmd, (msg_id, kernel_id, exec_ct, curr_time, code, namespace),
+                                   self._object_cmd, self._encoder.new_objects, curr_time, self._vars_cmd,
+                                   telemetry_rows(msg_id, kernel_id, curr_time, self._encoder.telemetry))
+                    conn.close()
+                    result = dill.dumps(self._encoder.state())
+                    status = 0
+            except Exception as e: # pylint: disable=broad-except
+                result = dill.dumps({"error" : repr(e)})
+            with os.fdopen(write_fd, "wb") as f:
+                f.write(result)
+        finally:
+            # never return into the kernel's code in the child
+            os._exit(status) # pylint: disable=protected-access
+
+    def wait_encoded(self, timeout=None):
+        """the child has its own image of the namespace, cells can run right away"""
+        # pylint: disable=no-self-use,unused-argument
+        return True
+
+    def flush(self, timeout=None):
+        """
+        wait until the running child has committed its snapshot, and adopt its
+        encoder state. a child past its child_timeout is killed
+        """
+        if self._child is None:
+            return True
+        pid, read_fd, variables, expires = self._child
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if expires is not None and (deadline is None or expires <= deadline):
+            deadline = expires
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([read_fd], [], [], remaining)
+            if not ready:
+                if expires is not None and time.monotonic() >= expires:
+                    self._kill()
+                    return True
+                return False
+            chunk = os.read(read_fd, 1 << 20)
+            if not chunk:
+                break
+            self._received.append(chunk)
+
+        os.close(read_fd)
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass # already reaped
+        self._child = None
+        data, self._received = b"".join(self._received), []
+
+        try:
+            state = dill.loads(data)
+        except Exception: # pylint: disable=broad-except
+            state = {"error" : "snapshot process {0} exited without a result".format(pid)}
+        if "error" in state:
+            # later snapshots must not reuse objects that were never recorded
+            self._encoder.reset()
+            self.log.error("[FORKINGKERNEL] could not store namespace {0}".format(state["error"]))
+        else:
+            self._encoder.adopt(state, variables)
+        return True
+
+    def _kill(self):
+        """kill the running child, and forget what it may have stored"""
+        pid, read_fd, _, _ = self._child
+        self.log.error("[FORKINGKERNEL] snapshot process {0} did not finish in {1} seconds, killing it".format(
+            pid, self.child_timeout))
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass # exited on its own
+        os.close(read_fd)
+        self._child = None
+        self._received = []
+        # its objects may be in the store without a row recording them
+        self._encoder.reset()
+
+    def close(self, timeout=None):
+        """wait for the running child"""
+        self.flush(timeout)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+def write_snapshot(conn, insert_cmd, params, object_cmd, new_objects, curr_time, vars_cmd=None, var_rows=()):
+    """
+    insert the namespace row, record the objects it added to the store and,
+    if vars_cmd is given, the telemetry rows of its variables, in one transaction
+    """
+    # pylint: disable=too-many-arguments
+    conn.executemany(object_cmd, [(digest, kind, size, curr_time) for (kind, digest), size in new_objects])
+    if vars_cmd and var_rows:
+        conn.executemany(vars_cmd, var_rows)
+    conn.execute(insert_cmd, params)
+    conn.commit()
+
+def telemetry_rows(msg_id, kernel_id, curr_time, telemetry):
+    """rows of the snapshot_vars table for the telemetry of an encode"""
+    return [(msg_id, kernel_id, name, kind, size, seconds, status, curr_time)
+            for name, kind, size, seconds, status in telemetry]
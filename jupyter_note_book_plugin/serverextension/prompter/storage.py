@@ -2,6 +2,7 @@
 storage.py contains utilities for storing responses from the 
 notebook application and tracking development of particular cells over time
 """
+from collections.abc import Mapping
 from datetime import datetime, timedelta
 
 import json
@@ -10,23 +11,31 @@ import pandas as pd
 import re
 import sqlite3
 import os
+import threading
+import time
 import dill
 
 from pandas.api.types import is_numeric_dtype
 
-from mysql.connector import connect
-from mysql.connector.errors import IntegrityError
+from mysql.connector.pooling import MySQLConnectionPool
+from mysql.connector.errors import IntegrityError, InterfaceError, OperationalError, Error as MySQLError
 
-from .config import DB_DIR, DB_NAME, table_query
+from .config import DB_DIR, DB_NAME, SNAPSHOT_WAIT, DB_POOL_SIZE, DB_IDLE_SECONDS, REMOTE_CONNECT_SECONDS
+from .snapshots import DFS_KEY, OBJS_KEY, PROFILES_KEY, SAMPLE_ATTR, is_sample
+from .objectstore import ObjectStore, FRAME
+from .nscache import NamespaceCache
+from .writebuffer import WriteBuffer
+from .catalog import MetadataCatalog
+from .profiles import columns_fingerprint
 
 SQL_CMDS = {
   "GET_CODE" : """SELECT contents FROM cells WHERE id = ? AND kernel = ? AND user = ?""",
   "INSERT_CELLS" : """INSERT INTO cells(id, contents, num_exec, last_exec, kernel, user, metadata) VALUES (?,?,?,?,?,?,?);""",
   "UPDATE_CELLS" : """UPDATE cells SET contents = ?, num_exec = num_exec + 1, last_exec = ?, kernel = ?, metadata = ? WHERE id = ? AND user = ?;""",
-  "INSERT_VERSIONS" : """INSERT INTO versions(user, kernel, id, version, time, contents, exec_ct) VALUES (?,?,?,?,?,?,?);""",
+  "INSERT_VERSIONS" : """INSERT INTO versions(user, kernel, id, version, time, contents, exec_ct, msg_id) VALUES (?,?,?,?,?,?,?,?);""",
   "DATA_VERSIONS" : """SELECT kernel, source, name, version, user FROM data WHERE source = ? AND name = ? AND user = ? AND kernel = ? ORDER BY version""",
-  "DATA_VERSIONS_NO_SOURCE" : """SELECT kernel, source, name, version, user, exec_ct FROM data WHERE name = ? AND user = ? AND kernel = ? ORDER BY version""",
-  "ADD_DATA" : """INSERT INTO data(kernel, cell, version, source, name, user, exec_ct) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+  "DATA_VERSIONS_NO_SOURCE" : """SELECT kernel, source, name, version, user, exec_ct, msg_id, schema_hash, object_ref FROM data WHERE name = ? AND user = ? AND kernel = ? ORDER BY version""",
+  "ADD_DATA" : """INSERT INTO data(kernel, cell, version, source, name, user, exec_ct, msg_id, schema_hash, object_ref) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
   "ADD_COLS" : """INSERT INTO columns(user, kernel, name, version, col_name, type, size) VALUES (?, ?, ?, ?, ?, ?, ?)""",
   "GET_VERSIONS" : """SELECT contents, version FROM versions WHERE kernel = ? AND id = ? AND user = ? ORDER BY version DESC LIMIT 1""",
   "GET_FIELDS" : """SELECT fields FROM columns WHERE user = ? AND kernel = ? AND name = ? AND version = ? AND col_name = ?""",
@@ -35,44 +44,117 @@ SQL_CMDS = {
   "UPDATE_COL_TYPES" : """UPDATE columns SET fields = ?, is_sensitive = ?, user_specified = ?, checked = ? WHERE user = ? AND kernel = ? AND name = ? AND version = ? AND col_name = ?""",
   "GET_MAX_VERSION" : """SELECT name,MAX(version) FROM data WHERE user = ? AND kernel = ? GROUP BY name""",
   "GET_VERSION_COLS" : """SELECT * FROM columns WHERE kernel = ? AND user = ? AND name = ? AND version = ?""",
+  # all the data versions and columns of a kernel, read into the MetadataCatalog
+  "KERNEL_DATA_VERSIONS" : """SELECT kernel, source, name, version, user, exec_ct, msg_id, schema_hash, object_ref FROM data WHERE user = ? AND kernel = ?""",
+  "KERNEL_COLS" : """SELECT * FROM columns WHERE user = ? AND kernel = ?""",
   "STORE_RESP" : """INSERT INTO notifications(kernel, user, cell, resp, exec_ct) VALUES (?, ?, ?, ?, ?)""",
   "GET_RESPS" : """SELECT cell, resp FROM notifications WHERE kernel = ? AND user = ?""",
   "GET_DATA_VERSION": "SELECT * from data WHERE exec_ct = ? AND name = ?", # NOTE: unused, probably wrong
+  "DATA_SNAPSHOTS" : """SELECT DISTINCT kernel, exec_ct, msg_id, object_ref FROM data WHERE user = ?""",
   "USER_TRACKING": """INSERT INTO userTracking(user, type, description) VALUES(?, ?, ?)""",
+  # tracking events are written in batches, so their time is recorded when they are added
+  "USER_TRACKING_AT": """INSERT INTO userTracking(user, type, description, time) VALUES(?, ?, ?, ?)""",
   "LINK_CELL" : """"""
 }
 
 LOCAL_SQL_CMDS = { # cmds that will always get executed locally
-  "MAKE_NS_TABLE" : """CREATE TABLE namespaces(msg_id TEXT PRIMARY KEY, exec_num INT, code TEXT, time TIMESTAMP, namespace BLOB)""",
+  # the tables of make_tables.sql a DbHandler uses, in sqlite's dialect
+  "MAKE_STUDY_TABLES" : """CREATE TABLE IF NOT EXISTS cells(user TEXT, kernel TEXT, id TEXT PRIMARY KEY, contents TEXT, metadata TEXT,
+                                                        num_exec INT, last_exec TIMESTAMP);
+                           CREATE TABLE IF NOT EXISTS versions(user TEXT, kernel TEXT, id TEXT, version INT, time TIMESTAMP,
+                                                           contents TEXT, exec_ct INT, msg_id TEXT, PRIMARY KEY(id, version));
+                           CREATE TABLE IF NOT EXISTS data(user TEXT NOT NULL, kernel TEXT NOT NULL, cell TEXT, version INT NOT NULL,
+                                                       source TEXT, name TEXT NOT NULL, exec_ct INT, msg_id TEXT,
+                                                       schema_hash TEXT, object_ref TEXT, PRIMARY KEY(user, kernel, name, version));
+                           CREATE INDEX IF NOT EXISTS data_schema ON data(user, kernel, name, schema_hash);
+                           CREATE TABLE IF NOT EXISTS columns(user TEXT, kernel TEXT, name TEXT, version INT, col_name TEXT, type TEXT,
+                                                          size INT, is_sensitive BOOLEAN DEFAULT FALSE,
+                                                          user_specified BOOLEAN DEFAULT FALSE, checked BOOLEAN DEFAULT FALSE,
+                                                          fields TEXT, PRIMARY KEY(user, kernel, name, version, col_name));
+                           CREATE TABLE IF NOT EXISTS notifications(kernel TEXT, user TEXT, cell TEXT, exec_ct INT, resp TEXT);
+                           CREATE TABLE IF NOT EXISTS userTracking(user TEXT NOT NULL, type TEXT, description TEXT,
+                                                               time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""",
+  # local tables made before versions and data recorded the msg_id of the execute request. the remote
+  # tables are made by make_tables.sql and migrate_tables.sql, the server does not alter them
+  "ADD_VERSIONS_MSG_ID" : """ALTER TABLE versions ADD COLUMN msg_id TEXT""",
+  "ADD_DATA_MSG_ID" : """ALTER TABLE data ADD COLUMN msg_id TEXT""",
+  "ADD_DATA_SCHEMA_HASH" : """ALTER TABLE data ADD COLUMN schema_hash TEXT""",
+  "ADD_DATA_SCHEMA_INDEX" : """CREATE INDEX data_schema ON data(user, kernel, name, schema_hash)""",
+  "ADD_DATA_OBJECT_REF" : """ALTER TABLE data ADD COLUMN object_ref TEXT""",
+  "MAKE_NS_TABLE" : """CREATE TABLE namespaces(msg_id TEXT PRIMARY KEY, kernel TEXT, exec_num INT, code TEXT, time TIMESTAMP, namespace BLOB)""",
+  "ADD_NS_KERNEL" : """ALTER TABLE namespaces ADD COLUMN kernel TEXT""",
+  "MAKE_NS_INDEXES" : """CREATE INDEX IF NOT EXISTS namespaces_kernel_time ON namespaces(kernel, time);
+                         CREATE INDEX IF NOT EXISTS namespaces_kernel_exec ON namespaces(kernel, exec_num);""",
   "RECOVER_NS" : """SELECT namespace FROM namespaces WHERE msg_id = ?""",
-  "RECENT_NS" : """SELECT * FROM namespaces ORDER BY time DESC LIMIT 1""",
+  "GET_NS" : """SELECT * FROM namespaces WHERE msg_id = ?""",
+  "RECENT_NS" : """SELECT * FROM namespaces WHERE kernel IS NULL AND namespace IS NOT NULL ORDER BY time DESC LIMIT 1""",
+  "RECENT_KERNEL_NS" : """SELECT * FROM namespaces WHERE kernel = ? AND namespace IS NOT NULL ORDER BY time DESC LIMIT 1""",
+  "SUPERSEDING_NS" : """SELECT * FROM namespaces WHERE kernel IS ? AND namespace IS NOT NULL
+                        AND time >= (SELECT time FROM namespaces WHERE msg_id = ?) ORDER BY time LIMIT 1""",
+  "EXEC_NS" : """SELECT * FROM namespaces WHERE kernel = ? AND exec_num = ? ORDER BY time DESC LIMIT 1""",
   "LINK_CELL" : """SELECT * FROM namespaces WHERE exec_num = ? ORDER BY time""",
+  "LINK_KERNEL_CELL" : """SELECT * FROM namespaces WHERE kernel = ? AND exec_num = ? ORDER BY time""",
+  "LAST_EXEC_NS" : """SELECT * FROM namespaces WHERE exec_num = ? ORDER BY time DESC LIMIT 1""",
+  "MAKE_OBJECTS_TABLE" : """CREATE TABLE IF NOT EXISTS objects(hash TEXT, kind TEXT, size INT, time TIMESTAMP, PRIMARY KEY(kind, hash))""",
+  "ADD_OBJECT" : """INSERT OR IGNORE INTO objects(hash, kind, size, time) VALUES (?, ?, ?, ?)""",
+  "INCREMENTAL_VACUUM" : """PRAGMA auto_vacuum = INCREMENTAL""", # must run before the first table is made
+  "MAKE_SNAPSHOT_VARS_TABLE" : """CREATE TABLE IF NOT EXISTS snapshot_vars(msg_id TEXT, kernel TEXT, name TEXT, type TEXT,
+                                                                           size INT, seconds REAL, status TEXT, time TIMESTAMP);
+                                  CREATE INDEX IF NOT EXISTS snapshot_vars_kernel ON snapshot_vars(kernel, name);
+                                  CREATE INDEX IF NOT EXISTS snapshot_vars_msg ON snapshot_vars(msg_id);""",
+  "ADD_SNAPSHOT_VARS" : """INSERT INTO snapshot_vars(msg_id, kernel, name, type, size, seconds, status, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+  # per variable totals over a kernel's snapshots, or over all snapshots if the kernel is NULL
+  "SLOWEST_VARS" : """SELECT name, type, COUNT(*) AS snapshots, SUM(seconds) AS seconds, MAX(seconds) AS max_seconds,
+                             MAX(size) AS size, SUM(status = 'skipped') AS skipped
+                      FROM snapshot_vars WHERE ? IS NULL OR kernel = ?
+                      GROUP BY name, type ORDER BY seconds DESC LIMIT ?""",
+  "LARGEST_VARS" : """SELECT name, type, COUNT(*) AS snapshots, SUM(seconds) AS seconds, MAX(seconds) AS max_seconds,
+                             MAX(size) AS size, SUM(status = 'skipped') AS skipped
+                      FROM snapshot_vars WHERE ? IS NULL OR kernel = ?
+                      GROUP BY name, type ORDER BY size DESC LIMIT ?""",
 }
 
+# sqlite has no error codes, the tables it has not made yet are made without migrating
+ALREADY_MIGRATED_LOCAL = re.compile(r"duplicate column name|already exists|no such table")
+
 class DbHandler:
     """
     DbHandler class handles connections between sqlite3 or MySQL database
     Provides single place for updating database entries
+
+    with an outbox, writes to the study tables are queued there for a
+    Replicator to copy to the remote database, see outbox.py. reads on the
+    request path are then answered from the outbox and what is in memory while
+    the remote database cannot be reached. a failed read marks it down, only
+    the Replicator marks it up again, see remote_reached
     """
-    def __init__(self, dirname = DB_DIR, dbname = DB_NAME):
+    pool_size = 1 # one sqlite connection, calls cannot run at the same time
+
+    def __init__(self, dirname = DB_DIR, dbname = DB_NAME, outbox=None):
 
         db_path_resolved = os.path.expanduser(dirname)
 
         self.user="default"
         self.cmds = SQL_CMDS
         self.cmds.update(LOCAL_SQL_CMDS)
+        self.outbox = outbox
+        self._init_caches()
  
         if os.path.isdir(db_path_resolved) and os.path.isfile(db_path_resolved+dbname):
 
             self._conn = sqlite3.connect(db_path_resolved+dbname, 
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                check_same_thread=False) # made on the main thread, used on the database thread
             self._conn.row_factory = sqlite3.Row
             self._cursor = self._conn.cursor()
+            update_ns_table(self._conn)
+            self._update_tables()
         else:
             if not os.path.isdir(db_path_resolved):
                os.mkdir(db_path_resolved)
             self._conn = sqlite3.connect(db_path_resolved+dbname, 
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                check_same_thread=False) # made on the main thread, used on the database thread
             self._conn.row_factory = sqlite3.Row
             self._cursor = self._conn.cursor()
             self._init_db()
@@ -82,16 +164,133 @@ class DbHandler:
         add the tables to the new database
         """
         
-        self._cursor.executescript(table_query)
+        self._cursor.execute(self.cmds["INCREMENTAL_VACUUM"])
+        # sqlite cannot read the MySQL column options in make_tables.sql
+        self._cursor.executescript(self.cmds["MAKE_STUDY_TABLES"])
         self._cursor.execute(self.cmds["MAKE_NS_TABLE"])
+        self._cursor.execute(self.cmds["MAKE_OBJECTS_TABLE"])
+        self._cursor.executescript(self.cmds["MAKE_NS_INDEXES"])
+        self._cursor.executescript(self.cmds["MAKE_SNAPSHOT_VARS_TABLE"])
+        self._conn.commit()
+
+    def _init_caches(self):
+        """set up what the handler keeps in memory between calls"""
+        self.ns_cache = NamespaceCache()
+        self._writes = WriteBuffer()
+        self._cell_versions = {} # (kernel, cell id) -> (contents, version) of the latest version queued
+        self._remote_up = threading.Event() # cleared while reads are answered locally, see _remote_read
+        self._remote_up.set()
+        self._offline_kernels = set() # read into the catalog while the remote database could not be reached
+        self._offline_lock = threading.Lock() # added to on the database threads, taken on the replicator thread
+        self._snapshot_links = None # the rows of the last DATA_SNAPSHOTS read, for data_snapshots while the remote is down
+        self.catalog = MetadataCatalog(self._read_catalog)
+        self.store = ObjectStore()
+
+    def _remote_read(self, read, local):
+        """
+        return read(), or with an outbox local() if the remote database cannot be
+        reached. after a failed read, reads go to local() without trying it until
+        the Replicator reaches it again, so requests do not wait on reconnects
+        """
+        if self.outbox is None:
+            return read()
+        if self._remote_up.is_set():
+            try:
+                if self.renew_connection():
+                    return read()
+            except MySQLError:
+                pass
+            self._remote_up.clear()
+        return local()
+
+    def remote_down(self):
+        """are reads answered locally, since the remote database could not be reached?"""
+        return self.outbox is not None and not self._remote_up.is_set()
+
+    def remote_reached(self, reachable):
+        """
+        record whether the Replicator could reach the remote database. once it
+        has, reads go to it again, and the kernels read into the catalog while
+        it could not be reached are read again with what it has
+        """
+        if not reachable:
+            self._remote_up.clear()
+            return
+        self._remote_up.set()
+        with self._offline_lock:
+            offline, self._offline_kernels = self._offline_kernels, set()
+        for kernel in offline:
+            self.catalog.invalidate(kernel)
+
+    def _read_catalog(self, kernel):
+        """
+        return the data and columns rows of kernel, for the catalog. with an outbox
+        the rows still queued there are added, they are all there is while the
+        remote database cannot be reached
+        """
+        # queued rows first, a batch copied in between is then read twice rather than not at all
+        queued_data, queued_cols, col_updates = self._queued_catalog(kernel)
+
+        def read():
+            self.renew_connection()
+            self._cursor.execute(self.cmds["KERNEL_DATA_VERSIONS"], (self.user, kernel))
+            data_rows = self._cursor.fetchall()
+            self._cursor.execute(self.cmds["KERNEL_COLS"], (self.user, kernel))
+            return data_rows, self._cursor.fetchall()
+        def local():
+            with self._offline_lock:
+                self._offline_kernels.add(kernel)
+            return [], []
+        data_rows, col_rows = self._remote_read(read, local)
+        if self.outbox is None:
+            return data_rows, col_rows
+
+        data = {(row["name"], row["version"]) : dict(row) for row in list(data_rows) + queued_data}
+        cols = {(row["name"], row["version"], row["col_name"]) : dict(row) for row in list(col_rows) + queued_cols}
+        for key, values in col_updates:
+            if key in cols:
+                cols[key].update(values)
+        return list(data.values()), list(cols.values())
+
+    def _queued_catalog(self, kernel):
+        """the data rows, columns rows and column updates of kernel still queued in the outbox"""
+        if self.outbox is None:
+            return [], [], []
+        data_rows = [{"kernel" : row[0], "source" : row[3], "name" : row[4], "version" : row[2], "user" : row[5],
+                      "exec_ct" : row[6], "msg_id" : row[7], "schema_hash" : row[8], "object_ref" : row[9]}
+                     for row in self.outbox.pending("ADD_DATA") if (row[0], row[5]) == (kernel, self.user)]
+        col_rows = [{"user" : row[0], "kernel" : row[1], "name" : row[2], "version" : row[3], "col_name" : row[4],
+                     "type" : row[5], "size" : row[6], "is_sensitive" : 0, "user_specified" : 0, "checked" : 0,
+                     "fields" : None}
+                    for row in self.outbox.pending("ADD_COLS") if row[:2] == (self.user, kernel)]
+        col_updates = [((row[6], row[7], row[8]), {"fields" : row[0], "is_sensitive" : row[1],
+                                                   "user_specified" : row[2], "checked" : row[3]})
+                       for row in self.outbox.pending("UPDATE_COL_TYPES") if row[4:6] == (self.user, kernel)]
+        return data_rows, col_rows, col_updates
+
+    def _update_tables(self):
+        """add the columns this version relies on to local tables made by older versions"""
+        for cmd in ("ADD_VERSIONS_MSG_ID", "ADD_DATA_MSG_ID", "ADD_DATA_SCHEMA_HASH", "ADD_DATA_SCHEMA_INDEX",
+                    "ADD_DATA_OBJECT_REF"):
+            try:
+                self._cursor.execute(self.cmds[cmd])
+            except sqlite3.OperationalError as e:
+                if not ALREADY_MIGRATED_LOCAL.search(str(e)):
+                    raise
         self._conn.commit()
 
     def get_code(self, kernel_id, cell_id):
         """return the contents of the cell, none if does not exist"""
+        if self.outbox is not None:
+            queued = [row[1] for row in self.outbox.pending("UPSERT_CELLS") if (row[0], row[4], row[5]) == (cell_id, kernel_id, self.user)]
+            if queued:
+                return queued[-1] # newer than what is stored
 
-        self.renew_connection()
-        self._cursor.execute(self.cmds["GET_CODE"], (cell_id, kernel_id, self.user))
-        result = self._cursor.fetchall()
+        def read():
+            self.renew_connection()
+            self._cursor.execute(self.cmds["GET_CODE"], (cell_id, kernel_id, self.user))
+            return self._cursor.fetchall()
+        result = self._remote_read(read, list)
 
         if len(result) != 0:
             return result[0]["contents"]
@@ -121,6 +320,10 @@ class DbHandler:
                If the cell is not a new version (the code has changed), then we 
                will need to create a new entry in the versions table
         """
+        if self.outbox is not None:
+            self._queue_entry(cell)
+            return
+
         #inserting new value into cells
 
         self.renew_connection()
@@ -141,44 +344,218 @@ class DbHandler:
           if results and results["contents"] != cell["contents"]:
             self._cursor.execute(self.cmds["INSERT_VERSIONS"], (self.user, cell["kernel"], cell['cell_id'], 
                                                                 results["version"]+1, datetime.now(), cell['contents'], 
-                                                                cell["exec_ct"]))
+                                                                cell["exec_ct"], cell.get("msg_id")))
           if not results:
             self._cursor.execute(self.cmds["INSERT_VERSIONS"], (self.user, cell["kernel"], cell['cell_id'], 
                                                                 1, datetime.now(), cell['contents'], 
-                                                                cell["exec_ct"]))
+                                                                cell["exec_ct"], cell.get("msg_id")))
         except (sqlite3.IntegrityError, IntegrityError) as _:
           #As I understand the documentation, nothing happens if a version
           #already exists. 
           pass
         self._conn.commit()
 
+    def _queue_entry(self, cell):
+        """
+        add_entry for a handler with an outbox. the latest version of each cell is
+        kept in memory, so a new version can be numbered without reading it back
+        """
+        key = (cell["kernel"], cell["cell_id"])
+        if key not in self._cell_versions:
+            self._cell_versions[key] = self._latest_version(cell["kernel"], cell["cell_id"])
+        now = _timestamp()
+        batches = [("UPSERT_CELLS", [(cell['cell_id'], cell['contents'], 1, now, cell["kernel"], self.user, cell['metadata'])])]
+
+        contents, version = self._cell_versions[key]
+        if contents != cell["contents"]:
+            self._cell_versions[key] = (cell["contents"], version + 1)
+            batches.append(("INSERT_VERSIONS", [(self.user, cell["kernel"], cell['cell_id'], version + 1, now,
+                                                 cell['contents'], cell["exec_ct"], cell.get("msg_id"))]))
+        self._write(batches)
+
+    def _latest_version(self, kernel, cell_id):
+        """
+        (contents, version) of the latest version of the cell, (None, 0) if there is
+        none or it cannot be read. versions still queued in the outbox are the latest
+        """
+        if self.outbox is not None:
+            queued = [(row[5], row[3]) for row in self.outbox.pending("INSERT_VERSIONS")
+                      if row[:3] == (self.user, kernel, cell_id)]
+            if queued:
+                return queued[-1]
+        def read():
+            self.renew_connection()
+            self._cursor.execute(self.cmds["GET_VERSIONS"], (kernel, cell_id, self.user))
+            return self._cursor.fetchone()
+        try:
+            result = self._remote_read(read, lambda: None)
+        except (sqlite3.Error, MySQLError):
+            return (None, 0) # numbered from 1, the replicator numbers them again after those the remote database has
+        return (result["contents"], result["version"]) if result else (None, 0)
+
+    def _write(self, batches):
+        """
+        run each (cmd name, [params]) of batches against the study tables in one
+        transaction, or queue them in the outbox if the handler has one
+        """
+        if self.outbox is not None:
+            self.outbox.put(batches)
+            return
+        self.renew_connection()
+        for cmd, rows in batches:
+            self._cursor.executemany(self.cmds[cmd], rows)
+        self._conn.commit()
+
+    def _append(self, cmd, params):
+        """write a row of an append-only table, in the next batch of buffered writes"""
+        if self._writes.add(cmd, params):
+            self.flush_writes()
+
     def recover_ns(self, msg_id, curs=None):
-        """return the namespace under the msg_id entry"""
+        """
+        return the namespace under the msg_id entry, None if there is none. for
+        a coalesced execution that is the snapshot stored at the end of its burst,
+        or the placeholder row itself while the burst is still running
+        """
         if not curs: 
             curs = self._cursor
-        curs.execute(self.cmds["RECOVER_NS"], (msg_id,))
-        return curs.fetchall()[0]
+        curs.execute(self.cmds["GET_NS"], (msg_id,))
+        rows = curs.fetchall()
+        if not rows:
+            return None
+        row = self._durable_ns(rows[0], curs)
+        if row is None:
+            return rows[0]
+        return self._cache_ns(row)
 
-    def recent_ns(self, curs=None):
-        """return the most recently logged namespace""" 
+    def recent_ns(self, kernel_id=None, curs=None):
+        """
+        return the most recently logged namespace of kernel_id. Falls back
+        to the most recent snapshot stored before namespaces were keyed by
+        kernel if kernel_id has none, None if there is no such snapshot either
+        """ 
         if not curs: 
             curs = self._cursor
-        curs.execute(self.cmds["RECENT_NS"])
-        return curs.fetchall()[0]
+        rows = []
+        if kernel_id:
+            curs.execute(self.cmds["RECENT_KERNEL_NS"], (kernel_id,))
+            rows = curs.fetchall()
+        if not rows:
+            curs.execute(self.cmds["RECENT_NS"])
+            rows = curs.fetchall()
+        if not rows:
+            return None
+        return self._cache_ns(rows[0])
+
+    def exec_ns(self, kernel_id, exec_ct, curs=None):
+        """return the namespace kernel_id logged for exec_ct, None if there is none"""
+        if not curs:
+            curs = self._cursor
+        curs.execute(self.cmds["EXEC_NS"], (kernel_id, exec_ct))
+        rows = curs.fetchall()
+        if not rows:
+            return None
+        row = self._durable_ns(rows[0], curs)
+        if row is None:
+            return None
+        return self._cache_ns(row)
 
-    def link_cell_to_ns(self, exec_ct, contents, cell_time, curs = None):
-        """given an entry in the versions table, find matching namespace entry"""
-        # pylint: disable=unused-argument
+    def msg_ns(self, msg_id, curs=None):
+        """
+        return the namespace logged for the execute request msg_id, None if it
+        has not been stored yet
+        """
+        if not curs:
+            curs = self._cursor
+        curs.execute(self.cmds["GET_NS"], (msg_id,))
+        rows = curs.fetchall()
+        if not rows:
+            return None
+        row = self._durable_ns(rows[0], curs)
+        if row is None:
+            return None
+        return self._cache_ns(row)
+
+    def find_ns(self, exec_ct, kernel_id=None, curs=None, msg_id=None):
+        """
+        return the namespace stored for exec_ct, or for the execute request msg_id
+        if it is known. for a coalesced execution that is the snapshot stored at the
+        end of its burst, or the placeholder row itself, with no namespace, while
+        the burst is still running. None if nothing has been stored yet
+        """
+        if not curs:
+            curs = self._cursor
+        if msg_id:
+            curs.execute(self.cmds["GET_NS"], (msg_id,))
+        elif kernel_id:
+            curs.execute(self.cmds["EXEC_NS"], (kernel_id, exec_ct))
+        else:
+            curs.execute(self.cmds["LAST_EXEC_NS"], (exec_ct,))
+        rows = curs.fetchall()
+        if not rows:
+            return None
+        row = self._durable_ns(rows[0], curs)
+        if row is None:
+            return rows[0]
+        return self._cache_ns(row)
+
+    def wait_for_ns(self, exec_ct, kernel_id=None, timeout=SNAPSHOT_WAIT, curs=None, msg_id=None):
+        """
+        wait until the kernel has stored the namespace for exec_ct, or for the
+        execute request msg_id, since snapshots are written in the background.
+        returns it as find_ns does, None if nothing was stored in time
+        """
+        # pylint: disable=too-many-arguments
+        deadline = time.monotonic() + timeout
+        while True:
+            ns = self.find_ns(exec_ct, kernel_id, curs=curs, msg_id=msg_id)
+            if ns is not None or time.monotonic() >= deadline:
+                return ns
+            time.sleep(0.05)
+
+    def _durable_ns(self, row, curs):
+        """
+        return row, or if it is the placeholder of a coalesced execution, the
+        snapshot stored at the end of that burst of executions. None if that
+        has not been stored yet
+        """
+        if row["namespace"] is not None:
+            return row
+        curs.execute(self.cmds["SUPERSEDING_NS"], (row["kernel"], row["msg_id"]))
+        rows = curs.fetchall()
+        return rows[0] if rows else None
+
+    def _cache_ns(self, row):
+        """
+        return the namespace row, keeping its decoded namespace dictionary
+        in ns_cache for the load_ functions. a placeholder row, with no
+        namespace, is returned as is
+        """
+        if row["namespace"] is None:
+            return row
+        self.ns_cache.get(("manifest", row["msg_id"]), lambda: dill.loads(row["namespace"]), len(row["namespace"]))
+        return row
+
+    def link_cell_to_ns(self, exec_ct, contents, cell_time, curs = None, msg_id=None):
+        """
+        given an entry in the versions table, find matching namespace entry.
+        entries that recorded the msg_id of their execute request match exactly
+        """
+        # pylint: disable=unused-argument,too-many-arguments
         # disable bc I don't want to mess up other calls
         if not curs: 
             curs = self._cursor
 
+        if msg_id:
+            curs.execute(self.cmds["GET_NS"], (msg_id,))
+            results = curs.fetchall()
+            return results[0] if results else None
+
         delta = timedelta(seconds=3) 
 
         #self.renew_connection()
-        # curs.execute(self.cmds["LINK_CELL"], (exec_ct,))
-        self._local_cursor.execute(self.cmds["LINK_CELL"], (exec_ct,))
-        results = self._local_cursor.fetchall()
+        curs.execute(self.cmds["LINK_CELL"], (exec_ct,))
+        results = curs.fetchall()
        
         results = [r for r in results if r["time"] > (cell_time - delta)]  
         results = [r for r in results if r["time"] < (cell_time + delta)]
@@ -193,21 +570,13 @@ class DbHandler:
         """
         return version number of data, if it exists, 
         else, return None
+
+        a version matches if the fingerprint of its column names, types and
+        sizes is that of the entry point, so columns are not compared one by one
         """
+        schema_hash = columns_fingerprint(entry_point["columns"])
         for version in data_versions:
-            entry_matched = True
-            columns = self.get_columns(entry_point["kernel"], entry_point["name"], version["version"])
-            names = [col["col_name"] for col in columns]
-  
-            if len(names) == len(entry_point["columns"]) and set(names).issubset(set(entry_point["columns"])):
-                for col in columns:
-                    if entry_point["columns"][col["col_name"]]["type"] != col["type"]:
-                        entry_matched = False
-                    if entry_point["columns"][col["col_name"]]["size"] != col["size"]:
-                        entry_matched = False
-            else:
-                entry_matched = False
-            if entry_matched:
+            if version["schema_hash"] == schema_hash:
                 return version["version"]
         return None
     def is_new_data(self, entry_point, data_versions=None):
@@ -233,12 +602,14 @@ class DbHandler:
             return self._match_columns(entry_point, data_versions)
         return None
  
-    def check_add_data(self, entry_point, exec_ct):
+    def check_add_data(self, entry_point, exec_ct, msg_id=None, object_ref=None):
         """
         check if entry_point data is updated, compare columns as well,
         then update
         
         entry_point is dict with attributes source, name, kernel, columns : {col_name : {"size", "type"}}
+        msg_id is that of the execute request, which the namespace snapshot is stored under
+        object_ref is the reference of the dataframe in that snapshot, see LazyFrames.ref
         """ 
         data_versions = self.find_data(entry_point)
 
@@ -254,13 +625,13 @@ class DbHandler:
                 max_data_version = [v for v in data_versions if v["version"] == max_version][0]
                 entry_point["source"] = max_data_version["source"] 
 
-            self.add_data(entry_point, max_version+1, exec_ct) 
+            self.add_data(entry_point, max_version+1, exec_ct, msg_id, object_ref)
             return max_version + 1
         else:
             # data is new, add data and columns to database
             if "source" not in entry_point:
                 entry_point["source"] = "unknown"
-            self.add_data(entry_point, 1, exec_ct)
+            self.add_data(entry_point, 1, exec_ct, msg_id, object_ref)
             return 1
     def find_data(self, data):
         """look up if data entry exists, return if exists, None if not"""
@@ -280,12 +651,7 @@ class DbHandler:
                 return None
             return data_versions
         """
-        name = data["name"]
-        kernel = data["kernel"] 
-
-        self.renew_connection()
-        self._cursor.execute(self.cmds["DATA_VERSIONS_NO_SOURCE"], (name, self.user, kernel))
-        data_versions = self._cursor.fetchall()
+        data_versions = self.catalog.versions(data["kernel"], data["name"])
 
         if data_versions == []:
             return None
@@ -305,28 +671,50 @@ class DbHandler:
             # loop through all matches to find the version we're looking for
             for match in data_versions:
                 if match["version"] == version:
+                    frame = self._load_version(match)
+                    if frame is not None:
+                        return frame
                     exec_ct = match["exec_ct"]
                     # query local database
                     self.renew_connection()
-                    cursor.execute(self.cmds["LINK_CELL"], (exec_ct,))
+                    if match["msg_id"]:
+                        # the snapshot of the execution that recorded this version
+                        cursor.execute(self.cmds["GET_NS"], (match["msg_id"],))
+                    else:
+                        cursor.execute(self.cmds["LINK_KERNEL_CELL"], (data["kernel"], exec_ct))
                     # list of all 
                     namespaces = cursor.fetchall()
+                    if len(namespaces) < 1 and not match["msg_id"]:
+                        # snapshots from before namespaces were keyed by kernel
+                        cursor.execute(self.cmds["LINK_CELL"], (exec_ct,))
+                        namespaces = cursor.fetchall()
                     if len(namespaces) < 1:
                         return None # there were no namespaces with this exec_ct
+                    elif not match["msg_id"] and namespaces[0]["namespace"] is None:
+                        # a coalesced execution, the frame it made was never stored
+                        return None
                     else:
                         # NOTE: gets the earliest timestamped matching namespace
-                        # TODO: select by kernel id instead?
-                        namespace = namespaces[0]
-                        df_name = data["name"]
-                        dfs = load_dfs(namespace)
-                        if df_name in dfs:
-                            return dfs[df_name]
-                        else:
+                        namespace = self._durable_ns(namespaces[0], cursor)
+                        if namespace is None:
                             return None
+                        return load_frame(namespace, data["name"], store=self.store, cache=self.ns_cache)
             # if we're here, no such version exists
             return None
 
-    def add_data(self, data, version, exec_ct):
+    def _load_version(self, match):
+        """
+        the dataframe a data version points to, None if it recorded no
+        object_ref or the object is no longer stored
+        """
+        if not match.get("object_ref"):
+            return None
+        ref = parse_ref(match["object_ref"])
+        if not self.store.has(ref):
+            return None
+        return _load_object(self.store, ref, self.ns_cache)
+
+    def add_data(self, data, version, exec_ct, msg_id=None, object_ref=None):
         """add data to data entry table
         data format is 
             {"kernel" : kernel_id, 
@@ -345,11 +733,10 @@ class DbHandler:
 
         columns = data["columns"]
 
-        self.renew_connection()
-
         # manager.py calls cell_exec() with exec_ct. cell_exec() calls check_add_data() and passes it down
         # check_add_data() passes exec_ct to add_data which finally adds it to the database
-        self._cursor.execute(self.cmds["ADD_DATA"], (kernel, cell, version, source, name, self.user, exec_ct))
+        schema_hash = columns_fingerprint(columns)
+        object_ref = format_ref(object_ref) if object_ref else None
 
         cols = [(self.user,
                  kernel,
@@ -358,43 +745,80 @@ class DbHandler:
                  col, # column's name
                  str(columns[col]["type"]), 
                  columns[col]["size"]) for col in columns.keys()]
-        self._cursor.executemany(self.cmds["ADD_COLS"], cols)
-        self._conn.commit()
+        self._write([("ADD_DATA", [(kernel, cell, version, source, name, self.user, exec_ct, msg_id, schema_hash, object_ref)]),
+                     ("ADD_COLS", cols)])
+
+        data_row = {"kernel" : kernel, "source" : source, "name" : name, "version" : version,
+                    "user" : self.user, "exec_ct" : exec_ct, "msg_id" : msg_id, "schema_hash" : schema_hash,
+                    "object_ref" : object_ref}
+        col_rows = [{"user" : self.user, "kernel" : kernel, "name" : name, "version" : version,
+                     "col_name" : col, "type" : col_type, "size" : size, "is_sensitive" : 0,
+                     "user_specified" : 0, "checked" : 0, "fields" : None}
+                    for _, _, _, _, col, col_type, size in cols]
+        self.catalog.add_version(kernel, data_row, col_rows)
     
+    def slowest_vars(self, kernel_id=None, limit=10, curs=None):
+        """
+        return the limit variables that took longest to snapshot over the
+        session of kernel_id, or of every kernel if it is None. each is a dict of
+        name, type, snapshots, seconds (total), max_seconds, size (largest) and skipped
+        """
+        if not curs:
+            curs = self._cursor
+        curs.execute(self.cmds["SLOWEST_VARS"], (kernel_id, kernel_id, limit))
+        return [dict(row) for row in curs.fetchall()]
+
+    def largest_vars(self, kernel_id=None, limit=10, curs=None):
+        """return the limit variables with the largest snapshots, as slowest_vars does"""
+        if not curs:
+            curs = self._cursor
+        curs.execute(self.cmds["LARGEST_VARS"], (kernel_id, kernel_id, limit))
+        return [dict(row) for row in curs.fetchall()]
+
+    def data_snapshots(self):
+        """
+        return what data versions link to, as SnapshotCompactor.run_once takes it.
+        {"protected" : {(kernel, exec_ct)} of versions recorded without a msg_id,
+         "msg_ids" : {msg_id}, "object_refs" : {(kind, hash)}}
+        while the remote database cannot be reached, what it had at the last read.
+        None if it has not been read since the server started, nothing is known
+        to be safe to remove then
+        """
+        def read():
+            self.renew_connection()
+            self._cursor.execute(self.cmds["DATA_SNAPSHOTS"], (self.user,))
+            self._snapshot_links = [dict(row) for row in self._cursor.fetchall()]
+            return self._snapshot_links
+        remote_rows = self._remote_read(read, lambda: self._snapshot_links)
+        if remote_rows is None:
+            return None
+        # versions still queued in an outbox, of every kernel, and those the catalog holds
+        queued = [{"kernel" : row[0], "exec_ct" : row[6], "msg_id" : row[7], "object_ref" : row[9]}
+                  for row in self.outbox.pending("ADD_DATA") if row[5] == self.user] if self.outbox else []
+        rows = remote_rows + queued + self.catalog.data_rows()
+        return {"protected" : {(row["kernel"], row["exec_ct"]) for row in rows if not row["msg_id"]},
+                "msg_ids" : {row["msg_id"] for row in rows if row["msg_id"]},
+                "object_refs" : {parse_ref(row["object_ref"]) for row in rows if row["object_ref"]}}
+
     def get_columns(self, kernel, df_name, version):
         """get columns from df_name"""
-        self.renew_connection()
-
-        self._cursor.execute(self.cmds["GET_ALL_COLS"], (self.user, kernel, df_name, version))
+        return self.catalog.columns(kernel, df_name, version)
 
-        return self._cursor.fetchall()
+    def max_versions(self, kernel):
+        """return {df name : most recent version} for every dataframe of kernel"""
+        return self.catalog.max_versions(kernel)
 
     def get_recent_cols(self, kernel):
         """return the columns of the most recent dataframe versions"""
-        self.renew_connection()
-        self._cursor.execute(self.cmds["GET_MAX_VERSION"], (self.user, kernel))
-        
-        max_versions = self._cursor.fetchall()
         recent_cols = []
-
-        for max_version in max_versions:
-
-            name = max_version["name"]
-            version = max_version["MAX(version)"]
-            self._cursor.execute(self.cmds["GET_VERSION_COLS"], (kernel, self.user, name, version))
-            row_values = self._cursor.fetchall()
-            values = []
-
-            for row_value in row_values:
-                # there must be a way to enforce these conversions in mysql-connector, but I
-                # can't find them.
-                value = dict(row_value) 
-                value["is_sensitive"] = bool(row_value["is_sensitive"])
-                value["user_specified"] = bool(row_value["user_specified"])
-                value["checked"] = bool(row_value["checked"])
-                values.append(value)
-
-            recent_cols.extend(values)
+        for row_value in self.catalog.recent_columns(kernel):
+            # there must be a way to enforce these conversions in mysql-connector, but I
+            # can't find them.
+            value = dict(row_value) 
+            value["is_sensitive"] = bool(row_value["is_sensitive"])
+            value["user_specified"] = bool(row_value["user_specified"])
+            value["checked"] = bool(row_value["checked"])
+            recent_cols.append(value)
         
         return recent_cols        
     def get_unmarked_columns(self, kernel):
@@ -405,48 +829,26 @@ class DbHandler:
         format is {df_name : [col_names]}
     
         """
-        self.renew_connection()
-        self._cursor.execute(self.cmds["GET_MAX_VERSION"], (self.user, kernel))
-
-        max_versions = self._cursor.fetchall()
         unmarked_cols = {}
-
-        for max_version in max_versions:
-
-            name = max_version["name"]
-            version = max_version["MAX(version)"]
-            self._cursor.execute(self.cmds["GET_UNMARKED"], (kernel, self.user, name, version))
-            results = self._cursor.fetchall()
-            
-            unmarked_cols[name] = [res["col_name"] for res in results]
+        for res in self.catalog.recent_columns(kernel):
+            if not res["checked"]:
+                unmarked_cols.setdefault(res["name"], []).append(res["col_name"])
         
-        return {df: res for df, res in unmarked_cols.items() if res}
+        return unmarked_cols
 
     def update_marked_columns(self, kernel, input_data):
         """
         update columns
         
         input_data is a dictionary mapping df_name -> {col_name : { "sensitive" : <boolean>, "user_designated" : <boolean>, "fields" : <string> }}
+        only the most recent version of each dataframe is updated
         """
-        self.renew_connection()
         query_tuples = [] 
+        max_versions = self.catalog.max_versions(kernel)
 
-        self._cursor.execute(self.cmds["GET_MAX_VERSION"], (self.user, kernel))
-        version_dict = {}
-
-        # turn it into a dictionary
-        for resp in self._cursor.fetchall():
-
-            key = (self.user, kernel, resp["name"])
-            value = resp["MAX(version)"]
-
-            if key in version_dict:
-                raise Exception("Duplicate keys {0}, {1}, {2}".format(key, value, version_dict[key]))
-            version_dict[key] = value
         for df_name, columns in input_data.items():
-               
-            # want to get the max value for each column
-            version = version_dict[(self.user, kernel, df_name)]
+            if df_name not in max_versions:
+                continue # no version recorded, there are no columns to update
             for col_name,info in columns.items():
                 is_sensitive = info["is_sensitive"]
                 user_specified = info["user_specified"]
@@ -455,26 +857,52 @@ class DbHandler:
                 if isinstance(user_specified, int):
                     user_specified = bool(user_specified) 
                 query_params = (info["fields"], is_sensitive, user_specified, True, 
-                                self.user, kernel, df_name, version, col_name)
+                                self.user, kernel, df_name, max_versions[df_name], col_name)
                 query_tuples.append(query_params)
-        self._cursor.executemany(self.cmds["UPDATE_COL_TYPES"], query_tuples)
-        self._conn.commit()
+                self.catalog.update_column(kernel, df_name, max_versions[df_name], col_name,
+                                           {"fields" : info["fields"], "is_sensitive" : is_sensitive,
+                                            "user_specified" : user_specified, "checked" : True})
+        self._write([("UPDATE_COL_TYPES", query_tuples)])
  
     def store_response(self, kernel_id, cell_id, exec_ct, response):
-        """store response in database"""
-        self.renew_connection()
+        """store response in database, in the next batch of buffered writes"""
+        self._append("STORE_RESP", (kernel_id, self.user, cell_id, json.dumps(response, cls=NpEncoder), exec_ct))
 
-        self._cursor.execute(self.cmds["STORE_RESP"], (kernel_id, self.user, cell_id, json.dumps(response, cls=NpEncoder), exec_ct))
-        self._conn.commit()
+    def flush_writes(self):
+        """
+        write the buffered rows with one executemany per command. if the
+        database cannot be reached they are kept for the next flush, returns
+        whether they were written
+        """
+        batches = self._writes.take()
+        if not batches:
+            return True
+        try:
+            self._write(batches)
+        except (sqlite3.Error, MySQLError):
+            try:
+                self._conn.rollback()
+            except (sqlite3.Error, MySQLError):
+                pass # the connection is gone, nothing was committed
+            self._writes.put_back(batches)
+            return False
+        return True
 
     def get_responses(self, kernel_id):
         """
         get responses from the database
         returns dictionary with keys of cell ids and values of a list of responses
         """
-        self.renew_connection()        
-        self._cursor.execute(self.cmds["GET_RESPS"], (kernel_id, self.user))
-        results = self._cursor.fetchall()
+        self.flush_writes()
+        def read():
+            self.renew_connection()
+            self._cursor.execute(self.cmds["GET_RESPS"], (kernel_id, self.user))
+            return list(self._cursor.fetchall())
+        results = self._remote_read(read, list)
+        if self.outbox is not None:
+            # read after the stored rows, a batch copied in between is left out rather than repeated
+            results.extend({"cell" : cell, "resp" : resp} for kernel, user, cell, resp, _ in self.outbox.pending("STORE_RESP")
+                           if kernel == kernel_id and user == self.user)
 
         responses = {}
 
@@ -486,7 +914,8 @@ class DbHandler:
 
         return responses
     def close(self):
-        """close the connection to the database"""
+        """close the connection to the database, after writing the buffered rows"""
+        self.flush_writes()
         self._cursor.close()
         self._conn.close()
 
@@ -503,71 +932,140 @@ class DbHandler:
 
         Returns: {“valueCounts”: <Series results of .valueCounts()>, 
                   “sensitivity”: <String explaining sensitivity>, 
-                  "col_name": name of queried column}
+                  "col_name": name of queried column,
+                  "sampled": whether the counts come from a row sample of a
+                             dataframe that was over the snapshot budget}
         """
         self.renew_connection()
         query_tuples = []
 
         # TODO: add some error handling
-        curr_ns = self.recent_ns()
-        dfs = load_dfs(curr_ns)
+        curr_ns = self.recent_ns(kernel_id)
+        if curr_ns is None:
+            return {"error": "no namespace stored for this kernel yet."}
 
         # find col in question
         df_name = request["df"] 
         col_name = request["col"]
 
-        if df_name not in dfs:
-            return {"error": "selected dataframe no longer exists."}
-        df_callable = dfs[df_name]
+        profile = load_profiles(curr_ns, cache=self.ns_cache).get(df_name)
+        col_profile = profile["columns"].get(col_name) if profile else None
+        if col_profile is not None and not profile["sampled"] and not is_numeric_dtype(col_profile["dtype"]):
+            # the kernel counted the top values of the whole column when it stored the frame
+            col_val_counts = pd.Series(dict(col_profile["top"]), dtype="int64")
+            sampled = False
+        else:
+            # only the requested column is read from the snapshot
+            df_callable = load_frame(curr_ns, df_name, columns=[col_name], cache=self.ns_cache)
+            if df_callable is None:
+                return {"error": "selected dataframe no longer exists."}
+
+            if col_name not in df_callable:
+                return {"error": "selected column no longer exists."}
+            col = df_callable[col_name]
+            sampled = is_sample(df_callable)
+
+            if is_numeric_dtype(col):
+                col_val_counts = col.value_counts(bins=5)
+            else:
+                col_val_counts = col.value_counts()[:5]
 
-        if col_name not in df_callable:
-            return {"error": "selected column no longer exists."}
-        col = df_callable[col_name]
+        # fields of the column in the most recent version of the dataframe
+        version = self.catalog.max_versions(kernel_id).get(df_name)
+        results = [{"fields" : col["fields"]} for col in self.catalog.columns(kernel_id, df_name, version)
+                   if col["col_name"] == col_name]
 
+        if not results:
+            return {"error": f"no record found in the table for {self.user}, {df_name}, {col_name}, {kernel_id}, version{version}"}
+        sensitivity_field = results[0]
 
-        if is_numeric_dtype(col):
-            col_val_counts = col.value_counts(bins=5)
-        else:
-            col_val_counts = col.value_counts()[:5]
+        return {"valueCounts": col_val_counts, "col_name" : col_name, "sensitivity": sensitivity_field, # how to get note text here?
+                "sampled" : sampled}
 
-        self._cursor.execute(self.cmds["GET_MAX_VERSION"], (self.user, kernel_id))
-        version_dict = {} 
+    def addTrack(self, type, description):
+        self._append("USER_TRACKING_AT", (self.user, type, description, _timestamp()))
 
-        # find max versions of all dfs
-        for resp in self._cursor.fetchall():
-            key = (self.user, kernel_id, resp["name"])
-            value = resp["MAX(version)"]
+# client errors for a connection the server closed or that was lost
+DROPPED_CONNECTION = (2006, 2013, 2055)
 
-            if key in version_dict:
-                raise Exception("Duplicate keys {")
-            version_dict[key] = value
+# statements that can be run again without changing what they did
+READ_STATEMENTS = ("SELECT", "SHOW")
 
-        version = version_dict[(self.user, kernel_id, df_name)]
-        query_params = (self.user, kernel_id, df_name, version, col_name)
-        self._cursor.execute(self.cmds["GET_FIELDS"], query_params)
-        results = self._cursor.fetchall()
+class PooledCursor:
+    """
+    buffered dictionary cursor on the pooled connection of a thread. when a
+    statement fails because the connection dropped, the connection is given
+    back to the pool. a read is run once more on a fresh pooled connection,
+    which connecting waits at most REMOTE_CONNECT_SECONDS for, writes and a
+    read that fails again raise. with an outbox the read is then answered
+    locally, see DbHandler._remote_read, and writes are queued there anyway
+    """
+    def __init__(self, handler):
+        self._handler = handler
+        self._cursor = handler._conn.cursor(buffered=True, dictionary=True)
 
-        if not results:
-            return {"error": f"no record found in the table for {self.user}, {df_name}, {col_name}, {kernel_id}, version{version}"}
-        sensitivity_field = results[0]
+    def execute(self, *args, **kwargs):
+        return self._run("execute", args, kwargs)
 
-        return {"valueCounts": col_val_counts, "col_name" : col_name, "sensitivity": sensitivity_field} # how to get note text here?
+    def executemany(self, *args, **kwargs):
+        return self._run("executemany", args, kwargs)
 
-    def addTrack(self, type, description):
-        self.renew_connection()
-        self._cursor.execute(self.cmds["USER_TRACKING"], (self.user, type, description))
-        self._conn.commit()
+    def _run(self, method, args, kwargs):
+        try:
+            return self._call(method, args, kwargs)
+        except (OperationalError, InterfaceError) as e:
+            query = args[0] if args else kwargs.get("operation", "")
+            if e.errno not in DROPPED_CONNECTION or method != "execute" or \
+                    not query.lstrip().upper().startswith(READ_STATEMENTS):
+                raise
+        self._cursor = self._handler._conn.cursor(buffered=True, dictionary=True)
+        return self._call(method, args, kwargs)
+
+    def _call(self, method, args, kwargs):
+        """run the statement, giving the connection back to the pool if it dropped"""
+        try:
+            return getattr(self._cursor, method)(*args, **kwargs)
+        except (OperationalError, InterfaceError) as e:
+            if e.errno in DROPPED_CONNECTION:
+                self._handler._drop_connection()
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
 class RemoteDbHandler(DbHandler):
-    """when we want the database to be remote"""
+    """
+    when we want the database to be remote
+
+    each thread holds its own connection from a pool, with a cursor that is
+    reused across calls, and its own connection to the local database.
+    connections are only checked after they have been idle for DB_IDLE_SECONDS,
+    and a connection that failed is given back to the pool and a fresh one
+    tried once, see PooledCursor. connecting waits at most REMOTE_CONNECT_SECONDS.
+    pool_size is the number of threads that can hold one, the pool has one more
+    for a call made off the database threads, eg. flushing writes at exit
+
+    no connection is made until a thread first needs one, so with an outbox
+    the handler starts while the remote database cannot be reached. writes are
+    queued and reads answered locally, see _remote_read, until the Replicator
+    reaches it. the remote tables are made by make_tables.sql, and those of
+    an existing database brought up to date by migrate_tables.sql, the
+    handler does not alter them
+    """
     # pylint: disable=too-many-arguments,super-init-not-called
-    def __init__(self, database, db_user, password, host, nb_user):
-        self._conn = connect(host=host, user=db_user, 
-                             password=password, database=database)
-        self._cursor = self._conn.cursor(buffered=True, dictionary=True)
+    def __init__(self, database, db_user, password, host, nb_user, pool_size=DB_POOL_SIZE, outbox=None):
+        self._pool_config = {"pool_size" : pool_size + 1, "host" : host, "user" : db_user,
+                             "password" : password, "database" : database,
+                             "connection_timeout" : REMOTE_CONNECT_SECONDS}
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.pool_size = pool_size
+        self._threads = threading.local()
         self.user = nb_user
         self.cmds = {k : v.replace("?","%s") for k, v in SQL_CMDS.items()}
         self.cmds.update(LOCAL_SQL_CMDS)
+        self.outbox = outbox
+        self._init_caches()
         self._init_local_db()
 
     def _init_local_db(self, dbname=DB_NAME, dirname=DB_DIR):
@@ -575,43 +1073,273 @@ class RemoteDbHandler(DbHandler):
 
         # print("creating local database at {0}".format(db_path_resolved+dbname))
 
+        self._local_path = db_path_resolved+dbname
         if os.path.isdir(db_path_resolved) and os.path.isfile(db_path_resolved+dbname): 
-            self._local_conn = sqlite3.connect(db_path_resolved+dbname, 
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-            self._local_conn.row_factory = sqlite3.Row
-            self._local_cursor = self._local_conn.cursor()
+            update_ns_table(self._local_conn)
         else:
             if not os.path.isdir(db_path_resolved):
                os.mkdir(db_path_resolved)
-            self._local_conn = sqlite3.connect(db_path_resolved+dbname, 
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-            self._local_conn.row_factory = sqlite3.Row
-            self._local_cursor = self._local_conn.cursor()
+            self._local_cursor.execute(self.cmds["INCREMENTAL_VACUUM"])
             self._local_cursor.execute(self.cmds["MAKE_NS_TABLE"])
+            self._local_cursor.execute(self.cmds["MAKE_OBJECTS_TABLE"])
+            self._local_cursor.executescript(self.cmds["MAKE_NS_INDEXES"])
+            self._local_cursor.executescript(self.cmds["MAKE_SNAPSHOT_VARS_TABLE"])
 
     def recover_ns(self, msg_id, curs=None):
         return super().recover_ns(msg_id, curs=self._local_cursor)
-    def recent_ns(self, curs=None):
-        return super().recent_ns(curs=self._local_cursor)
-    def link_cell_to_ns(self, exec_ct, contents, cell_time,curs=None):
-        return super().link_cell_to_ns(exec_ct, contents, cell_time, curs=self._local_cursor)
+    def recent_ns(self, kernel_id=None, curs=None):
+        return super().recent_ns(kernel_id, curs=self._local_cursor)
+    def exec_ns(self, kernel_id, exec_ct, curs=None):
+        return super().exec_ns(kernel_id, exec_ct, curs=self._local_cursor)
+    def msg_ns(self, msg_id, curs=None):
+        return super().msg_ns(msg_id, curs=self._local_cursor)
+    def find_ns(self, exec_ct, kernel_id=None, curs=None, msg_id=None):
+        return super().find_ns(exec_ct, kernel_id, curs=self._local_cursor, msg_id=msg_id)
+    def link_cell_to_ns(self, exec_ct, contents, cell_time,curs=None, msg_id=None):
+        return super().link_cell_to_ns(exec_ct, contents, cell_time, curs=self._local_cursor, msg_id=msg_id)
     def get_dataframe_version(self, data, version, curs=None):
         return super().get_dataframe_version(data, version, cursor=self._local_cursor)
+    def slowest_vars(self, kernel_id=None, limit=10, curs=None):
+        return super().slowest_vars(kernel_id, limit, curs=self._local_cursor)
+    def largest_vars(self, kernel_id=None, limit=10, curs=None):
+        return super().largest_vars(kernel_id, limit, curs=self._local_cursor)
+
+    @property
+    def _conn(self):
+        """the pooled connection of this thread"""
+        if getattr(self._threads, "conn", None) is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = MySQLConnectionPool(**self._pool_config)
+            self._threads.conn = self._pool.get_connection()
+            self._threads.cursor = None
+            self._threads.used = time.monotonic()
+        return self._threads.conn
+
+    @property
+    def _cursor(self):
+        """the cursor of this thread, reused until its connection is renewed"""
+        if getattr(self._threads, "cursor", None) is None:
+            self._threads.cursor = PooledCursor(self)
+        return self._threads.cursor
+
+    def _connect_local(self):
+        """connect this thread to the local database, sqlite connections cannot be shared between threads"""
+        if getattr(self._threads, "local_conn", None) is None:
+            self._threads.local_conn = sqlite3.connect(self._local_path,
+                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            self._threads.local_conn.row_factory = sqlite3.Row
+            self._threads.local_cursor = self._threads.local_conn.cursor()
+        return self._threads
+
+    @property
+    def _local_conn(self):
+        """the connection to the local database of this thread"""
+        return self._connect_local().local_conn
+
+    @property
+    def _local_cursor(self):
+        """the cursor on the local database of this thread"""
+        return self._connect_local().local_cursor
 
     def renew_connection(self):
+        """
+        make sure the connection of this thread is alive, if it has not been
+        used for DB_IDLE_SECONDS. one that does not answer a ping is given back
+        to the pool and a fresh one taken, which the pool reconnects before
+        handing it out. False if that cannot be done either
+        """
+        try:
+            conn = self._conn
+        except MySQLError:
+            return False
+        now = time.monotonic()
+        if now - self._threads.used > DB_IDLE_SECONDS:
+            try:
+                conn.ping()
+            except MySQLError:
+                self._drop_connection()
+                try:
+                    self._conn # pylint: disable=pointless-statement
+                except MySQLError:
+                    return False
+            self._threads.cursor = None
+        self._threads.used = now
+        return True
+
+    def _drop_connection(self):
+        """give the connection of this thread back to the pool, its next call takes one again"""
+        conn = self._threads.conn
+        self._threads.conn = self._threads.cursor = None
+        try:
+            conn.close()
+        except MySQLError:
+            pass # the session could not be reset, the connection is back in the pool all the same
 
-        if not self._conn.is_connected():
-            self._conn.reconnect(attempts=2, delay=1)
+    def close(self):
+        """write the buffered rows and return the connection of this thread to the pool"""
+        self.flush_writes()
+        if getattr(self._threads, "conn", None) is not None:
+            self._drop_connection()
 
-        if self._conn.is_connected():
-            self._cursor = self._conn.cursor(buffered=True, dictionary=True)
-            return True
-        return False
+def _timestamp():
+    """the current time, as rows written later record when they were added"""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def load_dfs(ns):
-    """take namespace and load dataframe objects from reserved variable name"""
-    ns_dict = dill.loads(ns["namespace"])
-    return {k : dill.loads(v) for k,v in ns_dict["_forking_kernel_dfs"].items()}
+def update_ns_table(conn):
+    """
+    bring a local database made by an older version up to date, adding the
+    objects and snapshot_vars tables, and the kernel column of the namespaces
+    table with the indexes on it
+    """
+    conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+    conn.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+    conn.commit()
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(namespaces)")]
+    if not columns:
+        return # the table has not been made yet
+    if "kernel" not in columns:
+        conn.execute(LOCAL_SQL_CMDS["ADD_NS_KERNEL"])
+    conn.executescript(LOCAL_SQL_CMDS["MAKE_NS_INDEXES"])
+    conn.commit()
+
+def _manifest(ns, cache=None):
+    """
+    the stored namespace dictionary of the namespace row, decoded once per
+    msg_id if there is a cache
+    """
+    msg_id = ns["msg_id"] if cache is not None and "msg_id" in ns.keys() else None
+    if msg_id is None:
+        return dill.loads(ns["namespace"])
+    return cache.get(("manifest", msg_id), lambda: dill.loads(ns["namespace"]), len(ns["namespace"]))
+
+def format_ref(ref):
+    """the (kind, hash) object reference as the text data.object_ref stores"""
+    return "{0}:{1}".format(*ref)
+
+def parse_ref(text):
+    """the (kind, hash) object reference stored as text by format_ref"""
+    kind, digest = text.split(":", 1)
+    return (kind, digest)
+
+def _load_object(store, stored, cache=None):
+    """load the object for a manifest entry, once per stored object if there is a cache"""
+    if cache is None or isinstance(stored, bytes): # pickled inline, nothing to key it by
+        return store.load(stored)
+    return cache.get(("object", stored), lambda: store.load(stored))
+
+class LazyFrames(Mapping):
+    """
+    read-only {df name : dataframe} of a stored namespace. each dataframe is
+    loaded the first time it is looked up, so callers that need one of them
+    do not load the rest
+    """
+    def __init__(self, stored, store, cache=None):
+        self._stored = stored # df name -> manifest entry
+        self._store = store
+        self._cache = cache
+        self._loaded = {}
+
+    def ref(self, df_name):
+        """
+        the object store reference of df_name, None if it was pickled into
+        the namespace itself
+        """
+        stored = self._stored.get(df_name)
+        return stored if isinstance(stored, tuple) else None
+
+    def sampled(self, df_name):
+        """
+        is df_name a row sample standing in for a dataframe that was over the
+        snapshot budget? frames stored column-wise are told without loading them
+        """
+        stored = self._stored[df_name]
+        if isinstance(stored, bytes):
+            return False # pickled into a namespace from before snapshot budgets
+        frame = self._store.frame(stored)
+        if frame is not None:
+            return SAMPLE_ATTR in frame.attrs
+        return is_sample(self[df_name])
+
+    def without_samples(self):
+        """a LazyFrames of the dataframes that were stored whole"""
+        full = LazyFrames({name : stored for name, stored in self._stored.items() if not self.sampled(name)},
+                          self._store, self._cache)
+        full._loaded = {name : df for name, df in self._loaded.items() if name in full._stored}
+        return full
+
+    def __getitem__(self, df_name):
+        if df_name not in self._loaded:
+            self._loaded[df_name] = _load_object(self._store, self._stored[df_name], self._cache)
+        return self._loaded[df_name]
+
+    def __contains__(self, df_name):
+        return df_name in self._stored # without loading it
+
+    def __iter__(self):
+        return iter(self._stored)
+
+    def __len__(self):
+        return len(self._stored)
+
+    def __repr__(self):
+        return "LazyFrames({0})".format(list(self._stored))
+
+def load_dfs(ns, store=None, cache=None):
+    """
+    take namespace and return a LazyFrames of the dataframe objects from reserved
+    variable name. objects from a NamespaceCache are shared, and must not be modified
+    """
+    ns_dict = _manifest(ns, cache)
+    if store is None:
+        store = ObjectStore()
+    return LazyFrames(ns_dict[DFS_KEY], store, cache)
+
+def load_profiles(ns, cache=None):
+    """
+    take namespace and return the column profiles of its dataframes,
+    {df name : profile}. empty for namespaces stored without profiles
+    """
+    return _manifest(ns, cache).get(PROFILES_KEY, {})
+
+def load_frame(ns, df_name, columns=None, store=None, cache=None):
+    """
+    load dataframe df_name from the namespace, or only the listed columns of it.
+    columns the dataframe does not have are skipped, returns None if there is
+    no such dataframe
+    """
+    # pylint: disable=too-many-arguments
+    stored = _manifest(ns, cache)[DFS_KEY].get(df_name)
+    if stored is None:
+        return None
+    if store is None:
+        store = ObjectStore()
+
+    frame = store.frame(stored)
+    if frame is None or columns is None: # pickled frames have to be loaded whole
+        df = _load_object(store, stored, cache)
+        if columns is None:
+            return df
+        return df[[c for c in columns if c in df.columns]]
+
+    cached = cache.peek(("object", stored)) if cache else None
+    columns = [c for c in columns if c in frame.columns]
+    if cached is not None:
+        return cached[columns]
+    return frame.to_frame(columns)
+
+def load_ns(ns, store=None, cache=None):
+    """
+    take namespace and load the objects that are not dataframes.
+    objects from a NamespaceCache are shared, and must not be modified
+    """
+    ns_dict = _manifest(ns, cache)
+    if OBJS_KEY not in ns_dict:
+        # stored before delta snapshots, objects are not pickled separately
+        return {k : v for k, v in ns_dict.items() if k != DFS_KEY}
+    if store is None:
+        store = ObjectStore()
+    return {k : _load_object(store, v, cache) for k,v in ns_dict[OBJS_KEY].items()}
 
 def clean_json(d, prefixes):
     """
@@ -689,6 +1417,8 @@ class NpEncoder(json.JSONEncoder):
             return int(obj)
         if isinstance(obj, np.floating):
             return float(obj)
+        if isinstance(obj, np.bool_):
+            return bool(obj)
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         if isinstance(obj, pd.Series):
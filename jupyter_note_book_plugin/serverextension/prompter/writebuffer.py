@@ -0,0 +1,64 @@
+"""
+writebuffer.py holds the rows of append-only inserts, eg. stored note
+responses and user tracking events, so DbHandler can write them in batches
+with executemany instead of committing each on the request path.
+"""
+import threading
+import time
+
+from .config import WRITE_BATCH_ROWS, WRITE_FLUSH_SECONDS
+
+class WriteBuffer:
+    """
+    rows waiting to be inserted, grouped by the command that inserts them.
+    a batch is due once it has max_rows rows, or its oldest row has waited
+    max_seconds
+    """
+    def __init__(self, max_rows=WRITE_BATCH_ROWS, max_seconds=WRITE_FLUSH_SECONDS):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self._rows = {} # cmd name -> [params], in the order they were added
+        self._count = 0
+        self._since = None # when the oldest buffered row was added
+        self._lock = threading.Lock()
+
+    def add(self, cmd, params):
+        """buffer a row for cmd, return whether the buffer should be written"""
+        with self._lock:
+            self._rows.setdefault(cmd, []).append(params)
+            self._count += 1
+            if self._since is None:
+                self._since = time.monotonic()
+        return self.due()
+
+    def due(self):
+        """whether the buffered rows should be written"""
+        with self._lock:
+            if not self._count:
+                return False
+            return self._count >= self.max_rows or time.monotonic() - self._since >= self.max_seconds
+
+    def take(self):
+        """remove and return the buffered rows, [(cmd name, [params])]"""
+        with self._lock:
+            batches = list(self._rows.items())
+            self._rows = {}
+            self._count = 0
+            self._since = None
+        return batches
+
+    def put_back(self, batches):
+        """return rows from take that could not be written, ahead of any added since"""
+        with self._lock:
+            rows = {}
+            for cmd, params in batches:
+                rows.setdefault(cmd, []).extend(params)
+                self._count += len(params)
+            for cmd, params in self._rows.items():
+                rows.setdefault(cmd, []).extend(params)
+            self._rows = rows
+            if self._count and self._since is None:
+                self._since = time.monotonic()
+
+    def __len__(self):
+        return self._count
@@ -4,6 +4,8 @@
 DROP DATABASE IF EXISTS test_jupyter;
 CREATE DATABASE test_jupyter;
 
+-- the tests make the tables from prompter/make_tables.sql as prompter_tester.
+-- test_user, like the server, only reads and writes rows, it does not alter tables
 CREATE USER IF NOT EXISTS 'test_user'@'localhost' IDENTIFIED BY 'test';
 GRANT INSERT, SELECT, UPDATE ON test_jupyter.* TO 'test_user'@'localhost';
 
@@ -2,12 +2,83 @@
 test the analysis methods
 """
 
+import asyncio
 import unittest
+import unittest.mock
 
 from unittest.mock import Mock, MagicMock
 from jupyter_client.manager import start_new_kernel
 from ast import parse, Call, Assign, Slice, Name, Attribute, Subscript
 from context import prompter
+from prompter.asyncdb import AsyncDbHandler
+
+class TestSnapshotChoice(unittest.TestCase):
+    """the namespace cell_exec analyzes"""
+
+    def setUp(self):
+        self.db = Mock()
+        self.db.msg_ns.return_value = None
+        self.db.recent_ns.return_value = None
+        self.env = prompter.AnalysisEnvironment(Mock(), "TEST", self.db)
+
+    def test_of_execution(self):
+        self.env.cell_exec("df = pd.read_csv('data.csv')", "TEST", "TESTCELL", 3, "msg-3")
+        self.db.msg_ns.assert_called_once_with("msg-3")
+        self.db.recent_ns.assert_not_called() # its dataframes are not those of this execution
+        self.db.check_add_data.assert_not_called()
+
+    def test_most_recent(self):
+        self.env.cell_exec("df = pd.read_csv('data.csv')", "TEST", "TESTCELL", 3)
+        self.db.recent_ns.assert_called_once_with("TEST")
+
+class TestCoalescedBurst(unittest.TestCase):
+    """executions coalesced during run all are analyzed with the snapshot at the end of their burst"""
+
+    def setUp(self):
+        self.db = Mock()
+        self.async_db = AsyncDbHandler(self.db, workers=2)
+        self.manager = prompter.AnalysisManager(Mock(), Mock(getDb=Mock(return_value=self.db),
+                                                             getAsyncDb=Mock(return_value=self.async_db)))
+        self.manager.note_manager = Mock()
+        self.env = Mock()
+        self.manager.analyses["kernel-a"] = self.env
+
+    def _execute(self, exec_ct):
+        return asyncio.run(self.manager.handle_execution({"kernel" : "kernel-a", "cell_id" : "cell-{0}".format(exec_ct),
+                                                          "contents" : "x = {0}".format(exec_ct), "metadata" : "{}",
+                                                          "exec_ct" : exec_ct, "msg_id" : "msg-{0}".format(exec_ct)}))
+
+    def test_burst(self):
+        snapshot = {"msg_id" : "msg-3", "namespace" : b""}
+        # placeholders are answered right away, without waiting out SNAPSHOT_WAIT
+        self.db.find_ns.side_effect = [{"msg_id" : "msg-1", "namespace" : None},
+                                       {"msg_id" : "msg-2", "namespace" : None}, snapshot]
+        with unittest.mock.patch("prompter.managers.analysis.load_dfs"), \
+             unittest.mock.patch("prompter.managers.analysis.load_ns"):
+            self.assertEqual(self._execute(1), {"kernel_id" : "kernel-a"})
+            self.assertEqual(self._execute(2), {"kernel_id" : "kernel-a"})
+            self.env.cell_exec.assert_not_called() # nothing to analyze until the burst is stored
+            self._execute(3)
+
+        self.assertEqual([c.args[2:] for c in self.env.cell_exec.call_args_list],
+                         [("cell-1", 1, None, snapshot), ("cell-2", 2, None, snapshot),
+                          ("cell-3", 3, "msg-3", snapshot)])
+        self.assertEqual([c.kwargs.get("coalesced", False) for c in self.env.cell_exec.call_args_list],
+                         [True, True, False])
+
+    def test_request_after_burst(self):
+        # the snapshot at the end of the burst was stored before the request of a coalesced execution came
+        snapshot = {"msg_id" : "msg-3", "namespace" : b""}
+        self.db.find_ns.return_value = snapshot
+        with unittest.mock.patch("prompter.managers.analysis.load_dfs"), \
+             unittest.mock.patch("prompter.managers.analysis.load_ns"):
+            self._execute(2)
+
+        self.assertEqual(self.env.cell_exec.call_args.args[2:], ("cell-2", 2, None, snapshot))
+        self.assertTrue(self.env.cell_exec.call_args.kwargs["coalesced"])
+
+    def tearDown(self):
+        self.async_db.close()
 
 class TestAnalysisMethods(unittest.TestCase):
     """
@@ -0,0 +1,62 @@
+"""
+test the column-wise DataFrame store
+"""
+
+import unittest
+import shutil
+import numpy as np
+import pandas as pd
+
+from context import prompter
+from prompter.frames import FrameStore
+
+class TestFrameStore(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./framestest/"
+        self.store = FrameStore(self.TEST_DIR)
+        self.df = pd.DataFrame({"gender" : ["M", "F", "M", "F", "F"],
+                                "age" : [26, 57, 49, 20, 30],
+                                "grade" : [.9, .8, .7, .6, np.nan],
+                                "group" : pd.Categorical(["a", "b", "a", "a", "b"]),
+                                "seen" : pd.to_datetime(["2021-01-01"]*5)},
+                               index=[10, 11, 12, 13, 14])
+
+    def test_roundtrip(self):
+        token = self.store.write(self.df)
+        pd.testing.assert_frame_equal(self.store.read(token).to_frame(), self.df)
+
+    def test_range_index(self):
+        df = self.df.reset_index(drop=True)
+        token = self.store.write(df)
+        pd.testing.assert_frame_equal(self.store.read(token).to_frame(), df)
+
+    def test_timezone(self):
+        df = pd.DataFrame({"seen" : pd.to_datetime(["2021-01-01 10:00"]*2).tz_localize("UTC"),
+                           "local" : pd.to_datetime(["2021-01-01 10:00"]*2).tz_localize("US/Central")})
+        frame = self.store.read(self.store.write(df))
+        pd.testing.assert_frame_equal(frame.to_frame(), df)
+        self.assertEqual(str(frame.column("local").dtype), str(df["local"].dtype))
+
+    def test_empty(self):
+        df = pd.DataFrame({"age" : pd.Series([], dtype="int64")})
+        token = self.store.write(df)
+        pd.testing.assert_frame_equal(self.store.read(token).to_frame(), df)
+
+    def test_single_column(self):
+        frame = self.store.read(self.store.write(self.df))
+
+        self.assertEqual(list(frame.columns), list(self.df.columns))
+        self.assertEqual(len(frame), 5)
+        pd.testing.assert_series_equal(frame.column("age"), self.df["age"])
+        pd.testing.assert_frame_equal(frame.to_frame(["grade", "gender"]), self.df[["grade", "gender"]])
+
+    def test_numeric_mapped(self):
+        frame = self.store.read(self.store.write(self.df))
+        self.assertIsInstance(frame._values(frame._position("age")).base, np.memmap)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,257 @@
+"""
+test the outbox of writes and their replication to the remote database
+"""
+
+import os
+import sqlite3
+import unittest
+import unittest.mock
+
+import mysql.connector
+
+from context import prompter
+from prompter.outbox import Outbox, Replicator, REPLICA_CMDS
+from prompter.storage import LOCAL_SQL_CMDS
+
+class RemoteConnection:
+    """stands in for a connection to the remote database, keeps what was committed"""
+    def __init__(self, last_id=None):
+        self.last_id = last_id
+        self.committed = []
+        self.statements = []
+        self.down = False
+        self.rejected = None # params of a row the remote database refuses
+        self.missing = None # a column its tables do not have yet
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        if self.down:
+            raise mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013)
+        if query == REPLICA_CMDS["SET_REPLICATED"]:
+            self.statements.append(("last_id", params[1]))
+        elif query != REPLICA_CMDS["LAST_REPLICATED"]:
+            self.executemany(query, [params])
+
+    def executemany(self, query, rows):
+        if self.missing is not None and self.missing in query:
+            raise mysql.connector.errors.ProgrammingError(msg="Unknown column '{0}'".format(self.missing), errno=1054)
+        if self.rejected in rows:
+            raise mysql.connector.errors.IntegrityError(msg="Duplicate entry", errno=1062)
+        self.statements.append((query, list(rows)))
+
+    def fetchall(self):
+        return [(self.last_id,)] if self.last_id is not None else []
+
+    def ping(self):
+        if self.down:
+            raise mysql.connector.errors.InterfaceError(msg="Can't connect", errno=2003)
+
+    def commit(self):
+        for statement in self.statements:
+            if statement[0] == "last_id":
+                self.last_id = statement[1]
+            else:
+                self.committed.append(statement)
+        self.statements = []
+
+    def rollback(self):
+        self.statements = []
+
+    def close(self):
+        pass
+
+class SqliteRemote:
+    """the study tables of the remote database in sqlite, for statements whose outcome matters"""
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.create_function("GREATEST", 2, max)
+        self.conn.executescript(LOCAL_SQL_CMDS["MAKE_STUDY_TABLES"])
+        self.conn.execute("CREATE TABLE replicated(source TEXT PRIMARY KEY, last_id INT NOT NULL)") # as in make_tables.sql
+        self._cursor = None
+        self.rowcount = -1
+
+    def cursor(self):
+        return self
+
+    def _run(self, method, query, params):
+        if query == REPLICA_CMDS["SET_REPLICATED"]:
+            query = "INSERT OR REPLACE INTO replicated(source, last_id) VALUES (%s, %s)"
+        query = query.replace(" FOR UPDATE", "").replace("%s", "?")
+        try:
+            self._cursor = getattr(self.conn, method)(query, params)
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.errors.IntegrityError(msg=str(e), errno=1062)
+        self.rowcount = self._cursor.rowcount
+
+    def execute(self, query, params=()):
+        self._run("execute", query, params)
+
+    def executemany(self, query, rows):
+        self._run("executemany", query, rows)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        pass
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "./outboxtest.db"
+        self.outbox = Outbox(self.path)
+        self.remote = RemoteConnection()
+        self.replicator = Replicator(self.outbox, lambda: self.remote, batch_rows=3)
+
+    def test_queue(self):
+        self.outbox.put([("STORE_RESP", [("kernel-a", "user", "cell-1", "{}", 1), ("kernel-a", "user", "cell-2", "{}", 2)]),
+                         ("USER_TRACKING_AT", [("user", "START", "started", "2021-01-01 00:00:00")])])
+        self.assertEqual(len(self.outbox), 3)
+        self.assertEqual([row[1] for row in self.outbox.peek(2)], ["STORE_RESP", "STORE_RESP"])
+        self.assertEqual(self.outbox.pending("STORE_RESP")[1], ("kernel-a", "user", "cell-2", "{}", 2))
+
+        source = self.outbox.source
+        self.outbox.close()
+        self.outbox = Outbox(self.path)
+        self.assertEqual((self.outbox.source, len(self.outbox)), (source, 3)) # kept across restarts
+
+    def test_pending(self):
+        rows = [("kernel-a", "user", "cell-1", "{}", n) for n in range(4)]
+        self.outbox.put([("STORE_RESP", rows[:2])])
+        self.assertEqual(self.outbox.pending("STORE_RESP"), rows[:2])
+        self.outbox.put([("STORE_RESP", rows[2:]), ("USER_TRACKING_AT", [("user", "START", "started", "2021-01-01 00:00:00")])])
+        self.assertEqual(self.outbox.pending("STORE_RESP"), rows) # queued after it was first read
+        self.outbox.hold([(2, "Duplicate entry")])
+        self.assertEqual(self.replicator.drain(), 3)
+        self.assertEqual(self.outbox.pending("STORE_RESP"), [rows[1]]) # held
+        self.assertEqual(len(self.outbox.pending("USER_TRACKING_AT")), 1) # not copied yet
+        self.outbox.release(2)
+        self.assertTrue(self.replicator.drain_all())
+        self.assertEqual(self.outbox.pending("STORE_RESP"), [])
+        self.assertEqual(self.outbox.pending("USER_TRACKING_AT"), [])
+
+        self.outbox.put([("STORE_RESP", rows[:1])])
+        self.outbox.hold([(6, "Duplicate entry")])
+        self.outbox.close()
+        self.outbox = Outbox(self.path)
+        self.outbox.remove(6)
+        self.assertEqual(self.outbox.pending("STORE_RESP"), rows[:1]) # still held after a restart
+
+    def test_replicate(self):
+        self.outbox.put([("STORE_RESP", [("kernel-a", "user", "cell-1", "{}", n) for n in range(4)]),
+                         ("USER_TRACKING_AT", [("user", "START", "started", "2021-01-01 00:00:00")])])
+        self.assertTrue(self.replicator.drain_all())
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual([(query, len(rows)) for query, rows in self.remote.committed],
+                         [(REPLICA_CMDS["STORE_RESP"], 3), (REPLICA_CMDS["STORE_RESP"], 1),
+                          (REPLICA_CMDS["USER_TRACKING_AT"], 1)])
+        self.assertEqual(self.remote.last_id, 5)
+
+    def test_unreachable(self):
+        self.outbox.put([("USER_TRACKING_AT", [("user", "START", "started", "2021-01-01 00:00:00")])])
+        self.remote.down = True
+        self.assertIsNone(self.replicator.drain())
+        self.assertEqual(len(self.outbox), 1) # kept for the next attempt
+        self.remote.down = False
+        self.assertEqual(self.replicator.drain(), 1)
+        self.assertEqual(len(self.remote.committed), 1)
+
+    def test_pinged_when_empty(self):
+        self.assertEqual(self.replicator.drain(), 0)
+        self.remote.down = True
+        self.assertIsNone(self.replicator.drain()) # reported unreachable with nothing to copy
+        self.assertFalse(self.replicator.drain_all())
+
+    def test_sent_again(self):
+        # the rows reached the remote database, but the server exited before removing them
+        self.outbox.put([("STORE_RESP", [("kernel-a", "user", "cell-1", "{}", n) for n in range(3)])])
+        self.remote.last_id = 2
+        self.assertEqual(self.replicator.drain(), 3)
+        self.assertEqual(self.remote.committed, [(REPLICA_CMDS["STORE_RESP"], [("kernel-a", "user", "cell-1", "{}", 2)])])
+        self.assertEqual(self.remote.last_id, 3)
+
+    def test_versions_renumbered(self):
+        version = ("user", "kernel-a", "cell-1", 1, "2021-01-01 00:00:00", "x = 1", 1, "msg-1")
+        self.outbox.put([("INSERT_VERSIONS", [version])])
+        self.assertEqual(self.replicator.drain(), 1)
+        # numbered after the latest version of the cell the remote database has
+        self.assertEqual(self.remote.committed, [(REPLICA_CMDS["INSERT_VERSIONS"], [version + ("cell-1",)])])
+
+    def test_kernel_restarted(self):
+        # the restarted kernel numbers the versions of the same cell id from 1 again
+        remote = SqliteRemote()
+        self.replicator = Replicator(self.outbox, lambda: remote, batch_rows=3)
+        self.outbox.put([("INSERT_VERSIONS", [("user", "kernel-a", "cell-1", 1, "2021-01-01 00:00:00", "x = 1", 1, "a-1"),
+                                              ("user", "kernel-a", "cell-1", 2, "2021-01-01 00:00:01", "x = 2", 2, "a-2")])])
+        self.assertEqual(self.replicator.drain(), 2)
+        self.outbox.put([("INSERT_VERSIONS", [("user", "kernel-b", "cell-1", 1, "2021-01-01 00:01:00", "x = 3", 1, "b-1")])])
+        self.assertEqual(self.replicator.drain(), 1)
+        self.assertEqual(len(self.outbox), 0)
+        versions = remote.conn.execute("SELECT kernel, version, contents FROM versions ORDER BY version").fetchall()
+        self.assertEqual(versions, [("kernel-a", 1, "x = 1"), ("kernel-a", 2, "x = 2"), ("kernel-b", 3, "x = 3")])
+
+    def test_rejected_row_held(self):
+        self.replicator.log = unittest.mock.Mock()
+        rows = [("kernel-a", "user", "cell-1", "{}", n) for n in range(3)]
+        self.outbox.put([("STORE_RESP", rows)])
+        self.remote.rejected = rows[1]
+        self.assertEqual(self.replicator.drain(), 3) # not retried forever
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(self.remote.committed, [(REPLICA_CMDS["STORE_RESP"], [rows[0]]),
+                                                 (REPLICA_CMDS["STORE_RESP"], [rows[2]])])
+        self.assertEqual(self.remote.last_id, 3)
+        self.replicator.log.error.assert_called_once()
+
+        held = self.outbox.held()
+        self.assertEqual([row[:3] for row in held], [(2, "STORE_RESP", rows[1])])
+        self.assertIn("Duplicate entry", held[0][3])
+        self.assertEqual(self.outbox.pending("STORE_RESP"), rows[1:2]) # still answered locally
+        self.remote.rejected = None
+        self.outbox.release(2)
+        self.assertEqual(self.replicator.drain(), 1)
+        self.assertEqual(self.outbox.held(), [])
+
+    def test_conflicting_version_held(self):
+        # a data version the remote database has already, eg. numbered while it could not be read
+        remote = SqliteRemote()
+        self.replicator = Replicator(self.outbox, lambda: remote, batch_rows=3)
+        data = ("kernel-a", "cell", 1, "test.csv", "df", "user", 1, "a-1", None, None)
+        self.outbox.put([("ADD_DATA", [data]), ("ADD_COLS", [("user", "kernel-a", "df", 1, "age", "int64", 2)])])
+        self.assertEqual(self.replicator.drain(), 2)
+        self.outbox.put([("ADD_DATA", [data[:6] + (2, "a-2", None, None)]),
+                         ("ADD_COLS", [("user", "kernel-a", "df", 1, "sex", "object", 2)])])
+        self.assertEqual(self.replicator.drain(), 2)
+
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual([(cmd, params[2]) for _, cmd, params, _ in self.outbox.held()], [("ADD_DATA", 1)])
+        cols = remote.conn.execute("SELECT col_name FROM columns ORDER BY col_name").fetchall()
+        self.assertEqual(cols, [("age",), ("sex",)])
+
+    def test_old_remote_tables(self):
+        # make_tables.sql made the remote tables before data had a msg_id, migrate_tables.sql was not run
+        self.replicator.log = unittest.mock.Mock()
+        self.replicator.report = unittest.mock.Mock()
+        self.outbox.put([("ADD_DATA", [("kernel-a", "cell", 1, "test.csv", "df", "user", 1, "a-1", None, None)])])
+        self.remote.missing = "msg_id"
+        self.replicator._run() # stops rather than retrying
+        self.assertEqual(self.replicator.schema_error.errno, 1054)
+        self.replicator.log.critical.assert_called_once()
+        self.replicator.report.assert_not_called() # not an outage
+        self.assertEqual(len(self.outbox), 1)
+        self.assertFalse(self.replicator.drain_all())
+        self.assertEqual(self.remote.committed, [])
+
+    def tearDown(self):
+        self.outbox.close()
+        os.remove(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
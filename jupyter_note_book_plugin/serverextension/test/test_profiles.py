@@ -0,0 +1,50 @@
+"""
+test the column profiles stored with snapshots
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+
+from context import prompter
+from prompter.profiles import profile_frame, schema_fingerprint, columns_fingerprint, col_info
+
+class TestProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({"age" : [26, 57, 49, 26, None],
+                                "race" : ["a", "b", "a", "a", "c"]})
+
+    def test_profile(self):
+        profile = profile_frame(self.df)
+        self.assertEqual(profile["nrows"], 5)
+        self.assertFalse(profile["sampled"])
+
+        age = profile["columns"]["age"]
+        self.assertEqual((age["dtype"], age["length"], age["nulls"], age["distinct"]), ("float64", 5, 1, 3))
+        self.assertEqual(profile["columns"]["race"]["top"][0], ("a", 3))
+
+        self.assertEqual(col_info(profile)["race"], {"size" : 5, "type" : str(self.df["race"].dtype)})
+
+    def test_schema_fingerprint(self):
+        fingerprint = schema_fingerprint(self.df)
+        self.assertEqual(fingerprint, schema_fingerprint(self.df.iloc[:2]))
+        self.assertNotEqual(fingerprint, schema_fingerprint(self.df[["race", "age"]]))
+        self.assertNotEqual(fingerprint, schema_fingerprint(self.df.astype({"age" : "float32"})))
+
+    def test_columns_fingerprint(self):
+        columns = {"age" : {"type" : "float64", "size" : 5}, "race" : {"type" : "object", "size" : 5}}
+        fingerprint = columns_fingerprint(columns)
+        self.assertEqual(fingerprint, columns_fingerprint(dict(reversed(list(columns.items())))))
+        self.assertNotEqual(fingerprint, columns_fingerprint({"age" : columns["age"]}))
+
+    def test_sampled(self):
+        df = pd.DataFrame({"id" : np.arange(200000), "group" : np.arange(200000) % 4})
+        profile = profile_frame(df, sample_rows=10000)
+        self.assertTrue(profile["sampled"])
+        self.assertEqual(profile["columns"]["group"]["distinct"], 4)
+        self.assertAlmostEqual(profile["columns"]["id"]["distinct"], 200000, delta=200000 * 0.15)
+        self.assertAlmostEqual(profile["columns"]["group"]["top"][0][1], 50000, delta=5000)
+
+if __name__ == "__main__":
+    unittest.main()
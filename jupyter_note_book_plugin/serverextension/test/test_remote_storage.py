@@ -3,10 +3,12 @@ test the remote db handler
 """
 
 import unittest
+import unittest.mock
 import mysql.connector
 import os
 
 from context import prompter 
+from prompter.storage import PooledCursor
 from test_storage import TestDBMethods
 
 class TestRemoteDB(TestDBMethods):
@@ -59,5 +61,95 @@ class TestRemoteDB(TestDBMethods):
         tables = self.cursor.fetchall()
         self.assertEqual(len(tables), 5, "found tables {0}".format(tables))
 
+    def test_migrate(self):
+        # tables made by make_tables.sql before versions and data recorded msg_ids and the outbox was replicated
+        self.cursor.execute("DROP TABLE IF EXISTS columns;")
+        self.cursor.execute("DROP TABLE IF EXISTS data;")
+        self.cursor.execute("DROP TABLE IF EXISTS versions;")
+        self.cursor.execute("DROP TABLE IF EXISTS replicated;")
+        self.cursor.execute("""CREATE TABLE versions(user TEXT, kernel VARCHAR(36), id VARCHAR(255), version INT,
+                               time TIMESTAMP, contents TEXT, exec_ct INT, PRIMARY KEY(id, version));""")
+        self.cursor.execute("""CREATE TABLE data(user VARCHAR(64) NOT NULL, kernel VARCHAR(36) NOT NULL, cell TEXT,
+                               version INT NOT NULL, source VARCHAR(255), name VARCHAR(160) binary NOT NULL,
+                               exec_ct INT, PRIMARY KEY(user, kernel, name, version));""")
+        for _ in range(2): # a database already brought up to date is left as it is
+            for q in prompter.migrate_query.split(";"):
+                self.cursor.execute(q)
+            self.conn.commit()
+
+        self.cursor.execute("""SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS
+                               WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME IN ('msg_id', 'schema_hash', 'object_ref')
+                               ORDER BY TABLE_NAME, COLUMN_NAME""")
+        self.assertEqual([(row["TABLE_NAME"], row["COLUMN_NAME"]) for row in self.cursor.fetchall()],
+                         [("data", "msg_id"), ("data", "object_ref"), ("data", "schema_hash"), ("versions", "msg_id")])
+        self.cursor.execute("SHOW INDEX FROM data WHERE Key_name = 'data_schema'")
+        self.assertEqual(len(self.cursor.fetchall()), 4)
+        self.cursor.execute("SELECT COUNT(*) AS n FROM replicated")
+        self.assertEqual(self.cursor.fetchone()["n"], 0)
+
+class DroppingConnection:
+    """stands in for a pooled connection whose server goes away once, at statement drop_at, if any"""
+    def __init__(self, drop_at=0):
+        self.reconnects = 0
+        self.statements = 0
+        self.drop_at = drop_at
+
+    def cursor(self, **kwargs):
+        return self
+
+    def execute(self, query, params=None):
+        self.statements += 1
+        if self.drop_at is not None and self.statements == self.drop_at + 1:
+            raise mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013)
+        return query
+
+    def reconnect(self, attempts=1, delay=0):
+        self.reconnects += 1
+
+class TestPooledCursor(unittest.TestCase):
+
+    def _handler(self, conn, fresh):
+        """handler whose pool hands out fresh once conn is given back"""
+        handler = unittest.mock.Mock(_conn=conn)
+        handler._drop_connection.side_effect = lambda: setattr(handler, "_conn", fresh)
+        return handler
+
+    def test_read_retried(self):
+        conn, fresh = DroppingConnection(drop_at=1), DroppingConnection(drop_at=None)
+        handler = self._handler(conn, fresh)
+        cursor = PooledCursor(handler)
+        self.assertEqual(cursor.execute("SELECT 1"), "SELECT 1")
+        self.assertEqual(cursor.execute("SELECT 2"), "SELECT 2") # on a fresh pooled connection
+        handler._drop_connection.assert_called_once()
+        self.assertEqual((conn.statements, fresh.statements), (2, 1))
+        self.assertEqual(conn.reconnects, 0) # not reconnected in place
+        self.assertEqual(cursor.execute("SELECT 3"), "SELECT 3")
+        self.assertEqual(fresh.statements, 2)
+
+    def test_read_retried_once(self):
+        handler = self._handler(DroppingConnection(drop_at=0), DroppingConnection(drop_at=0))
+        cursor = PooledCursor(handler)
+        with self.assertRaises(mysql.connector.errors.OperationalError):
+            cursor.execute("SELECT 1")
+        self.assertEqual(handler._drop_connection.call_count, 2)
+
+    def test_write_not_retried(self):
+        fresh = DroppingConnection(drop_at=None)
+        handler = self._handler(DroppingConnection(drop_at=0), fresh)
+        cursor = PooledCursor(handler)
+        with self.assertRaises(mysql.connector.errors.OperationalError):
+            cursor.execute("INSERT INTO data VALUES (1)") # queued in the outbox instead
+        handler._drop_connection.assert_called_once()
+        self.assertEqual(fresh.statements, 0)
+
+    def test_other_errors_keep_connection(self):
+        handler = unittest.mock.Mock(_conn=DroppingConnection())
+        handler._conn.execute = unittest.mock.Mock(
+            side_effect=mysql.connector.errors.ProgrammingError(msg="Syntax error", errno=1064))
+        cursor = PooledCursor(handler)
+        with self.assertRaises(mysql.connector.errors.ProgrammingError):
+            cursor.execute("SELEC 1")
+        handler._drop_connection.assert_not_called()
+
 if __name__ == "__main__":
     unittest.main()
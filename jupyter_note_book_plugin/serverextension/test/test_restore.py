@@ -0,0 +1,105 @@
+"""
+test restoring namespace snapshots
+"""
+
+import unittest
+import sqlite3
+import shutil
+import os
+import dill
+import numpy as np
+import pandas as pd
+
+from context import prompter
+from prompter.restore import load_manifest, bind, referenced_names, load_referenced
+from prompter.snapshots import DeltaEncoder, LazyVariable, write_snapshot, DFS_KEY, OBJS_KEY
+from prompter.objectstore import ObjectStore
+from prompter.storage import LOCAL_SQL_CMDS
+
+class TestRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./restoretest/"
+        os.makedirs(self.TEST_DIR, exist_ok=True)
+        self.conn = sqlite3.connect(self.TEST_DIR + "cells.db")
+        self.conn.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
+        self.conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        self.store = ObjectStore(self.TEST_DIR + "objects/", self.TEST_DIR + "frames/")
+        self.encoder = DeltaEncoder(self.store)
+        self.insert_cmd = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+
+        self.df = pd.DataFrame({"age" : [26, 57, 49]})
+        self._write("msg-1", 1, {"df" : self.df, "x" : [1, 2], "np" : np})
+        self.conn.execute(self.insert_cmd, ("msg-2", "kernel-1", 2, "2021-01-01 00:00:02", "", None))
+        self._write("msg-3", 3, {"df" : self.df, "x" : [3]})
+
+    def _write(self, msg_id, exec_num, variables):
+        curr_time = "2021-01-01 00:00:0{0}".format(exec_num)
+        namespace = dill.dumps(self.encoder.encode(variables))
+        write_snapshot(self.conn, self.insert_cmd, (msg_id, "kernel-1", exec_num, curr_time, "", namespace),
+                       LOCAL_SQL_CMDS["ADD_OBJECT"], self.encoder.new_objects, curr_time)
+
+    def test_lazy_restore(self):
+        namespace = {"y" : 1}
+        names, reduced = bind(namespace, load_manifest(self.conn, "msg-1"), self.store)
+        self.assertEqual(set(names), {"df", "x", "np"})
+        self.assertEqual(reduced, {})
+        self.assertIs(namespace["np"], np)
+        self.assertIsInstance(namespace["df"], LazyVariable)
+        self.assertFalse(namespace["x"].loaded)
+
+        self.assertEqual(len(namespace["x"]), 2) # loads on use
+        self.assertEqual(namespace["x"], [1, 2]) # and takes its place
+        self.assertIsInstance(namespace["df"], LazyVariable)
+
+        load_referenced(namespace, "df2 = df[df.age > 30]\ny += 1")
+        self.assertTrue(namespace["df"].equals(self.df))
+
+    def test_isinstance(self):
+        namespace = {}
+        bind(namespace, load_manifest(self.conn, "msg-1"), self.store)
+        self.assertIsInstance(namespace["df"], pd.DataFrame) # eg. in a function defined before the restore
+        self.assertIsInstance(namespace["x"], list)
+        self.assertNotIsInstance(namespace["x"], dict)
+        self.assertIs(namespace["df"].__class__, pd.DataFrame)
+
+    def test_placeholder_restores_superseding(self):
+        namespace = {}
+        bind(namespace, load_manifest(self.conn, "msg-2"), self.store)
+        self.assertEqual(namespace["x"].load(), [3])
+        with self.assertRaises(KeyError):
+            load_manifest(self.conn, "msg-4")
+
+    def test_reduced_not_bound(self):
+        encoder = DeltaEncoder(self.store, object_budget=1000, sample_rows=20)
+        variables = {"big_df" : pd.DataFrame({"age" : np.arange(1000)}), "arr" : np.arange(1000), "x" : [1]}
+        encoder.encode(variables)
+        manifest = encoder.encode(variables) # reused, the summaries are still marked
+
+        namespace = {}
+        names, reduced = bind(namespace, manifest, self.store)
+        self.assertEqual(names, ["x"])
+        self.assertEqual(set(reduced), {"big_df", "arr"})
+        self.assertEqual(set(namespace), {"x"})
+
+    def test_unloaded_reused(self):
+        namespace = {}
+        bind(namespace, load_manifest(self.conn, "msg-1"), self.store)
+        encoder = DeltaEncoder(self.store)
+        manifest = encoder.encode(namespace)
+
+        self.assertEqual(encoder.new_objects, [])
+        self.assertFalse(namespace["df"].loaded)
+        self.assertEqual(manifest[DFS_KEY]["df"], namespace["df"].ref)
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["x"]), [1, 2])
+
+    def test_referenced_names(self):
+        self.assertEqual(referenced_names("a = b + c.d\nprint(e)\nf += 1"), {"b", "c", "print", "e", "f"})
+        self.assertEqual(referenced_names("def ("), set())
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
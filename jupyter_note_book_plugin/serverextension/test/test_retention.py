@@ -0,0 +1,110 @@
+"""
+test removing old namespace snapshots
+"""
+
+import unittest
+import sqlite3
+import shutil
+import os
+import dill
+import pandas as pd
+
+from context import prompter
+from prompter.retention import SnapshotCompactor
+from prompter.snapshots import DeltaEncoder, write_snapshot, telemetry_rows, DFS_KEY, OBJS_KEY
+from prompter.objectstore import ObjectStore
+from prompter.storage import LOCAL_SQL_CMDS
+
+class TestSnapshotCompactor(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./retentiontest/"
+        self.TEST_DB = self.TEST_DIR + "cells.db"
+        os.makedirs(self.TEST_DIR, exist_ok=True)
+        self.conn = sqlite3.connect(self.TEST_DB)
+        self.conn.execute(LOCAL_SQL_CMDS["INCREMENTAL_VACUUM"])
+        self.conn.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
+        self.conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        self.conn.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+        self.conn.commit()
+
+        self.store = ObjectStore(self.TEST_DIR + "objects/", self.TEST_DIR + "frames/")
+        self.encoder = DeltaEncoder(self.store)
+        self.insert_cmd = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.df = pd.DataFrame({"age" : [26, 57, 49], "grade" : [.9, .8, .7]})
+
+        for i in range(5):
+            self.df["age"] = self.df["age"] + 1
+            self._write("msg-{0}".format(i), i, {"df" : self.df, "x" : i})
+
+    def _write(self, msg_id, exec_num, variables):
+        curr_time = "2021-01-01 00:00:0{0}".format(exec_num)
+        namespace = dill.dumps(self.encoder.encode(variables))
+        write_snapshot(self.conn, self.insert_cmd, (msg_id, "kernel-1", exec_num, curr_time, "", namespace),
+                       LOCAL_SQL_CMDS["ADD_OBJECT"], self.encoder.new_objects, curr_time,
+                       LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"],
+                       telemetry_rows(msg_id, "kernel-1", curr_time, self.encoder.telemetry))
+
+    def _manifest(self, msg_id):
+        row = self.conn.execute("SELECT namespace FROM namespaces WHERE msg_id = ?", (msg_id,)).fetchone()
+        return dill.loads(row[0])
+
+    def test_keeps_recent_and_protected(self):
+        compactor = SnapshotCompactor(self.TEST_DB, store=self.store, retain=2, grace=0)
+        old_ref = self._manifest("msg-0")[DFS_KEY]["df"]
+        report = compactor.run_once(protected={("kernel-1", 1), ("kernel-2", 2)})
+
+        rows = [r[0] for r in self.conn.execute("SELECT msg_id FROM namespaces ORDER BY exec_num")]
+        self.assertEqual(rows, ["msg-1", "msg-3", "msg-4"])
+        self.assertEqual(report["rows"], 2)
+        self.assertEqual(report["objects"], 4) # df and x of msg-0 and msg-2
+        self.assertGreater(report["bytes"], 0)
+
+        self.assertFalse(self.store.has(old_ref))
+        for msg_id in rows:
+            manifest = self._manifest(msg_id)
+            self.assertIsNotNone(self.store.load(manifest[OBJS_KEY]["x"]))
+            self.assertIsNotNone(self.store.load(manifest[DFS_KEY]["df"]))
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0], 6)
+
+    def test_keeps_linked_by_msg_id(self):
+        # the kernel restarted, a newer snapshot reuses the exec_num of the one a version links to
+        compactor = SnapshotCompactor(self.TEST_DB, store=self.store, retain=1, grace=0)
+        version_ref = self._manifest("msg-2")[DFS_KEY]["df"]
+        compactor.run_once(msg_ids={"msg-1"}, object_refs={version_ref})
+
+        rows = [r[0] for r in self.conn.execute("SELECT msg_id FROM namespaces ORDER BY exec_num")]
+        self.assertEqual(rows, ["msg-1", "msg-4"])
+        self.assertTrue(self.store.has(version_ref))
+
+    def test_telemetry_removed(self):
+        SnapshotCompactor(self.TEST_DB, store=self.store, retain=2, grace=0).run_once()
+        rows = self.conn.execute("SELECT DISTINCT msg_id FROM snapshot_vars ORDER BY msg_id").fetchall()
+        self.assertEqual(rows, [("msg-3",), ("msg-4",)])
+
+    def test_converted_to_incremental(self):
+        conn = sqlite3.connect(self.TEST_DIR + "old.db")
+        conn.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
+        conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        conn.commit()
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchall()[0][0], 0)
+
+        conn.close()
+
+        SnapshotCompactor(self.TEST_DIR + "old.db", store=self.store).run_once()
+        conn = sqlite3.connect(self.TEST_DIR + "old.db")
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchall()[0][0], 2)
+        conn.close()
+
+    def test_recent_objects_kept(self):
+        compactor = SnapshotCompactor(self.TEST_DB, store=self.store, retain=1, grace=600)
+        report = compactor.run_once()
+        self.assertEqual(report["rows"], 4)
+        self.assertEqual(report["objects"], 0)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
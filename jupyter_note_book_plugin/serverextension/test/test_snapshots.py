@@ -0,0 +1,308 @@
+"""
+test the namespace snapshot encoding
+"""
+
+import unittest
+import sqlite3
+import shutil
+import os
+import threading
+import time
+import dill
+import numpy as np
+import pandas as pd
+
+from unittest.mock import Mock
+
+from context import prompter
+from prompter.snapshots import DeltaEncoder, SnapshotWriter, ForkedSnapshotWriter, ObjectSummary, is_sample, \
+    DFS_KEY, OBJS_KEY, PROFILES_KEY
+from prompter.objectstore import ObjectStore
+from prompter.storage import LOCAL_SQL_CMDS
+
+class TestDeltaEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./snapshotstest/"
+        self.store = ObjectStore(self.TEST_DIR + "objects/", self.TEST_DIR + "frames/")
+        self.encoder = DeltaEncoder(self.store)
+        self.df = pd.DataFrame({"age" : [26, 57, 49], "grade" : [.9, .8, .7]})
+
+    def test_first_snapshot_stores(self):
+        manifest = self.encoder.encode({"df" : self.df, "x" : 1})
+        self.assertEqual(manifest[DFS_KEY]["df"][0], "frame")
+        self.assertEqual(manifest[OBJS_KEY]["x"][0], "pickle")
+        self.assertEqual(len(self.encoder.new_objects), 2)
+
+        self.assertTrue(self.store.load(manifest[DFS_KEY]["df"]).equals(self.df))
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["x"]), 1)
+        self.assertEqual(list(manifest[PROFILES_KEY]), ["df"])
+        self.assertEqual(manifest[PROFILES_KEY]["df"]["columns"]["age"]["length"], 3)
+
+    def test_unchanged_reused(self):
+        first = self.encoder.encode({"df" : self.df, "x" : 1})
+        second = self.encoder.encode({"df" : self.df, "x" : 1})
+        self.assertEqual(first, second)
+        self.assertEqual(self.encoder.new_objects, [])
+
+    def test_stored_once(self):
+        manifest = self.encoder.encode({"df" : self.df, "df_copy" : self.df.copy()})
+        self.assertEqual(manifest[DFS_KEY]["df"], manifest[DFS_KEY]["df_copy"])
+        self.assertEqual(len(self.encoder.new_objects), 1)
+
+    def test_inplace_change_stored(self):
+        first = self.encoder.encode({"df" : self.df})
+        self.df["age"] = [1, 2, 3]
+        second = self.encoder.encode({"df" : self.df})
+        self.assertNotEqual(first[DFS_KEY]["df"], second[DFS_KEY]["df"])
+        self.assertTrue(self.store.load(second[DFS_KEY]["df"]).equals(self.df))
+
+    def test_categories_stored(self):
+        df = pd.DataFrame({"grade" : pd.Categorical(["a", "b"], categories=["a", "b"])})
+        other = pd.DataFrame({"grade" : pd.Categorical(["a", "b"], categories=["a", "b", "c"])})
+        ordered = pd.DataFrame({"grade" : pd.Categorical(["a", "b"], categories=["a", "b"], ordered=True)})
+        manifest = self.encoder.encode({"df" : df, "other" : other, "ordered" : ordered})
+        self.assertEqual(len(set(manifest[DFS_KEY].values())), 3)
+        self.assertEqual(list(self.store.load(manifest[DFS_KEY]["other"])["grade"].cat.categories), ["a", "b", "c"])
+
+    def test_frame_write_failure(self):
+        self.store.put_frame = Mock(side_effect=OSError("No space left on device"))
+        manifest = self.encoder.encode({"df" : self.df, "x" : 1})
+        self.assertEqual(manifest[DFS_KEY]["df"][0], "pickle") # pickled whole instead
+        self.assertTrue(self.store.load(manifest[DFS_KEY]["df"]).equals(self.df))
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["x"]), 1)
+
+    def test_large_array_out_of_band(self):
+        arr = np.arange(100000, dtype="float64")
+        manifest = self.encoder.encode({"arr" : arr, "small" : np.arange(10)})
+        self.assertEqual(manifest[OBJS_KEY]["arr"][0], "pickle5")
+        self.assertEqual(manifest[OBJS_KEY]["small"][0], "pickle")
+
+        loaded = self.store.load(manifest[OBJS_KEY]["arr"])
+        np.testing.assert_array_equal(loaded, arr)
+        self.assertFalse(loaded.flags.owndata) # a view over the stored file
+        loaded[0] = -1 # copy on write, the stored object does not change
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["arr"])[0], 0)
+
+    def test_over_object_budget(self):
+        encoder = DeltaEncoder(self.store, object_budget=1000, sample_rows=20)
+        big_df = pd.DataFrame({"age" : np.arange(1000), "grade" : np.linspace(0, 1, 1000)})
+        manifest = encoder.encode({"big_df" : big_df, "arr" : np.arange(1000), "df" : self.df})
+
+        self.assertEqual(set(encoder.summarized), {"big_df", "arr"})
+        self.assertTrue(self.store.load(manifest[DFS_KEY]["df"]).equals(self.df))
+
+        sample = self.store.load(manifest[DFS_KEY]["big_df"])
+        self.assertTrue(is_sample(sample))
+        self.assertEqual(len(sample), 20)
+        self.assertEqual(manifest[PROFILES_KEY]["big_df"]["nrows"], 1000) # of the full frame
+        self.assertEqual(sample.attrs["forking_kernel_sample"]["shape"], (1000, 2))
+
+        summary = self.store.load(manifest[OBJS_KEY]["arr"])
+        self.assertIsInstance(summary, ObjectSummary)
+        self.assertEqual(summary["shape"], (1000,))
+        self.assertEqual(summary["stats"]["max"], 999)
+
+    def test_over_budget_measured_once(self):
+        class Model:
+            def __init__(self):
+                self.weights = list(range(1000)) # no cheap size estimate
+        encoder = DeltaEncoder(self.store, object_budget=1000)
+        model = Model()
+        encoder.encode({"model" : model})
+        self.assertIn("model", encoder.summarized)
+        adopted = DeltaEncoder(self.store, object_budget=1000) # eg. the kernel's, after a forked child encoded
+        adopted.adopt(encoder.state(), {"model" : model})
+        self.assertGreater(adopted._oversized_size(model), 1000)
+
+        self.store.pickle = Mock(wraps=self.store.pickle)
+        encoder.encode({"model" : model})
+        self.assertIn("model", encoder.summarized)
+        self.assertEqual([c.args[0] for c in self.store.pickle.call_args_list if c.args[0] is model], [])
+
+        encoder.encode({"model" : Model()}) # another object is measured again
+        self.assertTrue(any(c.args[0] is not model and isinstance(c.args[0], Model)
+                            for c in self.store.pickle.call_args_list))
+
+    def test_over_snapshot_budget(self):
+        encoder = DeltaEncoder(self.store, snapshot_budget=5000)
+        manifest = encoder.encode({"a" : np.arange(400), "b" : np.arange(400, 800), "c" : [1, 2]})
+        self.assertEqual(list(encoder.summarized), ["b"])
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["c"]), [1, 2])
+
+    def test_telemetry(self):
+        self.encoder.encode({"df" : self.df, "x" : 1})
+        self.encoder.encode({"df" : self.df, "x" : 2, "os" : os})
+        telemetry = {name : (kind, size, status) for name, kind, size, _, status in self.encoder.telemetry}
+
+        self.assertTrue(telemetry["df"][0].endswith(".DataFrame"))
+        self.assertEqual(telemetry["df"][2], "unchanged")
+        self.assertGreater(telemetry["df"][1], 0)
+        self.assertEqual(telemetry["x"][2], "stored")
+        self.assertEqual(telemetry["os"], ("builtins.module", 0, "skipped"))
+        self.assertTrue(all(seconds >= 0 for _, _, _, seconds, _ in self.encoder.telemetry))
+
+    def test_values_compared_by_value(self):
+        self.encoder.encode({"name" : "".join(["ab", "c"]), "pair" : (1, "x"), "series" : pd.Series([1, 2])})
+        self.encoder.encode({"name" : "".join(["a", "bc"]), "pair" : (1, "x"), "series" : pd.Series([1, 3])})
+        status = {name : status for name, _, _, _, status in self.encoder.telemetry}
+        self.assertEqual(status, {"name" : "unchanged", "pair" : "unchanged", "series" : "stored"})
+        self.assertEqual(len(self.encoder.new_objects), 1)
+
+    def test_unchanged_pickle_reported(self):
+        self.encoder.encode({"d" : {"a" : [1, 2]}})
+        self.encoder.encode({"d" : {"a" : [1, 2]}})
+        self.assertEqual(self.encoder.telemetry[0][4], "unchanged")
+        self.assertEqual(self.encoder.new_objects, [])
+
+    def test_unpicklable_skipped(self):
+        lock = threading.Lock()
+        manifest = self.encoder.encode({"lock" : lock, "os" : os, "x" : 1})
+        self.assertEqual(list(manifest[OBJS_KEY]), ["x"])
+        self.assertEqual(set(self.encoder.skipped), {"lock", "os"})
+
+    def test_failure_remembered(self):
+        class Holder:
+            pass
+        holder = Holder()
+        holder.rows = (i for i in range(3))
+        items = [1, (i for i in range(3))]
+
+        self.encoder.encode({"holder" : holder, "items" : items})
+        self.assertEqual(set(self.encoder.skipped), {"holder", "items"})
+        self.assertIsNotNone(self.encoder.picklability.known_bad(Holder()))
+        self.assertIsNotNone(self.encoder.picklability.known_bad(items))
+
+        picklability = self.encoder.picklability
+        reused = [1, 2] # a new list given the id of the one that failed
+        picklability._bad_containers[id(reused)] = picklability._bad_containers[id(items)]
+        self.assertIsNone(picklability.known_bad(reused))
+
+        items.pop() # the container can be pickled once it changes
+        manifest = self.encoder.encode({"items" : items})
+        self.assertEqual(self.store.load(manifest[OBJS_KEY]["items"]), [1])
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+class TestSnapshotWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./snapshotstest/"
+        self.TEST_DB = self.TEST_DIR + "cells.db"
+        os.makedirs(self.TEST_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.TEST_DB)
+        conn.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
+        conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        conn.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+        conn.commit()
+        conn.close()
+
+        self.store = ObjectStore(self.TEST_DIR + "objects/", self.TEST_DIR + "frames/")
+        insert_cmd = """INSERT OR REPLACE INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.writer = SnapshotWriter(self.TEST_DB, insert_cmd, LOCAL_SQL_CMDS["ADD_OBJECT"],
+                                     DeltaEncoder(self.store), Mock(), maxsize=1,
+                                     vars_cmd=LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"])
+
+    def test_flush_in_order(self):
+        df = pd.DataFrame({"age" : [26, 57, 49]})
+        for i in range(5):
+            self.writer.submit("msg-{0}".format(i), "kernel-1", i, "2021-01-01 00:00:0{0}".format(i), "", {"x" : i, "df" : df})
+        self.assertTrue(self.writer.flush(timeout=10))
+
+        conn = sqlite3.connect(self.TEST_DB)
+        rows = conn.execute("SELECT msg_id, namespace FROM namespaces ORDER BY rowid").fetchall()
+        objects = conn.execute("SELECT * FROM objects").fetchall()
+        statuses = conn.execute("""SELECT status FROM snapshot_vars WHERE name = 'df' ORDER BY time""").fetchall()
+        conn.close()
+
+        self.assertEqual([r[0] for r in rows], ["msg-{0}".format(i) for i in range(5)])
+        self.assertEqual(self.store.load(dill.loads(rows[-1][1])[OBJS_KEY]["x"]), 4)
+        self.assertEqual(len(objects), 6) # five values of x, one of df
+        self.assertEqual([s[0] for s in statuses], ["stored"] + ["unchanged"] * 4)
+
+    def test_placeholder_replaced(self):
+        self.writer.submit("msg-0", "kernel-1", 0, "2021-01-01 00:00:00", "", None)
+        self.assertTrue(self.writer.flush(timeout=10))
+        conn = sqlite3.connect(self.TEST_DB)
+        self.assertIsNone(conn.execute("SELECT namespace FROM namespaces").fetchone()[0])
+
+        self.writer.submit("msg-0", "kernel-1", 0, "2021-01-01 00:00:00", "", {"x" : 1})
+        self.assertTrue(self.writer.flush(timeout=10))
+        rows = conn.execute("SELECT namespace FROM namespaces").fetchall()
+        conn.close()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(self.store.load(dill.loads(rows[0][0])[OBJS_KEY]["x"]), 1)
+
+    def tearDown(self):
+        self.writer.close(timeout=10)
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+class TestForkedSnapshotWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_DIR = "./snapshotstest/"
+        self.TEST_DB = self.TEST_DIR + "cells.db"
+        os.makedirs(self.TEST_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.TEST_DB)
+        conn.execute(LOCAL_SQL_CMDS["MAKE_NS_TABLE"])
+        conn.execute(LOCAL_SQL_CMDS["MAKE_OBJECTS_TABLE"])
+        conn.executescript(LOCAL_SQL_CMDS["MAKE_SNAPSHOT_VARS_TABLE"])
+        conn.commit()
+        conn.close()
+
+        self.store = ObjectStore(self.TEST_DIR + "objects/", self.TEST_DIR + "frames/")
+        self.encoder = DeltaEncoder(self.store)
+        insert_cmd = """INSERT OR REPLACE INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.writer = ForkedSnapshotWriter(self.TEST_DB, insert_cmd, LOCAL_SQL_CMDS["ADD_OBJECT"],
+                                           self.encoder, Mock(), vars_cmd=LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"])
+
+    def test_stored_by_child(self):
+        df = pd.DataFrame({"age" : [26, 57, 49]})
+        holder = [1, (i for i in range(3))]
+        self.writer.submit("msg-0", "kernel-1", 0, "2021-01-01 00:00:00", "", None)
+        for i in range(1, 4):
+            self.writer.submit("msg-{0}".format(i), "kernel-1", i, "2021-01-01 00:00:0{0}".format(i), "",
+                               {"x" : i, "df" : df, "holder" : holder})
+        self.assertTrue(self.writer.flush(timeout=10))
+
+        conn = sqlite3.connect(self.TEST_DB)
+        rows = conn.execute("SELECT msg_id, namespace FROM namespaces ORDER BY exec_num").fetchall()
+        statuses = conn.execute("""SELECT status FROM snapshot_vars WHERE name = 'df' ORDER BY time""").fetchall()
+        conn.close()
+
+        self.assertEqual([r[0] for r in rows], ["msg-{0}".format(i) for i in range(4)])
+        self.assertIsNone(rows[0][1])
+        self.assertEqual(self.store.load(dill.loads(rows[-1][1])[OBJS_KEY]["x"]), 3)
+        # the parent's encoder learned from the children
+        self.assertEqual([s[0] for s in statuses], ["stored", "unchanged", "unchanged"])
+        self.assertIsNotNone(self.encoder.picklability.known_bad(holder))
+
+    def test_hung_child_killed(self):
+        def hang(*args):
+            time.sleep(60)
+            os._exit(0) # pylint: disable=protected-access
+        self.writer.child_timeout = 0.5
+        self.writer._run_child = hang
+        self.encoder.encode({"x" : 1})
+        self.writer.submit("msg-0", "kernel-1", 0, "2021-01-01 00:00:00", "", {"x" : 1})
+        self.assertFalse(self.writer.flush(timeout=0))
+
+        started = time.monotonic()
+        self.assertTrue(self.writer.flush(timeout=10))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIsNone(self.writer._child)
+        # nothing the child stored can be reused
+        self.assertEqual(self.encoder.state()["prev"], {})
+
+        del self.writer._run_child
+        self.writer.submit("msg-1", "kernel-1", 1, "2021-01-01 00:00:01", "", {"x" : 2})
+        self.assertTrue(self.writer.flush(timeout=10))
+
+    def tearDown(self):
+        self.writer.close(timeout=10)
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,17 +2,41 @@
 test the DbHandler methods
 """
 
+import asyncio
 import unittest
 import sqlite3
 import os
+import shutil
+import tempfile
+import threading
+import unittest.mock
+import dill
+import mysql.connector
+import pandas as pd
 from context import prompter
+from prompter.snapshots import DFS_KEY, OBJS_KEY, DeltaEncoder
+from prompter.storage import LOCAL_SQL_CMDS, load_dfs, load_ns, load_profiles
+from prompter.objectstore import ObjectStore
+from prompter.nscache import NamespaceCache
+from prompter.asyncdb import AsyncDbHandler
+from prompter.outbox import Outbox
+from prompter.profiles import columns_fingerprint
 #import prompter
 
+def temp_home(test):
+    """point HOME at a temporary directory for test, so the handler's ObjectStore does not use ~/.promptml"""
+    home = tempfile.mkdtemp()
+    patch = unittest.mock.patch.dict(os.environ, {"HOME" : home})
+    patch.start()
+    test.addCleanup(shutil.rmtree, home, ignore_errors=True)
+    test.addCleanup(patch.stop)
+
 
 class TestDBMethods(unittest.TestCase):
 
     def setUp(self):
 
+        temp_home(self)
         self.TEST_DB_DIR = "./"
         self.TEST_DB_NAME = "cellstest.db"
         self.db = prompter.DbHandler(dirname=self.TEST_DB_DIR, dbname=self.TEST_DB_NAME)
@@ -202,5 +226,463 @@ class TestDBMethods(unittest.TestCase):
         if os.path.exists(self.TEST_DB_DIR+self.TEST_DB_NAME):
             os.remove(self.TEST_DB_DIR+self.TEST_DB_NAME)
 
+def _ns(msg_id):
+    return dill.dumps({DFS_KEY : {}, OBJS_KEY : {}, "msg" : msg_id})
+
+class StorageTestCase(unittest.TestCase):
+    """a DbHandler on a new nstest.db, made from LOCAL_SQL_CMDS"""
+
+    def setUp(self):
+        temp_home(self)
+        self.TEST_DB_DIR = "./"
+        self.TEST_DB_NAME = "nstest.db"
+        self.db = prompter.DbHandler(dirname=self.TEST_DB_DIR, dbname=self.TEST_DB_NAME)
+
+    def _add_namespaces(self):
+        """snapshots of kernel-a and kernel-b, and one stored before snapshots had a kernel"""
+        insert = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.db._conn.executemany(insert, [
+            ("old", None, 1, "2021-01-01 00:00:00", "", _ns("old")),
+            ("a-1", "kernel-a", 1, "2021-01-01 00:00:01", "", _ns("a-1")),
+            ("b-1", "kernel-b", 1, "2021-01-01 00:00:02", "", _ns("b-1")),
+            ("a-2", "kernel-a", 2, "2021-01-01 00:00:03", "", _ns("a-2")),
+            ("b-2", "kernel-b", 2, "2021-01-01 00:00:04", "", _ns("b-2"))])
+        self.db._conn.commit()
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.TEST_DB_DIR + self.TEST_DB_NAME)
+
+class TestMigrations(StorageTestCase):
+    """databases made by earlier versions are brought up to date"""
+
+    def setUp(self):
+        # a namespaces table from before namespaces were keyed by kernel
+        conn = sqlite3.connect("./nstest.db")
+        conn.execute("""CREATE TABLE namespaces(msg_id TEXT PRIMARY KEY, exec_num INT, code TEXT, time TIMESTAMP, namespace BLOB)""")
+        conn.execute("""INSERT INTO namespaces VALUES (?, ?, ?, ?, ?)""", ("old", 1, "", "2021-01-01 00:00:00", _ns("old")))
+        conn.commit()
+        conn.close()
+        super().setUp()
+
+    def test_migrated(self):
+        indexes = [r[1] for r in self.db._conn.execute("PRAGMA index_list(namespaces)")]
+        self.assertIn("namespaces_kernel_time", indexes)
+        self.assertIn("namespaces_kernel_exec", indexes)
+
+    def test_migrated_tables(self):
+        tables = [row[0] for row in self.db._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertIn("objects", tables) # the old database was made without them
+        self.assertIn("snapshot_vars", tables)
+
+    def test_update_tables(self):
+        self.db._conn.executescript(LOCAL_SQL_CMDS["MAKE_STUDY_TABLES"]) # an old database may have none
+        self.db._update_tables()
+        self.db._update_tables() # the columns are there already
+        self.db.cmds = dict(self.db.cmds, ADD_DATA_OBJECT_REF="ALTER TABLE data ADD COLUMN")
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db._update_tables()
+
+class TestNamespaceLookups(StorageTestCase):
+    """finding the namespace snapshot of an execution"""
+
+    def setUp(self):
+        super().setUp()
+        self._add_namespaces()
+
+    def test_recent_by_kernel(self):
+        self.assertEqual(self.db.recent_ns("kernel-a")["msg_id"], "a-2")
+        self.assertEqual(self.db.recent_ns("kernel-b")["msg_id"], "b-2")
+        self.assertEqual(self.db.recent_ns("kernel-c")["msg_id"], "old") # stored before snapshots had a kernel
+        self.db._conn.execute("DELETE FROM namespaces WHERE kernel IS NULL")
+        self.assertIsNone(self.db.recent_ns("kernel-c")) # not another kernel's
+
+    def test_recover_ns(self):
+        ns = self.db.recover_ns("b-1")
+        self.assertEqual(ns["msg_id"], "b-1")
+        self.assertEqual(dill.loads(ns["namespace"])["msg"], "b-1")
+        self.assertIsNone(self.db.recover_ns("c-1"))
+
+    def test_exec_ns(self):
+        self.assertEqual(self.db.exec_ns("kernel-b", 1)["msg_id"], "b-1")
+        self.assertIsNone(self.db.exec_ns("kernel-a", 3))
+        self.assertEqual(self.db.wait_for_ns(2, "kernel-a", timeout=0)["msg_id"], "a-2")
+        self.assertIsNone(self.db.wait_for_ns(3, "kernel-a", timeout=0))
+
+    def test_coalesced_placeholder(self):
+        insert = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.db._conn.execute(insert, ("a-3", "kernel-a", 3, "2021-01-01 00:00:05", "", None))
+        self.db._conn.commit()
+
+        # the burst is still running, the placeholder itself is returned without waiting for it
+        placeholder = self.db.wait_for_ns(3, "kernel-a", timeout=5, msg_id="a-3")
+        self.assertEqual((placeholder["msg_id"], placeholder["namespace"]), ("a-3", None))
+        self.assertIsNone(self.db.wait_for_ns(3, "kernel-a", timeout=0)["namespace"])
+        self.assertEqual(self.db.recent_ns("kernel-a")["msg_id"], "a-2")
+        self.assertIsNone(self.db.exec_ns("kernel-a", 3))
+        placeholder = self.db.recover_ns("a-3")
+        self.assertEqual((placeholder["msg_id"], placeholder["namespace"]), ("a-3", None))
+
+        self.db._conn.execute(insert, ("a-4", "kernel-a", 4, "2021-01-01 00:00:06", "", _ns("a-4")))
+        self.db._conn.commit()
+        self.assertEqual(self.db.exec_ns("kernel-a", 3)["msg_id"], "a-4")
+        self.assertEqual(self.db.wait_for_ns(3, "kernel-a", timeout=0)["msg_id"], "a-4")
+        self.assertEqual(self.db.msg_ns("a-3")["msg_id"], "a-4")
+        self.assertEqual(self.db.recover_ns("a-3")["msg_id"], "a-4")
+
+    def test_coalesced_version_unlinked(self):
+        insert = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.db._conn.executemany(insert, [("a-3", "kernel-a", 3, "2021-01-01 00:00:05", "", None),
+                                           ("a-4", "kernel-a", 4, "2021-01-01 00:00:06", "", _ns("a-4"))])
+        self.db._conn.execute("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                              ("default", "kernel-a", "cell", 1, "unknown", "df", 3, None))
+        self.db._conn.commit()
+        # the frames stored at the end of the burst are not those execution 3 made
+        self.assertIsNone(self.db.get_dataframe_version({"name" : "df", "kernel" : "kernel-a"}, 1))
+
+    def test_linked_by_msg_id(self):
+        # the kernel restarted, exec_num 1 was logged twice
+        df = pd.DataFrame({"age" : [26, 57]})
+        insert = """INSERT INTO namespaces(msg_id, kernel, exec_num, time, code, namespace) VALUES (?, ?, ?, ?, ?, ?)"""
+        self.db._conn.execute(insert, ("a-3", "kernel-a", 1, "2021-01-01 00:10:00", "",
+                                       dill.dumps({DFS_KEY : {"df" : dill.dumps(df)}, OBJS_KEY : {}})))
+        self.db._conn.executemany("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", [
+            ("default", "kernel-a", "cell", 1, "unknown", "df", 1, "a-3"),
+            ("default", "kernel-a", "cell", 2, "unknown", "df", 1, None)])
+        self.db._conn.commit()
+
+        self.assertTrue(self.db.get_dataframe_version({"name" : "df", "kernel" : "kernel-a"}, 1).equals(df))
+        self.assertIsNone(self.db.get_dataframe_version({"name" : "df", "kernel" : "kernel-a"}, 2)) # a-1, by exec_ct
+
+        self.assertEqual(self.db.link_cell_to_ns(1, "", None, msg_id="a-3")["msg_id"], "a-3")
+        self.assertEqual(self.db.wait_for_ns(1, "kernel-a", timeout=0, msg_id="a-3")["msg_id"], "a-3")
+        self.assertIsNone(self.db.wait_for_ns(1, "kernel-a", timeout=0, msg_id="a-4"))
+
+class TestMetadataCatalog(StorageTestCase):
+    """data versions and columns answered from the catalog"""
+
+    def test_recent_columns(self):
+        self.db._conn.executemany("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id) VALUES (?, ?, 'cell', ?, 'unknown', ?, 1, NULL)""", [
+            ("default", "kernel-a", 1, "a"), ("default", "kernel-a", 2, "a"),
+            ("default", "kernel-a", 1, "b"), ("default", "kernel-b", 3, "a")])
+        self.db._conn.executemany("""INSERT INTO columns(user, kernel, name, version, col_name, type, size, checked)
+                                     VALUES ('default', ?, ?, ?, ?, 'int', 2, ?)""", [
+            ("kernel-a", "a", 1, "old", False), ("kernel-a", "a", 2, "age", False),
+            ("kernel-a", "a", 2, "sex", False), ("kernel-a", "b", 1, "x", True), ("kernel-b", "a", 3, "y", False)])
+        self.db._conn.commit()
+
+        self.assertEqual(self.db.max_versions("kernel-a"), {"a" : 2, "b" : 1})
+        recent = self.db.get_recent_cols("kernel-a")
+        self.assertEqual(sorted((c["name"], c["col_name"]) for c in recent), [("a", "age"), ("a", "sex"), ("b", "x")])
+        self.assertIs(recent[0]["checked"], False)
+        self.assertEqual(self.db.get_unmarked_columns("kernel-a"), {"a" : ["age", "sex"]})
+
+        self.db.update_marked_columns("kernel-a", {"a" : {"sex" : {"is_sensitive" : 1, "user_specified" : 0, "fields" : "sex"}}})
+        self.assertEqual(self.db.get_unmarked_columns("kernel-a"), {"a" : ["age"]})
+        sex = [c for c in self.db.get_recent_cols("kernel-a") if c["col_name"] == "sex"][0]
+        self.assertEqual((sex["is_sensitive"], sex["fields"]), (True, "sex"))
+
+    def test_catalog(self):
+        data = {"kernel" : "kernel-a", "cell" : "cell", "source" : "test.csv", "name" : "df",
+                "columns" : {"age" : {"type" : "int64", "size" : 2}}}
+        self.db.add_data(data, 1, 1)
+        self.assertEqual(self.db.find_data(data)[0]["version"], 1) # read from the tables
+
+        self.db._conn.execute("DELETE FROM data") # later lookups do not query
+        self.db.add_data(dict(data, columns={"sex" : {"type" : "object", "size" : 2}}), 2, 2, "a-2")
+        self.assertEqual([v["version"] for v in self.db.find_data(data)], [1, 2])
+        self.assertEqual(self.db.get_data_version("df", {"sex" : {"type" : "object", "size" : 2}}, "kernel-a"), 2)
+        self.assertEqual(self.db.get_unmarked_columns("kernel-a"), {"df" : ["sex"]})
+        self.assertEqual(self.db._conn.execute("SELECT schema_hash FROM data WHERE version = 2").fetchone()[0],
+                         columns_fingerprint({"sex" : {"type" : "object", "size" : 2}}))
+
+        self.db.update_marked_columns("kernel-a", {"df" : {"sex" : {"is_sensitive" : True, "user_specified" : True, "fields" : "sex"}}})
+        self.assertEqual([v["version"] for v in self.db.find_data(data)], [1, 2]) # updated in place
+        self.assertEqual(self.db.get_unmarked_columns("kernel-a"), {})
+        self.assertEqual(self.db._conn.execute("SELECT checked FROM columns WHERE version = 2").fetchone()[0], 1)
+
+    def test_invalidated_while_read(self):
+        # the replicator invalidates a kernel a database thread is reading in
+        catalog = prompter.storage.MetadataCatalog(lambda kernel: (catalog.invalidate(kernel), ([], []))[1])
+        self.assertEqual(catalog.max_versions("kernel-a"), {})
+        self.assertEqual(catalog.data_rows(), []) # not kept, read again on the next lookup
+        catalog._load = lambda kernel: ([{"name" : "df", "version" : 1, "schema_hash" : "h"}], [])
+        self.assertEqual(catalog.max_versions("kernel-a"), {"df" : 1})
+
+class TestBufferedWrites(StorageTestCase):
+    """note responses and tracking events written in batches"""
+
+    def test_buffered_writes(self):
+        self.db._writes.max_rows = 3
+
+        self.db.store_response("kernel-a", "cell-1", 1, {"type" : "note", "n" : 1})
+        self.db.addTrack("START", "started")
+        self.assertEqual(self.db._conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0], 0)
+        self.db.store_response("kernel-a", "cell-1", 1, {"type" : "note", "n" : 2}) # third row, writes the batch
+        self.assertEqual(len(self.db._writes), 0)
+        self.assertIsNotNone(self.db._conn.execute("SELECT time FROM userTracking").fetchone()[0])
+
+        self.db.store_response("kernel-a", "cell-2", 2, {"type" : "note", "n" : 3})
+        self.assertEqual([r["n"] for r in self.db.get_responses("kernel-a")["cell-1"]], [1, 2])
+        self.assertEqual(len(self.db.get_responses("kernel-a")["cell-2"]), 1) # flushed before reading
+
+        self.db.addTrack("END", "ended")
+        self.db._conn.execute("DROP TABLE userTracking")
+        self.assertFalse(self.db.flush_writes())
+        self.assertEqual(len(self.db._writes), 1) # kept for the next flush
+
+class TestOutboxWrites(StorageTestCase):
+    """writes queued in an outbox, and reads while the remote database is down"""
+
+    def test_outbox(self):
+        self.db.outbox = Outbox(self.TEST_DB_DIR + "outboxtest.db")
+        data = {"kernel" : "kernel-a", "cell" : "cell", "source" : "test.csv", "name" : "df",
+                "columns" : {"age" : {"type" : "int64", "size" : 2}}}
+        self.db.check_add_data(data, 1)
+        self.db.update_marked_columns("kernel-a", {"df" : {"age" : {"is_sensitive" : False, "user_specified" : True,
+                                                                   "fields" : "none"}}})
+        self.db.addTrack("START", "started")
+        self.db.store_response("kernel-a", "cell", 1, {"type" : "note"})
+        self.assertEqual(len(self.db.outbox), 3) # buffered, then queued in one transaction
+        self.db.flush_writes()
+
+        self.assertEqual(self.db._conn.execute("SELECT COUNT(*) FROM data").fetchone()[0], 0) # only queued
+        self.assertEqual([cmd for _, cmd, _ in self.db.outbox.peek(10)],
+                         ["ADD_DATA", "ADD_COLS", "UPDATE_COL_TYPES", "USER_TRACKING_AT", "STORE_RESP"])
+        self.assertEqual(self.db.check_add_data(data, 2), 1) # answered by the catalog
+        self.assertEqual(self.db.get_unmarked_columns("kernel-a"), {})
+        self.db.outbox.close()
+        os.remove(self.TEST_DB_DIR + "outboxtest.db")
+
+    def test_outbox_versions(self):
+        self.db.outbox = Outbox(self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(os.remove, self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(self.db.outbox.close)
+        for contents in ("x = 1", "x = 2"):
+            self.db.add_entry({"cell_id" : "cell", "kernel" : "kernel-a", "contents" : contents, "metadata" : "{}",
+                               "exec_ct" : 1})
+        self.db._cell_versions = {} # restarted, the versions table cannot be read
+        self.db.add_entry({"cell_id" : "cell", "kernel" : "kernel-a", "contents" : "x = 3", "metadata" : "{}",
+                           "exec_ct" : 2})
+        self.assertEqual([row[3] for row in self.db.outbox.pending("INSERT_VERSIONS")], [1, 2, 3])
+
+    def test_remote_down(self):
+        self.db.outbox = Outbox(self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(os.remove, self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(self.db.outbox.close)
+        self.db._conn.execute("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id)
+                                 VALUES ('default', 'kernel-b', 'cell', 1, 'unknown', 'df', 1, NULL)""")
+        self.db._conn.commit()
+        self.db.outbox.put([("ADD_DATA", [("kernel-b", "cell", 2, "unknown", "df", "default", 2, None, None, None)]),
+                            ("UPSERT_CELLS", [("cell", "x = 1", 1, "2021-01-01 00:00:00", "kernel-b", "default", "{}")]),
+                            ("STORE_RESP", [("kernel-b", "default", "cell", "{}", 2)])])
+
+        cursor = self.db._cursor
+        self.db._cursor = unittest.mock.Mock(execute=unittest.mock.Mock(
+            side_effect=mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013)))
+        self.assertEqual(self.db.max_versions("kernel-b"), {"df" : 2}) # from the outbox alone
+        self.assertEqual(self.db.get_code("kernel-b", "cell"), "x = 1")
+        self.assertEqual(self.db.get_responses("kernel-b"), {"cell" : [{}]})
+        self.assertEqual(self.db._cursor.execute.call_count, 1) # not tried again until the replicator reaches it
+
+        self.db._cursor = cursor
+        self.db.remote_reached(True)
+        self.db._conn.execute("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id)
+                                 VALUES ('default', 'kernel-b', 'cell', 2, 'unknown', 'df', 2, NULL)""")
+        self.db._conn.commit()
+        self.db.outbox.remove(1) # the data version was copied
+        self.assertEqual(self.db.get_responses("kernel-b"), {"cell" : [{}]})
+        self.assertEqual([row["version"] for row in self.db.catalog.versions("kernel-b", "df")], [1, 2]) # read again
+
+    def test_data_snapshots_remote_down(self):
+        self.db.outbox = Outbox(self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(os.remove, self.TEST_DB_DIR + "outboxtest.db")
+        self.addCleanup(self.db.outbox.close)
+        self.db._conn.execute("""INSERT INTO data(user, kernel, cell, version, source, name, exec_ct, msg_id)
+                                 VALUES ('default', 'kernel-a', 'cell', 1, 'unknown', 'df', 1, 'a-1')""")
+        self.db._conn.commit()
+        self.assertEqual(self.db.data_snapshots()["msg_ids"], {"a-1"})
+
+        # a kernel the catalog has not read, with a version still queued
+        self.db.outbox.put([("ADD_DATA", [("kernel-c", "cell", 1, "unknown", "df", "default", 4, "c-4", None, "frame:ab")])])
+        self.db._cursor = unittest.mock.Mock(execute=unittest.mock.Mock(
+            side_effect=mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013)))
+        links = self.db.data_snapshots() # what the remote db had at the last read
+        self.assertEqual(links["msg_ids"], {"a-1", "c-4"})
+        self.assertEqual(links["object_refs"], {("frame", "ab")})
+
+        self.db._snapshot_links = None # not read since the server started
+        self.assertIsNone(self.db.data_snapshots())
+
+class TestAsyncDb(StorageTestCase):
+    """awaitable database calls"""
+
+    def setUp(self):
+        super().setUp()
+        self._add_namespaces()
+
+    def test_async_db(self):
+        async_db = AsyncDbHandler(self.db)
+
+        async def requests():
+            recent = await async_db.recent_ns("kernel-a")
+            thread = await async_db.run(lambda: threading.current_thread().name)
+            return recent["msg_id"], thread
+        msg_id, thread = asyncio.run(requests())
+        async_db.close()
+        self.assertEqual(msg_id, "a-2")
+        self.assertTrue(thread.startswith("db"))
+
+    def test_async_wait_for_ns(self):
+        # a snapshot that is not there yet does not hold the only database thread
+        async_db = AsyncDbHandler(self.db, workers=1)
+        finished = []
+
+        async def wait():
+            ns = await async_db.wait_for_ns(9, "kernel-a", timeout=1)
+            finished.append("wait")
+            return ns
+
+        async def read():
+            await asyncio.sleep(0.1)
+            recent = await async_db.recent_ns("kernel-b")
+            finished.append("read")
+            return recent
+
+        async def requests():
+            return await asyncio.gather(wait(), read())
+        ns, recent = asyncio.run(requests())
+        async_db.close()
+        self.assertIsNone(ns)
+        self.assertEqual(recent["msg_id"], "b-2")
+        self.assertEqual(finished, ["read", "wait"])
+
+class TestSnapshotTelemetry(StorageTestCase):
+    """per variable snapshot costs"""
+
+    def test_snapshot_vars(self):
+        insert = LOCAL_SQL_CMDS["ADD_SNAPSHOT_VARS"]
+        self.db._conn.executemany(insert, [
+            ("a-1", "kernel-a", "df", "pandas.core.frame.DataFrame", 5000, 0.5, "stored", "2021-01-01 00:00:01"),
+            ("a-1", "kernel-a", "x", "builtins.int", 20, 0.01, "stored", "2021-01-01 00:00:01"),
+            ("a-2", "kernel-a", "df", "pandas.core.frame.DataFrame", 5000, 0.1, "unchanged", "2021-01-01 00:00:03"),
+            ("a-2", "kernel-a", "lock", "_thread.lock", 0, 0.7, "skipped", "2021-01-01 00:00:03"),
+            ("b-1", "kernel-b", "big", "numpy.ndarray", 90000, 2.0, "stored", "2021-01-01 00:00:02")])
+        self.db._conn.commit()
+
+        slowest = self.db.slowest_vars("kernel-a", limit=2)
+        self.assertEqual([v["name"] for v in slowest], ["lock", "df"])
+        self.assertEqual(slowest[1]["snapshots"], 2)
+        self.assertAlmostEqual(slowest[1]["seconds"], 0.6)
+        self.assertEqual(slowest[0]["skipped"], 1)
+
+        self.assertEqual([v["name"] for v in self.db.largest_vars("kernel-a")], ["df", "x", "lock"])
+        self.assertEqual(self.db.largest_vars(limit=1)[0]["name"], "big")
+
+class TestNamespaceLoading(StorageTestCase):
+    """decoding stored namespaces"""
+
+    def setUp(self):
+        super().setUp()
+        self._add_namespaces()
+
+    def test_ns_cache(self):
+        ns = self.db.recent_ns("kernel-a")
+        misses = self.db.ns_cache.misses
+        self.assertEqual(load_ns(ns, cache=self.db.ns_cache), {})
+        self.assertEqual(load_profiles(self.db.recent_ns("kernel-a"), cache=self.db.ns_cache), {})
+        self.assertEqual(self.db.ns_cache.misses, misses) # decoded once by recent_ns
+
+        cache = NamespaceCache(max_bytes=100)
+        cache.get("a", lambda: "a", 60)
+        cache.get("b", lambda: "b", 30)
+        cache.get("a", lambda: "not loaded", 60)
+        cache.get("c", lambda: "c", 30) # evicts b, the least recently used
+        self.assertEqual((cache.peek("a"), cache.peek("b"), cache.nbytes), ("a", None, 90))
+        self.assertEqual(cache.get("d", lambda: "d", 200), "d")
+        self.assertIsNone(cache.peek("d")) # larger than the whole cache
+
+    def test_lazy_dfs(self):
+        store = ObjectStore(self.TEST_DB_DIR + "objects/", self.TEST_DB_DIR + "frames/")
+        manifest = DeltaEncoder(store).encode({"a" : pd.DataFrame({"x" : [1]}), "b" : pd.DataFrame({"y" : [2]})})
+        dfs = load_dfs({"msg_id" : "lazy", "namespace" : dill.dumps(manifest)}, store=store)
+
+        self.assertEqual(sorted(dfs), ["a", "b"])
+        self.assertIn("b", dfs)
+        self.assertEqual(dfs._loaded, {}) # nothing loaded yet
+        self.assertEqual(dfs["a"]["x"].tolist(), [1])
+        self.assertIs(dfs.get("a"), dfs["a"])
+        self.assertEqual(list(dfs._loaded), ["a"])
+        with self.assertRaises(TypeError):
+            dfs["c"] = None
+        shutil.rmtree(self.TEST_DB_DIR + "objects/")
+        shutil.rmtree(self.TEST_DB_DIR + "frames/")
+
+    def test_samples_left_out(self):
+        store = ObjectStore(self.TEST_DB_DIR + "objects/", self.TEST_DB_DIR + "frames/")
+        big_df = pd.DataFrame({"age" : list(range(1000))})
+        manifest = DeltaEncoder(store, object_budget=1000, sample_rows=20).encode({"big_df" : big_df,
+                                                                                 "df" : pd.DataFrame({"x" : [1]})})
+        dfs = load_dfs({"msg_id" : "sampled", "namespace" : dill.dumps(manifest)}, store=store)
+
+        self.assertTrue(dfs.sampled("big_df"))
+        self.assertEqual(dfs._loaded, {}) # told from the stored schema
+        self.assertEqual(list(dfs.without_samples()), ["df"])
+        shutil.rmtree(self.TEST_DB_DIR + "objects/")
+        shutil.rmtree(self.TEST_DB_DIR + "frames/")
+
+    def test_version_object_ref(self):
+        self.db.store = ObjectStore(self.TEST_DB_DIR + "objects/", self.TEST_DB_DIR + "frames/")
+        manifest = DeltaEncoder(self.db.store).encode({"df" : pd.DataFrame({"age" : [26, 57]})})
+        dfs = load_dfs({"msg_id" : "ref", "namespace" : dill.dumps(manifest)}, store=self.db.store)
+        data = {"kernel" : "kernel-a", "cell" : "cell", "source" : "test.csv", "name" : "df",
+                "columns" : {"age" : {"type" : "int64", "size" : 2}}}
+        self.db.check_add_data(data, 9, "no-such-snapshot", dfs.ref("df"))
+
+        frame = self.db.get_dataframe_version({"name" : "df", "kernel" : "kernel-a"}, 1)
+        self.assertEqual(frame["age"].tolist(), [26, 57]) # without a snapshot to link it to
+        shutil.rmtree(self.TEST_DB_DIR + "objects/")
+        shutil.rmtree(self.TEST_DB_DIR + "frames/")
+
+class TestRemoteUnreachable(unittest.TestCase):
+    """a RemoteDbHandler started while the remote database cannot be reached"""
+
+    def setUp(self):
+        temp_home(self)
+        self.outbox = Outbox("./outboxtest.db")
+        self.addCleanup(os.remove, "./outboxtest.db")
+        self.addCleanup(self.outbox.close)
+        self.refused = mysql.connector.errors.InterfaceError(msg="Can't connect", errno=2003)
+        with unittest.mock.patch("prompter.storage.MySQLConnectionPool", side_effect=self.refused) as make_pool:
+            self.db = prompter.RemoteDbHandler("db", "user", "password", "host", "default", pool_size=2,
+                                               outbox=self.outbox)
+        make_pool.assert_not_called() # connects on the database threads
+
+    def test_reconnected(self):
+        self.db.store_response("kernel-a", "cell", 2, {"n" : 2})
+        with unittest.mock.patch("prompter.storage.MySQLConnectionPool", side_effect=self.refused):
+            self.assertEqual(self.db.get_responses("kernel-a"), {"cell" : [{"n" : 2}]}) # only what is queued
+        self.assertTrue(self.db.remote_down())
+
+        conn = unittest.mock.MagicMock()
+        conn.cursor.return_value.fetchall.return_value = [{"cell" : "cell", "resp" : '{"n" : 1}'}]
+        pool = unittest.mock.Mock(get_connection=unittest.mock.Mock(return_value=conn))
+        with unittest.mock.patch("prompter.storage.MySQLConnectionPool", return_value=pool) as make_pool:
+            self.assertEqual(self.db.get_responses("kernel-a"), {"cell" : [{"n" : 2}]}) # not tried again yet
+            self.db.remote_reached(True)
+            self.assertEqual(self.db.get_responses("kernel-a"), {"cell" : [{"n" : 1}, {"n" : 2}]})
+        self.assertFalse(self.db.remote_down())
+        # a connection for each database thread, and one for a call made off them
+        self.assertEqual(make_pool.call_args.kwargs["pool_size"], 3)
+
+    def test_without_outbox(self):
+        db = prompter.RemoteDbHandler("db", "user", "password", "host", "default")
+        with unittest.mock.patch("prompter.storage.MySQLConnectionPool", side_effect=self.refused):
+            with self.assertRaises(mysql.connector.Error):
+                db.get_responses("kernel-a")
+
+    def tearDown(self):
+        self.db.close()
+
 if __name__ == "__main__":
     unittest.main()